@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -60,6 +61,16 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # orjson-backed JSON; output matches the stock JSONRenderer
+    'DEFAULT_RENDERER_CLASSES': [
+        'btValidator.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'btValidator.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 
@@ -104,15 +115,42 @@ COSMOS_DB = {
     'ENDPOINT': os.getenv('COSMOS_DB_ENDPOINT'),
     'PRIMARY_KEY': os.getenv('COSMOS_DB_PRIMARY_KEY'),
     'DATABASE': os.getenv('COSMOS_DB_DATABASE'),
-    'CONTAINER': os.getenv('COSMOS_DB_CONTAINER')
+    'CONTAINER': os.getenv('COSMOS_DB_CONTAINER'),
+    # Document field the container is partitioned on. 'id' lets every lookup be a point read.
+    'PARTITION_KEY': os.getenv('COSMOS_DB_PARTITION_KEY', 'id'),
+    # Query across partitions when a point read misses, for documents not yet migrated
+    'LEGACY_QUERY_FALLBACK': os.getenv('COSMOS_DB_LEGACY_QUERY_FALLBACK', 'True') == 'True',
+    'POOL_SIZE': int(os.getenv('COSMOS_DB_POOL_SIZE', '20')),  # Keep-alive connections per process
+    'CONNECTION_TIMEOUT': int(os.getenv('COSMOS_DB_CONNECTION_TIMEOUT', '30')),  # Seconds
+    'RETRY_TOTAL': int(os.getenv('COSMOS_DB_RETRY_TOTAL', '9')),  # Throttled (429) request retries
+    'PAGE_SIZE': int(os.getenv('COSMOS_DB_PAGE_SIZE', '50')),  # Default items per list page
+    'MAX_PAGE_SIZE': int(os.getenv('COSMOS_DB_MAX_PAGE_SIZE', '200')),
 }
 
 # Azure Blob Storage Configuration
+# For local development point the connection string at Azurite: 'UseDevelopmentStorage=true'
 AZURE_STORAGE = {
     'CONNECTION_STRING': os.getenv('AZURE_STORAGE_CONNECTION_STRING', ''),
     'CONTAINER_NAME': os.getenv('AZURE_STORAGE_CONTAINER_NAME', ''),
     'ALLOWED_FILE_TYPES': ['application/pdf'],
-    'MAX_FILE_SIZE': 10 * 1024 * 1024  # 10MB
+    'MAX_FILE_SIZE': 10 * 1024 * 1024,  # 10MB
+    'UPLOAD_CONCURRENCY': int(os.getenv('AZURE_STORAGE_UPLOAD_CONCURRENCY', '5')),  # Files uploaded in parallel
+    'MAX_CONCURRENCY': int(os.getenv('AZURE_STORAGE_MAX_CONCURRENCY', '4')),  # Parallel blocks per file
+    'MAX_SINGLE_PUT_SIZE': 4 * 1024 * 1024,  # Larger files are uploaded in blocks
+    'MAX_BLOCK_SIZE': 4 * 1024 * 1024,
+    'STAGING_CONTAINER': os.getenv('AZURE_STORAGE_STAGING_CONTAINER', 'staging'),  # generate-report uploads reused by submit-report
+    'STAGING_TTL': int(os.getenv('AZURE_STORAGE_STAGING_TTL', str(24 * 60 * 60))),  # Seconds before unclaimed staged files are purged
+}
+
+# PDF rasterization
+PDF_PROCESSING = {
+    'RENDER_WINDOW': int(os.getenv('PDF_RENDER_WINDOW', '2')),  # Pages rendered per pdftoppm call
+    'RENDER_THREADS': int(os.getenv('PDF_RENDER_THREADS', '1')),  # pdftoppm processes per window (pdf2image thread_count)
+    'WORKERS': int(os.getenv('PDF_RENDER_WORKERS', '0')),  # Process pool size for rendering; 0 renders on the request thread
+    'TEXT_LAYER': os.getenv('PDF_TEXT_LAYER', 'True') == 'True',  # Send embedded text instead of images when present
+    'TEXT_MIN_CHARS': int(os.getenv('PDF_TEXT_MIN_CHARS', '200')),  # Minimum text on a page to skip rendering
+    'IMAGE_PAGE_SECONDS': float(os.getenv('PDF_IMAGE_PAGE_SECONDS', '5')),  # Render + extraction estimate for text_layer_seconds_saved until measured
+    'TEXT_TIMEOUT': int(os.getenv('PDF_TEXT_TIMEOUT', '30')),  # Seconds allowed for pdftotext per file
 }
 
 AZURE_OPENAI = {
@@ -120,8 +158,91 @@ AZURE_OPENAI = {
     'ENDPOINT': os.getenv('AZURE_OPENAI_ENDPOINT', ''),
     'API_VERSION': os.getenv('AZURE_OPENAI_API', ''),
     'DEPLOYMENT': os.getenv('AZURE_OPENAI_DEPLOYMENT', ''),
+    'MAX_CONCURRENCY': int(os.getenv('AZURE_OPENAI_MAX_CONCURRENCY', '4')),  # Parallel page requests per upload
+    # Starting cap on page requests in flight across the whole process; halves on 429s and grows back
+    'PROCESS_MAX_CONCURRENCY': int(os.getenv('AZURE_OPENAI_PROCESS_MAX_CONCURRENCY', '16')),
+    'POOL_SIZE': int(os.getenv('AZURE_OPENAI_POOL_SIZE', '20')),  # Keep-alive connections per process
+    'KEEPALIVE_EXPIRY': float(os.getenv('AZURE_OPENAI_KEEPALIVE_EXPIRY', '60')),  # Seconds
+    'TIMEOUT': float(os.getenv('AZURE_OPENAI_TIMEOUT', '120')),  # Seconds per request
+    'CONNECT_TIMEOUT': float(os.getenv('AZURE_OPENAI_CONNECT_TIMEOUT', '10')),  # Seconds
+    'MAX_RETRIES': int(os.getenv('AZURE_OPENAI_MAX_RETRIES', '3')),  # SDK retries with exponential backoff
+    'BATCH_PAGES': int(os.getenv('AZURE_OPENAI_BATCH_PAGES', '1')),  # Pages per completion; 1 disables batching
+    'BATCH_TOKEN_BUDGET': int(os.getenv('AZURE_OPENAI_BATCH_TOKEN_BUDGET', '6000')),  # Estimated image tokens per batch
+    # Constrain responses to the JSON schema (needs API version 2024-08-01-preview or later)
+    'STRUCTURED_OUTPUTS': os.getenv('AZURE_OPENAI_STRUCTURED_OUTPUTS', 'False') == 'True',
+    # Deployment quota shared by all workers on the host; 0 disables that limit
+    'RPM_LIMIT': int(os.getenv('AZURE_OPENAI_RPM_LIMIT', '0')),  # Requests per minute
+    'TPM_LIMIT': int(os.getenv('AZURE_OPENAI_TPM_LIMIT', '0')),  # Tokens per minute
+    # SQLite file holding the shared buckets; defaults to the local temp directory. Keep it off network
+    # shares such as App Service's /home, or set AZURE_OPENAI_RATE_LIMIT_JOURNAL_MODE=DELETE there.
+    'RATE_LIMIT_PATH': os.getenv('AZURE_OPENAI_RATE_LIMIT_PATH'),
+    'RATE_LIMIT_JOURNAL_MODE': os.getenv('AZURE_OPENAI_RATE_LIMIT_JOURNAL_MODE', 'WAL'),
 }
 
+# Cache for per-page model extractions, keyed by page image hash + schema + prompt version.
+# Use btValidator.cache.SQLiteCache to share entries between gunicorn workers;
+# set EXTRACTION_CACHE_BACKEND to an empty string to disable caching.
+EXTRACTION_CACHE = {
+    'BACKEND': os.getenv('EXTRACTION_CACHE_BACKEND', 'btValidator.cache.MemoryCache'),
+    'OPTIONS': {
+        'ttl': int(os.getenv('EXTRACTION_CACHE_TTL', str(24 * 60 * 60))),  # Seconds
+        'max_bytes': int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', str(16 * 1024 * 1024))),  # MemoryCache only
+        'path': os.getenv('EXTRACTION_CACHE_PATH'),  # SQLiteCache only
+    },
+}
+
+# Read-through cache of travel request documents keyed by id, invalidated by every
+# CosmosDB write. SQLiteCache is shared by all worker processes on the host, so an
+# invalidation in one worker is seen by the others; a MemoryCache is per process and
+# only safe with a single worker. Set REQUEST_CACHE_BACKEND to an empty string to disable.
+REQUEST_CACHE = {
+    'BACKEND': os.getenv('REQUEST_CACHE_BACKEND', 'btValidator.cache.SQLiteCache'),
+    'OPTIONS': {
+        'ttl': int(os.getenv('REQUEST_CACHE_TTL', '60')),  # Seconds; bounds staleness from writes made outside CosmosDB
+        'table': 'request_cache',
+        # SQLiteCache only; defaults to the local temp directory. Keep it off network shares
+        # such as App Service's /home, or set REQUEST_CACHE_JOURNAL_MODE=DELETE there.
+        'path': os.getenv('REQUEST_CACHE_PATH'),
+        'journal_mode': os.getenv('REQUEST_CACHE_JOURNAL_MODE', 'WAL'),  # SQLiteCache only
+    },
+}
+
+# Background generate-report jobs (?mode=async)
+REPORT_JOBS = {
+    # Spooled inputs + SQLite status store, on local disk by default. Keep it off network shares
+    # such as App Service's /home, or set REPORT_JOBS_JOURNAL_MODE=DELETE there.
+    'DIR': os.getenv('REPORT_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'btvalidator_report_jobs')),
+    'JOURNAL_MODE': os.getenv('REPORT_JOBS_JOURNAL_MODE', 'WAL'),
+    'WORKERS': int(os.getenv('REPORT_JOBS_WORKERS', '2')),  # Jobs processed concurrently per process
+    'TTL': int(os.getenv('REPORT_JOBS_TTL', str(24 * 60 * 60))),  # Seconds finished jobs are kept
+    'STALE_AFTER': int(os.getenv('REPORT_JOBS_STALE_AFTER', str(15 * 60))),  # Seconds without progress before a queued/running job is failed
+}
+
+# Dashboard aggregates maintained from the Cosmos DB change feed by
+# `python manage.py consume_change_feed` and served by /api/travel-requests/stats/
+DASHBOARD_STATS = {
+    # Aggregates + lease store, on local disk by default; a lost file is rebuilt from the start of the feed.
+    # Keep it off network shares such as App Service's /home, or set DASHBOARD_STATS_JOURNAL_MODE=DELETE there.
+    'PATH': os.getenv(
+        'DASHBOARD_STATS_PATH', os.path.join(tempfile.gettempdir(), 'btvalidator_dashboard_stats.sqlite3')
+    ),
+    'JOURNAL_MODE': os.getenv('DASHBOARD_STATS_JOURNAL_MODE', 'WAL'),
+    'BATCH_SIZE': int(os.getenv('DASHBOARD_STATS_BATCH_SIZE', '100')),  # Changed documents per checkpoint
+    'POLL_INTERVAL': float(os.getenv('DASHBOARD_STATS_POLL_INTERVAL', '5')),  # Seconds between polls once caught up
+    'LEASE_TTL': int(os.getenv('DASHBOARD_STATS_LEASE_TTL', '60')),  # Seconds before a silent consumer's lease can be taken over
+    # The change feed omits hard deletes; seconds between passes removing them (0 disables)
+    'RECONCILE_INTERVAL': int(os.getenv('DASHBOARD_STATS_RECONCILE_INTERVAL', '3600')),
+}
+
+# Prometheus-format /api/metrics endpoint, restricted to local scrapers
+METRICS = {
+    'ALLOWED_IPS': os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(','),
+}
+
+# Serve /api/travel-requests/ with async views (btValidator.async_views); run under ASGI,
+# e.g. `uvicorn backend.asgi:application`, so requests waiting on I/O do not hold a thread
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+
 WSGI_APPLICATION = 'backend.wsgi.application'
 
 # Database
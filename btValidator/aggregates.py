@@ -0,0 +1,335 @@
+# aggregates.py
+
+from django.conf import settings
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from .data import get_cosmos_db
+from .metrics import increment, span
+
+logger = logging.getLogger(__name__)
+
+# Dimensions travel requests are aggregated by, in the order of a contribution tuple
+DIMENSIONS = ('status', 'department', 'month')
+
+LEASE_NAME = 'travel_requests'
+
+
+class LeaseUnavailableError(Exception):
+    """Another consumer holds the change feed lease"""
+    pass
+
+
+def _contribution(item):
+    """
+    Return the (status, department, month, total_amount) a document adds to
+    the aggregates, or None for documents that are not travel requests or
+    are soft-deleted ('deleted': true, e.g. before a ttl removes them).
+    The month is taken from start_date, or created_at when there is none.
+    """
+    if item.get('type') != 'travel_request' or item.get('deleted'):
+        return None
+    try:
+        amount = float(item.get('total_amount') or 0)
+    except (TypeError, ValueError):
+        amount = 0.0
+    month = str(item.get('start_date') or item.get('created_at') or '')[:7]
+    return (str(item.get('status') or ''), str(item.get('department') or ''), month, amount)
+
+
+class AggregateStore:
+    """
+    SQLite-backed dashboard aggregates maintained from the Cosmos DB change feed.
+
+    The change feed only returns the latest version of a document, so the
+    contribution of every document is kept as well: a change first removes the
+    previous contribution, then adds the new one. Aggregates, contributions and
+    the feed continuation are committed in one transaction, so a consumer that
+    restarts resumes from its checkpoint and replaying a batch is harmless.
+    The lease row makes sure only one consumer applies changes at a time.
+
+    The change feed does not report deletes. Documents soft-deleted with
+    'deleted': true are removed as a change; hard deletes are removed by
+    reconcile(), which drops contributions of documents no longer stored.
+
+    Use journal_mode='DELETE' if path is on a network share: WAL needs
+    shared memory that such filesystems do not provide.
+    """
+
+    def __init__(self, path, journal_mode='WAL'):
+        self.path = path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS aggregates ("
+                "dimension TEXT NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL, "
+                "total_amount REAL NOT NULL, PRIMARY KEY (dimension, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS aggregate_sources ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, department TEXT NOT NULL, "
+                "month TEXT NOT NULL, total_amount REAL NOT NULL, lsn INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS change_feed_leases ("
+                "name TEXT PRIMARY KEY, owner TEXT, expires_at REAL NOT NULL DEFAULT 0, "
+                "continuation TEXT, checkpointed_at REAL)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self._local.conn = conn
+        return conn
+
+    def acquire_lease(self, owner, ttl):
+        """
+        Take the change feed lease if it is free, expired or already ours
+
+        Returns:
+            str: Continuation to resume from, or None to start from the beginning
+
+        Raises:
+            LeaseUnavailableError: Another consumer holds the lease
+        """
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO change_feed_leases (name) VALUES (?)", (LEASE_NAME,))
+            cursor = conn.execute(
+                "UPDATE change_feed_leases SET owner = ?, expires_at = ? "
+                "WHERE name = ? AND (owner IS NULL OR owner = ? OR expires_at < ?)",
+                (owner, now + ttl, LEASE_NAME, owner, now)
+            )
+            if cursor.rowcount == 0:
+                raise LeaseUnavailableError(f"Change feed lease {LEASE_NAME} is held by another consumer")
+            return conn.execute(
+                "SELECT continuation FROM change_feed_leases WHERE name = ?", (LEASE_NAME,)
+            ).fetchone()[0]
+
+    def release_lease(self, owner):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE change_feed_leases SET owner = NULL, expires_at = 0 WHERE name = ? AND owner = ?",
+                (LEASE_NAME, owner)
+            )
+
+    def checkpoint(self, owner, items, continuation, ttl):
+        """
+        Apply a batch of changed documents and record the continuation that
+        follows it, renewing the lease
+
+        Raises:
+            LeaseUnavailableError: The lease expired and was taken by another consumer
+        """
+        now = time.time()
+        with self._connection() as conn:
+            # Updating the lease first takes the write lock for the whole batch
+            cursor = conn.execute(
+                "UPDATE change_feed_leases SET continuation = COALESCE(?, continuation), "
+                "expires_at = ?, checkpointed_at = ? WHERE name = ? AND owner = ?",
+                (continuation, now + ttl, now, LEASE_NAME, owner)
+            )
+            if cursor.rowcount == 0:
+                raise LeaseUnavailableError(f"Change feed lease {LEASE_NAME} was lost")
+            applied = sum(self._apply(conn, item) for item in items)
+            if applied:
+                conn.execute("DELETE FROM aggregates WHERE count <= 0")
+        return applied
+
+    def reconcile(self, owner, live_ids, ttl):
+        """
+        Remove the contributions of documents that are no longer in the
+        container, renewing the lease. live_ids must be read after the last
+        checkpoint and before any further one, which holds for the consumer
+        that owns the lease.
+
+        Returns:
+            int: Number of deleted documents removed from the aggregates
+
+        Raises:
+            LeaseUnavailableError: The lease expired and was taken by another consumer
+        """
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE change_feed_leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                (now + ttl, LEASE_NAME, owner)
+            )
+            if cursor.rowcount == 0:
+                raise LeaseUnavailableError(f"Change feed lease {LEASE_NAME} was lost")
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_ids (id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM live_ids")
+            conn.executemany("INSERT OR IGNORE INTO live_ids (id) VALUES (?)", ((id,) for id in live_ids))
+            rows = conn.execute(
+                "SELECT id, status, department, month, total_amount FROM aggregate_sources "
+                "WHERE id NOT IN (SELECT id FROM live_ids)"
+            ).fetchall()
+            for row in rows:
+                self._add(conn, row[1:], -1)
+            conn.executemany("DELETE FROM aggregate_sources WHERE id = ?", ((row[0],) for row in rows))
+            if rows:
+                conn.execute("DELETE FROM aggregates WHERE count <= 0")
+            conn.execute("DELETE FROM live_ids")
+        return len(rows)
+
+    def _apply(self, conn, item):
+        row = conn.execute(
+            "SELECT status, department, month, total_amount, lsn FROM aggregate_sources WHERE id = ?",
+            (item['id'],)
+        ).fetchone()
+        lsn = item.get('_lsn')
+        if row is not None and row[4] is not None and lsn is not None and lsn <= row[4]:
+            # Already applied (a replayed batch)
+            return 0
+        if row is not None:
+            self._add(conn, row[:4], -1)
+        contribution = _contribution(item)
+        if contribution is None:
+            conn.execute("DELETE FROM aggregate_sources WHERE id = ?", (item['id'],))
+        else:
+            self._add(conn, contribution, 1)
+            conn.execute(
+                "INSERT OR REPLACE INTO aggregate_sources "
+                "(id, status, department, month, total_amount, lsn) VALUES (?, ?, ?, ?, ?, ?)",
+                (item['id'], *contribution, lsn)
+            )
+        return 1
+
+    def _add(self, conn, contribution, sign):
+        amount = contribution[3]
+        conn.executemany(
+            "INSERT INTO aggregates (dimension, key, count, total_amount) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (dimension, key) DO UPDATE SET "
+            "count = count + excluded.count, total_amount = total_amount + excluded.total_amount",
+            [(dimension, key, sign, sign * amount) for dimension, key in zip(DIMENSIONS, contribution)]
+        )
+
+    def reset(self):
+        """
+        Drop the aggregates and the checkpoint so they are rebuilt from the
+        beginning of the change feed; call it while holding the lease
+        """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM aggregates")
+            conn.execute("DELETE FROM aggregate_sources")
+            conn.execute(
+                "UPDATE change_feed_leases SET continuation = NULL, checkpointed_at = NULL WHERE name = ?",
+                (LEASE_NAME,)
+            )
+
+    def stats(self):
+        """
+        Return counts and total_amount sums per status, department and month
+
+        Returns:
+            dict: {'by_status': {key: {'count', 'total_amount'}}, 'by_department': ...,
+                'by_month': ..., 'updated_at': time of the last checkpoint or None}
+        """
+        conn = self._connection()
+        stats = {f'by_{dimension}': {} for dimension in DIMENSIONS}
+        for dimension, key, count, total_amount in conn.execute(
+            "SELECT dimension, key, count, total_amount FROM aggregates"
+        ):
+            stats[f'by_{dimension}'][key] = {'count': count, 'total_amount': round(total_amount, 2)}
+        row = conn.execute(
+            "SELECT checkpointed_at FROM change_feed_leases WHERE name = ?", (LEASE_NAME,)
+        ).fetchone()
+        stats['updated_at'] = row[0] if row else None
+        return stats
+
+
+_aggregate_store = None
+_lock = threading.Lock()
+
+
+def get_aggregate_store():
+    """
+    Return the process-wide aggregate store
+    """
+    global _aggregate_store
+    if _aggregate_store is None:
+        with _lock:
+            if _aggregate_store is None:
+                _aggregate_store = AggregateStore(
+                    settings.DASHBOARD_STATS['PATH'], settings.DASHBOARD_STATS['JOURNAL_MODE']
+                )
+    return _aggregate_store
+
+
+def _live_ids(container):
+    with span('change_feed_reconcile'):
+        return set(container.query_items(
+            query="SELECT VALUE c.id FROM c WHERE c.type = 'travel_request'",
+            enable_cross_partition_query=True
+        ))
+
+
+def consume_change_feed(once=False, reset=False, reconcile=False, stop_event=None):
+    """
+    Fold the travel request change feed into the aggregate store, resuming
+    from the last checkpoint, and poll for further changes. Hard-deleted
+    documents are not in the feed; they are dropped by a reconcile pass every
+    DASHBOARD_STATS['RECONCILE_INTERVAL'] seconds while polling.
+
+    Args:
+        once: Return after catching up instead of polling
+        reset: Rebuild the aggregates from the beginning of the feed
+        reconcile: Reconcile deletes once caught up, even if not yet due
+        stop_event: Optional threading.Event that ends the polling loop
+
+    Returns:
+        int: Number of changed documents applied
+
+    Raises:
+        LeaseUnavailableError: Another consumer holds (or took over) the lease
+    """
+    config = settings.DASHBOARD_STATS
+    store = get_aggregate_store()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    continuation = store.acquire_lease(owner, config['LEASE_TTL'])
+    if reset:
+        store.reset()
+        continuation = None
+    container = get_cosmos_db().container
+    applied = 0
+    reconciled_at = time.time()
+    try:
+        while True:
+            options = {'continuation': continuation} if continuation else {'start_time': 'Beginning'}
+            with span('change_feed_poll'):
+                pager = container.query_items_change_feed(
+                    max_item_count=config['BATCH_SIZE'], **options
+                ).by_page()
+                for page in pager:
+                    items = list(page)
+                    continuation = pager.continuation_token
+                    count = store.checkpoint(owner, items, continuation, config['LEASE_TTL'])
+                    increment('change_feed_documents_total', count)
+                    applied += count
+                    logger.info(f"Applied {count} of {len(items)} changed travel requests")
+            interval = config['RECONCILE_INTERVAL']
+            if reconcile or (interval and time.time() - reconciled_at >= interval):
+                removed = store.reconcile(owner, _live_ids(container), config['LEASE_TTL'])
+                increment('change_feed_deletes_total', removed)
+                logger.info(f"Removed {removed} deleted travel requests from the aggregates")
+                reconcile = False
+                reconciled_at = time.time()
+            if once:
+                break
+            # Renews the lease while the feed is idle
+            store.checkpoint(owner, [], None, config['LEASE_TTL'])
+            if stop_event is not None:
+                if stop_event.wait(config['POLL_INTERVAL']):
+                    break
+            else:
+                time.sleep(config['POLL_INTERVAL'])
+    finally:
+        store.release_lease(owner)
+    return applied
@@ -0,0 +1,338 @@
+# async_views.py
+
+from adrf.viewsets import ViewSet as AsyncViewSet
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from django.http import StreamingHttpResponse
+from .data import get_async_cosmos_db
+from .jobs import submit_report_job
+from .metrics import timed
+from .renderers import EventStreamRenderer, ORJSONRenderer, format_sse
+from .models import TravelRequest, Document, RequestHistory, Expense
+from .serializers import TravelRequestSerializer, DocumentSerializer
+from .utils import (
+    aupload_to_blob_storage, aupload_multiple_files, acleanup_uploaded_files, apromote_staged_files,
+    astart_staging_files, acall_openai_api, astream_expense_report, iter_pdf_pages_as_base64, parse_expenses, build_report_data,
+    EXPENSE_SCHEMA
+)
+from .views import TravelRequestViewSet
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTravelRequestViewSet(AsyncViewSet, TravelRequestViewSet):
+    """
+    TravelRequestViewSet with the I/O-bound actions implemented as coroutines
+    on azure.cosmos.aio, azure.storage.blob.aio and AsyncAzureOpenAI, so a
+    request waiting on Cosmos, Blob or the model does not hold a thread.
+    Served in place of TravelRequestViewSet when settings.ASYNC_VIEWS is on
+    (run the ASGI application, e.g. `uvicorn backend.asgi:application`).
+    adrf runs the actions not overridden here (report_job, stats) through
+    sync_to_async, one call at a time on the single thread shared by every
+    thread-sensitive call, so only quick local reads are left to them.
+    """
+
+    @timed('view', action='list')
+    async def list(self, request):
+        try:
+            params = self._list_params(request)
+            travel_requests, continuation, etag = await get_async_cosmos_db().list_travel_requests_page(**params)
+        except ValueError:
+            return Response(
+                {'error': 'Invalid page_size or cursor'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return self._list_response(request, travel_requests, continuation, etag, params['summary'])
+
+    @timed('view', action='retrieve')
+    async def retrieve(self, request, pk=None):
+        return self._retrieve_response(request, await get_async_cosmos_db().get_travel_request_item(pk))
+
+    async def create(self, request):
+        serializer = TravelRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        travel_request = serializer.save(requester=request.user.email, status='PENDING')
+        travel_request.history.append(RequestHistory(
+            type='created',
+            title='Request Created',
+            user=request.user.email,
+            comments='Travel request submitted for approval'
+        ))
+        created_request = await get_async_cosmos_db().create_travel_request(travel_request)
+        return Response(TravelRequestSerializer(created_request).data, status=status.HTTP_201_CREATED)
+
+    async def _patch_response(self, request, pk, updates=None, append=None):
+        """
+        Apply a patch honouring If-Match and return the updated request,
+        412 when it changed concurrently or 404 when it does not exist
+        """
+        try:
+            updated_request = await get_async_cosmos_db().update_travel_request(
+                pk,
+                updates=updates,
+                append=append,
+                etag=request.headers.get('If-Match')
+            )
+        except CosmosAccessConditionFailedError:
+            return Response(status=status.HTTP_412_PRECONDITION_FAILED)
+        if not updated_request:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(TravelRequestSerializer(updated_request).data)
+
+    @action(detail=True, methods=['post'])
+    async def approve(self, request, pk=None):
+        history_entry = RequestHistory(
+            type='approved',
+            title='Request Approved',
+            user=request.user.email,
+            comments=request.data.get('comments', '')
+        )
+        return await self._patch_response(
+            request, pk, updates={'status': 'APPROVED'}, append={'history': [history_entry]}
+        )
+
+    @action(detail=True, methods=['post'])
+    async def reject(self, request, pk=None):
+        history_entry = RequestHistory(
+            type='rejected',
+            title='Request Rejected',
+            user=request.user.email,
+            comments=request.data.get('comments', '')
+        )
+        return await self._patch_response(
+            request, pk, updates={'status': 'REJECTED'}, append={'history': [history_entry]}
+        )
+
+    @action(detail=True, methods=['post'])
+    async def assign(self, request, pk=None):
+        assignee_email = request.data.get('assignee_email')
+        comments = request.data.get('comments', '')
+        history_entry = RequestHistory(
+            type='assigned',
+            title='Request Assigned',
+            user=request.user.email,
+            comments=f"Assigned to {assignee_email}. {comments}"
+        )
+        return await self._patch_response(request, pk, append={'history': [history_entry]})
+
+    @action(detail=True, methods=['post'])
+    async def upload_document(self, request, pk=None):
+        file = request.FILES.get('file')
+        if not file:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            file_url = await aupload_to_blob_storage(file)
+            document = Document(
+                file_name=file.name,
+                file_size=file.size,
+                file_url=file_url
+            )
+            if not await get_async_cosmos_db().update_travel_request(pk, append={'documents': [document]}):
+                # The travel request does not exist; do not keep its blob
+                await acleanup_uploaded_files([{'url': file_url}])
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            return Response(DocumentSerializer(document).data)
+
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['post'], url_path='generate-report')
+    @timed('view', action='generate_report')
+    async def generate_report(self, request):
+        """
+        Process uploaded PDFs and extract expense information
+        """
+        try:
+            files = request.FILES.getlist('files')
+            error_response = self._validate_report_files(files)
+            if error_response:
+                return error_response
+
+            if request.query_params.get('mode') == 'async':
+                # Spooling the inputs writes to disk
+                job_id = await asyncio.to_thread(submit_report_job, files)
+                return Response({
+                    'job_id': job_id,
+                    'status': 'queued',
+                    'status_url': reverse('travel-request-report-job', kwargs={'job_id': job_id}, request=request)
+                }, status=status.HTTP_202_ACCEPTED)
+
+            # Stage the files so submit-report can reference them instead of
+            # receiving them again; the upload overlaps the extraction
+            staging = await astart_staging_files(files)
+            try:
+                responses = await acall_openai_api(
+                    iter_pdf_pages_as_base64(files), json.dumps(EXPENSE_SCHEMA)
+                )
+                logger.info(f"Received {len(responses)} responses from OpenAI")
+            except Exception as e:
+                # Let the upload finish rather than leave the task unreferenced
+                await staging
+                return self._extraction_error_response(e)
+
+            all_expenses = []
+            for response in responses:
+                all_expenses.extend(parse_expenses(response))
+
+            return Response(build_report_data(files, all_expenses, await staging), status=status.HTTP_200_OK)
+
+        except Exception as e:
+            logger.error(f"Error in generate_report: {str(e)}")
+            return Response(
+                {'error': f'Error processing request: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    @action(detail=False, methods=['post'], url_path='generate-report/stream',
+            renderer_classes=[ORJSONRenderer, EventStreamRenderer])
+    async def generate_report_stream(self, request):
+        """
+        Streaming variant of generate-report. Under ASGI a synchronous iterator
+        is buffered in full before it is sent, so events come from an async
+        generator and each one is flushed as soon as its page completes.
+        """
+        files = request.FILES.getlist('files')
+        error_response = self._validate_report_files(files)
+        if error_response:
+            return error_response
+
+        async def events():
+            async for event, data in astream_expense_report(files):
+                yield format_sse(event, data)
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering
+        return response
+
+    @action(detail=True, methods=['put'], url_path='update-report')
+    @timed('view', action='update_report')
+    async def update_report(self, request, pk=None):
+        """
+        Update a travel request with edited report data
+        """
+        try:
+            history_entry = RequestHistory(
+                type='updated',
+                title='Report Updated',
+                user=request.user.email,
+                comments='Report details were updated'
+            )
+
+            # Only the fields present in the request are patched; the rest are left as stored
+            fields = ['requester', 'department', 'position', 'start_date', 'end_date', 'total_amount']
+            updates = {field: request.data[field] for field in fields if field in request.data}
+            if 'expenses' in request.data:
+                updates['expenses'] = [Expense.from_dict(expense) for expense in request.data['expenses']]
+
+            response = await self._patch_response(request, pk, updates=updates, append={'history': [history_entry]})
+            if response.status_code == status.HTTP_412_PRECONDITION_FAILED:
+                response.data = {'error': 'Travel request was modified by another user'}
+            elif response.status_code == status.HTTP_404_NOT_FOUND:
+                response.data = {'error': 'Travel request not found'}
+            return response
+
+        except Exception as e:
+            return Response(
+                {'error': f'Error updating report: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    @action(detail=False, methods=['post'], url_path='submit-report', parser_classes=[MultiPartParser, FormParser])
+    @timed('view', action='submit_report')
+    async def submit_report(self, request):
+        """
+        Create a new travel request from the user-validated extracted data
+        """
+        uploaded_files = []
+        try:
+            files = request.FILES.getlist('files')
+            try:
+                if isinstance(request.data.get('data'), str):
+                    data = json.loads(request.data.get('data', '{}'))
+                else:
+                    data = request.data.get('data', {})
+            except json.JSONDecodeError as e:
+                logger.error(f"Error parsing JSON data: {str(e)}")
+                return Response(
+                    {'error': 'Invalid JSON data provided'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Files staged by generate-report are copied server-side instead of re-uploaded
+            staged_files = data.get('staged_files') or []
+            try:
+                if staged_files:
+                    uploaded_files = await apromote_staged_files(staged_files)
+                if files:
+                    uploaded_files = uploaded_files + await aupload_multiple_files(files)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except Exception as e:
+                logger.error(f"Error uploading files: {str(e)}")
+                await acleanup_uploaded_files(uploaded_files)
+                return Response(
+                    {'error': f'Error uploading files: {str(e)}'},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            travel_request = TravelRequest(
+                requester=str(data.get('requester', '')),
+                status='PENDING_REVIEW',
+                department=str(data.get('department', '')),
+                position=str(data.get('position', '')),
+                start_date=data.get('start_date'),
+                end_date=data.get('end_date'),
+                total_amount=float(data.get('total_amount', 0))
+            )
+            travel_request.expenses = [
+                Expense(
+                    id=expense_data.get('id'),
+                    category=str(expense_data.get('category', '')),
+                    description=str(expense_data.get('description', '')),
+                    amount=float(expense_data.get('amount', 0)),
+                    date=expense_data.get('date')
+                )
+                for expense_data in data.get('expenses', [])
+            ]
+            travel_request.documents = [
+                Document(
+                    file_name=str(file_info['name']),
+                    file_size=int(file_info['size']),
+                    file_url=str(file_info['url'])
+                )
+                for file_info in uploaded_files
+            ]
+            travel_request.history = [RequestHistory(
+                type='submitted',
+                title='Report Submitted',
+                user=request.user.email if request.user.is_authenticated else 'anonymous',
+                comments='Travel request submitted for review'
+            )]
+
+            created_request = await get_async_cosmos_db().create_travel_request(travel_request)
+            logger.info(f"Successfully created travel request with ID: {created_request['id']}")
+
+            return Response({
+                'message': 'Report submitted successfully',
+                'request_id': created_request['id'],
+                'uploaded_files': uploaded_files
+            }, status=status.HTTP_201_CREATED)
+
+        except Exception as e:
+            logger.error(f"Error in submit_report: {str(e)}")
+            if uploaded_files:
+                await acleanup_uploaded_files(uploaded_files)
+            return Response(
+                {'error': f'Error submitting report: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
@@ -0,0 +1,274 @@
+# cache.py
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from .metrics import increment
+
+logger = logging.getLogger(__name__)
+
+
+def make_extraction_key(page_bytes, schema, prompt_version):
+    """
+    Build a content-addressed cache key for a single page extraction
+
+    Args:
+        page_bytes: Rendered page image (raw or base64 encoded bytes/str)
+        schema: JSON schema string sent to the model
+        prompt_version: Version tag of the system prompt
+
+    Returns:
+        str: Hex sha256 digest
+    """
+    if isinstance(page_bytes, str):
+        page_bytes = page_bytes.encode('utf-8')
+    digest = hashlib.sha256()
+    digest.update(page_bytes)
+    digest.update(b'\0')
+    digest.update(str(schema).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(str(prompt_version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class BaseCache:
+    """
+    Base class for the extraction and travel request caches. Values are strings.
+    Subclasses implement _get, _set and _delete; hit/miss counting is shared
+    and exported as cache_requests_total{cache=name, result=hit|miss}.
+    """
+
+    def __init__(self, ttl=None, name='cache', **kwargs):
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        increment('cache_requests_total', cache=self.name, result='miss' if value is None else 'hit')
+        return value
+
+    def set(self, key, value):
+        if value is None:
+            return
+        self._set(key, value)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def generation(self, key):
+        """
+        Return the invalidation generation of key. Take it before reading the
+        value from its source and pass it to set_unless_invalidated.
+        """
+        return self._get(f'{key}#generation')
+
+    def set_unless_invalidated(self, key, value, generation):
+        """
+        Store a value read from the source unless key was invalidated since
+        generation was taken; that read may predate the write and be stale.
+        The check follows the write, so an invalidation racing with it still
+        either sees the entry or is seen by the check.
+        """
+        self.set(key, value)
+        if self.generation(key) != generation:
+            self._delete(key)
+
+    def invalidate(self, key):
+        """
+        Drop key and start a new generation, so reads already in flight do
+        not store their (possibly stale) value
+        """
+        self._set(f'{key}#generation', uuid.uuid4().hex)
+        self._delete(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryCache(BaseCache):
+    """
+    In-process LRU cache evicting least recently used entries once the
+    total size of stored values exceeds max_bytes
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self._expires_at())
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def _delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._size -= len(value)
+
+
+class SQLiteCache(BaseCache):
+    """
+    SQLite-backed cache shared by every worker process on the host.
+
+    The file defaults to the local temporary directory: WAL needs shared
+    memory that network filesystems (such as the App Service /home share)
+    do not provide. Use journal_mode='DELETE' if path is on such a share.
+    """
+
+    def __init__(self, path=None, table='extraction_cache', journal_mode='WAL', **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or os.path.join(tempfile.gettempdir(), f'btvalidator_{table}.sqlite3')
+        self.table = table
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key):
+        try:
+            row = self._connection().execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Cache {self.table} read failed: {str(e)}")
+            return None
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return value
+
+    def _set(self, key, value):
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, self._expires_at())
+                )
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at < ?",
+                    (time.time(),)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Cache {self.table} write failed: {str(e)}")
+
+    def _delete(self, key):
+        try:
+            with self._connection() as conn:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            # A failed invalidation leaves the entry until it expires
+            logger.warning(f"Cache {self.table} delete failed: {str(e)}")
+
+
+def _build_cache(config, name):
+    backend = import_string(config['BACKEND'])
+    return backend(name=name, **config.get('OPTIONS', {}))
+
+
+_extraction_cache = None
+_extraction_cache_lock = threading.Lock()
+
+
+def get_extraction_cache():
+    """
+    Return the process-wide extraction cache configured in
+    settings.EXTRACTION_CACHE, or None when caching is disabled
+    """
+    global _extraction_cache
+    config = settings.EXTRACTION_CACHE
+    if not config.get('BACKEND'):
+        return None
+    if _extraction_cache is None:
+        with _extraction_cache_lock:
+            if _extraction_cache is None:
+                _extraction_cache = _build_cache(config, 'extraction')
+    return _extraction_cache
+
+
+_request_cache = None
+_request_cache_lock = threading.Lock()
+
+
+def get_request_cache():
+    """
+    Return the process-wide travel request cache configured in
+    settings.REQUEST_CACHE, or None when caching is disabled
+    """
+    global _request_cache
+    config = settings.REQUEST_CACHE
+    if not config.get('BACKEND'):
+        return None
+    if _request_cache is None:
+        with _request_cache_lock:
+            if _request_cache is None:
+                _request_cache = _build_cache(config, 'request')
+    return _request_cache
@@ -1,12 +1,211 @@
 from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.cosmos.exceptions import (
+    CosmosResourceNotFoundError, CosmosAccessConditionFailedError, CosmosHttpResponseError
+)
+from azure.core import MatchConditions
+from azure.core.pipeline.transport import RequestsTransport
 from django.conf import settings
+from .cache import get_request_cache
 from .models import TravelRequest
+from .metrics import increment, current_stage, span
+from .utils import loop_client
 from datetime import datetime
+import asyncio
+import hashlib
 import logging
+import orjson
+import requests
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Fields returned by the summary (dashboard) listing
+SUMMARY_FIELDS = [
+    'id', 'requester', 'status', 'department', 'start_date', 'end_date',
+    'created_at', 'updated_at', 'total_amount'
+]
+
+# Cosmos DB accepts at most 10 operations in a single patch request
+MAX_PATCH_OPERATIONS = 10
+
+def _to_json(value):
+    """
+    Convert model objects (or lists of them) into JSON-compatible values
+    """
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return value
+
+def _patch_operations(updates=None, append=None):
+    """
+    Build the patch operations for update_travel_request, stamping updated_at
+
+    Raises:
+        ValueError: More than MAX_PATCH_OPERATIONS operations
+    """
+    operations = [
+        {'op': 'set', 'path': f'/{field}', 'value': _to_json(value)}
+        for field, value in (updates or {}).items()
+        if field != 'updated_at'
+    ]
+    for field, items in (append or {}).items():
+        operations.extend(
+            {'op': 'add', 'path': f'/{field}/-', 'value': _to_json(item)}
+            for item in items
+        )
+    operations.append({'op': 'set', 'path': '/updated_at', 'value': datetime.utcnow().isoformat()})
+    if len(operations) > MAX_PATCH_OPERATIONS:
+        raise ValueError(f"A patch is limited to {MAX_PATCH_OPERATIONS} operations, got {len(operations)}")
+    return operations
+
+def _page_items(items, summary):
+    if summary:
+        # Cosmos omits projected fields missing from a document
+        return [{field: item.get(field) for field in SUMMARY_FIELDS} for item in items]
+    return [TravelRequest.from_dict(item) for item in items]
+
+def _page_etag(items, continuation, summary):
+    """
+    Weak ETag of a list page: changes whenever a document on the page, the
+    page boundaries or the representation change
+    """
+    digest = hashlib.sha1(b'summary' if summary else b'full')
+    for item in items:
+        digest.update(b'\0')
+        digest.update(str(item.get('_etag')).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(str(continuation).encode('utf-8'))
+    return f'W/"{digest.hexdigest()}"'
+
+def _list_fields(summary):
+    # _etag is projected for the page ETag but not returned in the summary
+    return SUMMARY_FIELDS + ['_etag'] if summary else None
+
+def _partition_key_value(item, path):
+    """
+    Read the value at a partition key path such as '/id' or '/a/b' from a document
+    """
+    value = item
+    for segment in path.strip('/').split('/'):
+        value = value.get(segment) if isinstance(value, dict) else None
+    return value
+
+def _cache_key(request_id):
+    return f"travel_request:{settings.COSMOS_DB['DATABASE']}/{settings.COSMOS_DB['CONTAINER']}:{request_id}"
+
+def _cached_item(request_id):
+    """
+    Return the cached travel request document (with its _etag), or None on a miss
+    """
+    cache = get_request_cache()
+    if cache is None:
+        return None
+    value = cache.get(_cache_key(request_id))
+    return orjson.loads(value) if value is not None else None
+
+def _cache_generation(request_id):
+    # Taken before fetching, so _cache_item can tell a write happened meanwhile
+    cache = get_request_cache()
+    return cache.generation(_cache_key(request_id)) if cache is not None else None
+
+def _cache_item(item, generation):
+    cache = get_request_cache()
+    if cache is not None:
+        cache.set_unless_invalidated(_cache_key(item['id']), orjson.dumps(item).decode('utf-8'), generation)
+
+def _invalidate_item(request_id):
+    # Writes drop the entry rather than storing the result: concurrent writers
+    # could otherwise leave an older version cached until it expires. The new
+    # generation stops reads that started before the write from caching theirs.
+    cache = get_request_cache()
+    if cache is not None:
+        cache.invalidate(_cache_key(request_id))
+
+def _record_cosmos_response(response):
+    """
+    Pipeline hook invoked for every Cosmos DB HTTP response, retries included:
+    records the request charge (RU) and throttled responses under the span
+    that issued the call
+    """
+    http_response = response.http_response
+    operation = current_stage() or 'cosmos_other'
+    increment('cosmos_requests_total', operation=operation, status=http_response.status_code)
+    charge = http_response.headers.get('x-ms-request-charge')
+    if charge:
+        try:
+            increment('cosmos_request_charge_total', float(charge), operation=operation)
+        except ValueError:
+            pass
+    if http_response.status_code == 429:
+        logger.warning(f"Cosmos DB throttled {operation}, retry after "
+                       f"{http_response.headers.get('x-ms-retry-after-ms')}ms")
+
+def partition_key_for(request_id, partition_key=None):
+    """
+    Resolve the partition key value of a travel request.
+
+    Travel requests are partitioned on the field named by
+    COSMOS_DB['PARTITION_KEY'] (default 'id'). With the default strategy the
+    key is always known from the id alone; otherwise the caller must supply it.
+    """
+    if partition_key is not None:
+        return partition_key
+    if settings.COSMOS_DB['PARTITION_KEY'] == 'id':
+        return request_id
+    return None
+
+def _list_query(requester=None, status=None, fields=None):
+    projection = ', '.join(f'c.{field}' for field in fields) if fields else '*'
+    query = f"SELECT {projection} FROM c WHERE c.type = 'travel_request'"
+    parameters = []
+    if requester:
+        query += " AND c.requester = @requester"
+        parameters.append({'name': '@requester', 'value': requester})
+    if status:
+        query += " AND c.status = @status"
+        parameters.append({'name': '@status', 'value': status})
+    return query, parameters
+
+def _item_query(request_id):
+    return {
+        'query': "SELECT * FROM c WHERE c.id = @id AND c.type = 'travel_request'",
+        'parameters': [{'name': '@id', 'value': request_id}]
+    }
+
+def _read_result(item):
+    # A point read also finds other document types that share the id
+    return item if item.get('type') == 'travel_request' else None
+
+def _patch_kwargs(request_id, partition_key, operations, etag):
+    options = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+    return {'item': request_id, 'partition_key': partition_key, 'patch_operations': operations, **options}
+
+def _legacy_key(item, partition_key_path, tried):
+    """
+    Return the partition key value a document found by the fallback query is
+    stored under, or None when it is missing or the key already tried
+    """
+    value = _partition_key_value(item, partition_key_path)
+    return None if value is None or value == tried else value
+
+def _raise_for_continuation(error, continuation):
+    # The service answers a malformed or foreign continuation token with 400
+    if continuation and error.status_code == 400:
+        raise ValueError(f"Invalid continuation token: {error.message}")
+
+def _page_result(items, continuation, summary):
+    return _page_items(items, summary), continuation, _page_etag(items, continuation, summary)
+
+
 class CosmosDB:
+    # Path the container is partitioned on, read once for legacy documents
+    _partition_key_path = None
+
+    partition_key_for = staticmethod(partition_key_for)
+
     def __init__(self):
         
         endpoint = settings.COSMOS_DB['ENDPOINT']
@@ -20,10 +219,23 @@ class CosmosDB:
         logger.info(f"Container: {container}")
 
         try:
+            # Share one pooled HTTP session for every request made through this client
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=settings.COSMOS_DB['POOL_SIZE'],
+                pool_maxsize=settings.COSMOS_DB['POOL_SIZE']
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
             # Initialize with url and credential parameters explicitly
             self.client = CosmosClient(
                 url=settings.COSMOS_DB['ENDPOINT'],
-                credential=settings.COSMOS_DB['PRIMARY_KEY']
+                credential=settings.COSMOS_DB['PRIMARY_KEY'],
+                transport=RequestsTransport(session=session, session_owner=False),
+                connection_timeout=settings.COSMOS_DB['CONNECTION_TIMEOUT'],
+                retry_total=settings.COSMOS_DB['RETRY_TOTAL'],
+                raw_response_hook=_record_cosmos_response
             )
             
             # Get database reference
@@ -38,48 +250,332 @@ class CosmosDB:
 
     def create_travel_request(self, travel_request):
         try:
-            return self.container.create_item(body=travel_request.to_dict())
+            with span('cosmos_create'):
+                return self.container.create_item(body=travel_request.to_dict())
         except Exception as e:
             logger.error(f"Failed to create travel request: {str(e)}")
             raise
 
-    def get_travel_request(self, request_id):
+    def get_travel_request(self, request_id, partition_key=None):
+        item = self.get_travel_request_item(request_id, partition_key)
+        return TravelRequest.from_dict(item) if item else None
+
+    def get_travel_request_item(self, request_id, partition_key=None):
+        """
+        Fetch the raw travel request document, using a point read when the
+        partition key is known and a cross-partition query otherwise.
+        Documents are served from the request cache when present.
+        """
+        item = _cached_item(request_id)
+        if item is not None:
+            return item
+        generation = _cache_generation(request_id)
+        item = self._fetch_travel_request_item(request_id, partition_key)
+        if item is not None:
+            _cache_item(item, generation)
+        return item
+
+    def _fetch_travel_request_item(self, request_id, partition_key=None):
         try:
-            query = f"SELECT * FROM c WHERE c.id = '{request_id}' AND c.type = 'travel_request'"
-            items = list(self.container.query_items(
-                query=query, 
-                enable_cross_partition_query=True
-            ))
-            return TravelRequest.from_dict(items[0]) if items else None
+            partition_key = partition_key_for(request_id, partition_key)
+            if partition_key is not None:
+                try:
+                    with span('cosmos_read'):
+                        return _read_result(self.container.read_item(item=request_id, partition_key=partition_key))
+                except CosmosResourceNotFoundError:
+                    # Documents written before the partition key strategy may live
+                    # under a different key; fall back to a query for those.
+                    if not settings.COSMOS_DB['LEGACY_QUERY_FALLBACK']:
+                        return None
+            return self._query_travel_request_item(request_id)
         except Exception as e:
             logger.error(f"Failed to get travel request {request_id}: {str(e)}")
             return None
 
-    def update_travel_request(self, request_id, updates):
+    def _query_travel_request_item(self, request_id):
+        with span('cosmos_query', query='by_id'):
+            items = list(self.container.query_items(**_item_query(request_id), enable_cross_partition_query=True))
+        return items[0] if items else None
+
+    def _legacy_partition_key(self, request_id, tried):
+        """
+        Return the partition key a document is actually stored under when the
+        patch with the derived key found nothing, or None when there is no such
+        document or LEGACY_QUERY_FALLBACK is off
+        """
+        if not settings.COSMOS_DB['LEGACY_QUERY_FALLBACK']:
+            return None
+        item = self._query_travel_request_item(request_id)
+        if not item:
+            return None
+        if self._partition_key_path is None:
+            self._partition_key_path = self.container.read()['partitionKey']['paths'][0]
+        return _legacy_key(item, self._partition_key_path, tried)
+
+    def update_travel_request(self, request_id, updates=None, append=None, etag=None, partition_key=None):
+        """
+        Apply a partial update to a travel request in a single round-trip
+        using Cosmos DB patch operations.
+
+        Args:
+            request_id: Travel request id
+            updates: Fields to set, e.g. {'status': 'APPROVED'}
+            append: Items to append to array fields, e.g. {'history': [entry]}
+            etag: Optional ETag; the update only applies if the document is unchanged
+            partition_key: Partition key value if it cannot be derived from the id
+
+        Returns:
+            dict: Updated document, or None if the request does not exist
+
+        Raises:
+            CosmosAccessConditionFailedError: The document changed since `etag` was read
+        """
+        operations = _patch_operations(updates, append)
         try:
-            request = self.get_travel_request(request_id)
-            if request:
-                request_dict = request.to_dict()
-                request_dict.update(updates)
-                request_dict['updated_at'] = datetime.utcnow().isoformat()
-                return self.container.upsert_item(body=request_dict)
+            derived = partition_key is None
+            partition_key = partition_key_for(request_id, partition_key)
+            if partition_key is None:
+                item = self.get_travel_request_item(request_id)
+                if not item:
+                    return None
+                partition_key = item[settings.COSMOS_DB['PARTITION_KEY']]
+
+            try:
+                try:
+                    with span('cosmos_patch'):
+                        return self.container.patch_item(**_patch_kwargs(request_id, partition_key, operations, etag))
+                except CosmosResourceNotFoundError:
+                    # Documents written before the partition key strategy (served by
+                    # LEGACY_QUERY_FALLBACK) live under another key; retry under it
+                    legacy_key = self._legacy_partition_key(request_id, partition_key) if derived else None
+                    if legacy_key is None:
+                        raise
+                    with span('cosmos_patch'):
+                        return self.container.patch_item(**_patch_kwargs(request_id, legacy_key, operations, etag))
+            finally:
+                # Also on failure: a 412 means the cached copy is out of date
+                _invalidate_item(request_id)
+        except CosmosResourceNotFoundError:
             return None
+        except CosmosAccessConditionFailedError:
+            logger.warning(f"Travel request {request_id} was modified concurrently")
+            raise
         except Exception as e:
             logger.error(f"Failed to update travel request {request_id}: {str(e)}")
             raise
 
     def list_travel_requests(self, requester=None, status=None):
         try:
-            query = "SELECT * FROM c WHERE c.type = 'travel_request'"
-            if requester:
-                query += f" AND c.requester = '{requester}'"
-            if status:
-                query += f" AND c.status = '{status}'"
-            items = self.container.query_items(
-                query=query, 
-                enable_cross_partition_query=True
-            )
+            query, parameters = _list_query(requester, status)
+            with span('cosmos_query', query='list'):
+                items = list(self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    enable_cross_partition_query=True
+                ))
             return [TravelRequest.from_dict(item) for item in items]
         except Exception as e:
             logger.error(f"Failed to list travel requests: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    def list_travel_requests_page(self, requester=None, status=None, page_size=None, continuation=None,
+                                  summary=False):
+        """
+        Fetch one page of travel requests using a Cosmos continuation token
+
+        Args:
+            requester: Optional requester filter
+            status: Optional status filter
+            page_size: Maximum number of items in the page
+            continuation: Token returned by the previous page, or None for the first page
+            summary: Project only SUMMARY_FIELDS and return raw dicts without
+                hydrating the nested documents, expenses and history
+
+        Returns:
+            tuple: (list of TravelRequest or dict, continuation token or None on the last page,
+                weak ETag of the page)
+
+
+        Raises:
+            ValueError: Cosmos DB rejected the continuation token
+        """
+        try:
+            query, parameters = _list_query(requester, status, _list_fields(summary))
+            with span('cosmos_query', query='page'):
+                pager = self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    enable_cross_partition_query=True,
+                    max_item_count=page_size or settings.COSMOS_DB['PAGE_SIZE']
+                ).by_page(continuation)
+                items = list(next(pager, []))
+            return _page_result(items, pager.continuation_token, summary)
+        except CosmosHttpResponseError as e:
+            _raise_for_continuation(e, continuation)
+            logger.error(f"Failed to list travel requests page: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Failed to list travel requests page: {str(e)}")
+            raise
+
+
+class AsyncCosmosDB:
+    """
+    azure.cosmos.aio counterpart of CosmosDB for the async views.
+    Methods take the same arguments and return the same values; the queries,
+    patch operations and result handling are the module helpers CosmosDB uses.
+    """
+
+    _partition_key_path = None
+
+    partition_key_for = staticmethod(partition_key_for)
+
+    def __init__(self):
+        try:
+            self.client = AsyncCosmosClient(
+                url=settings.COSMOS_DB['ENDPOINT'],
+                credential=settings.COSMOS_DB['PRIMARY_KEY'],
+                connection_timeout=settings.COSMOS_DB['CONNECTION_TIMEOUT'],
+                retry_total=settings.COSMOS_DB['RETRY_TOTAL'],
+                raw_response_hook=_record_cosmos_response
+            )
+            self.database = self.client.get_database_client(settings.COSMOS_DB['DATABASE'])
+            self.container = self.database.get_container_client(settings.COSMOS_DB['CONTAINER'])
+        except Exception as e:
+            logger.error(f"Failed to initialize async Cosmos DB: {str(e)}")
+            raise
+
+    async def create_travel_request(self, travel_request):
+        try:
+            with span('cosmos_create'):
+                return await self.container.create_item(body=travel_request.to_dict())
+        except Exception as e:
+            logger.error(f"Failed to create travel request: {str(e)}")
+            raise
+
+    async def get_travel_request(self, request_id, partition_key=None):
+        item = await self.get_travel_request_item(request_id, partition_key)
+        return TravelRequest.from_dict(item) if item else None
+
+    async def get_travel_request_item(self, request_id, partition_key=None):
+        # SQLiteCache reads and writes block, so they run in a thread
+        item = await asyncio.to_thread(_cached_item, request_id)
+        if item is not None:
+            return item
+        generation = await asyncio.to_thread(_cache_generation, request_id)
+        item = await self._fetch_travel_request_item(request_id, partition_key)
+        if item is not None:
+            await asyncio.to_thread(_cache_item, item, generation)
+        return item
+
+    async def _fetch_travel_request_item(self, request_id, partition_key=None):
+        try:
+            partition_key = partition_key_for(request_id, partition_key)
+            if partition_key is not None:
+                try:
+                    with span('cosmos_read'):
+                        item = await self.container.read_item(item=request_id, partition_key=partition_key)
+                    return _read_result(item)
+                except CosmosResourceNotFoundError:
+                    if not settings.COSMOS_DB['LEGACY_QUERY_FALLBACK']:
+                        return None
+            return await self._query_travel_request_item(request_id)
+        except Exception as e:
+            logger.error(f"Failed to get travel request {request_id}: {str(e)}")
+            return None
+
+    async def _query_travel_request_item(self, request_id):
+        with span('cosmos_query', query='by_id'):
+            items = [item async for item in self.container.query_items(**_item_query(request_id))]
+        return items[0] if items else None
+
+    async def _legacy_partition_key(self, request_id, tried):
+        if not settings.COSMOS_DB['LEGACY_QUERY_FALLBACK']:
+            return None
+        item = await self._query_travel_request_item(request_id)
+        if not item:
+            return None
+        if self._partition_key_path is None:
+            self._partition_key_path = (await self.container.read())['partitionKey']['paths'][0]
+        return _legacy_key(item, self._partition_key_path, tried)
+
+    async def update_travel_request(self, request_id, updates=None, append=None, etag=None, partition_key=None):
+        operations = _patch_operations(updates, append)
+        try:
+            derived = partition_key is None
+            partition_key = partition_key_for(request_id, partition_key)
+            if partition_key is None:
+                item = await self.get_travel_request_item(request_id)
+                if not item:
+                    return None
+                partition_key = item[settings.COSMOS_DB['PARTITION_KEY']]
+
+            try:
+                try:
+                    with span('cosmos_patch'):
+                        return await self.container.patch_item(
+                            **_patch_kwargs(request_id, partition_key, operations, etag)
+                        )
+                except CosmosResourceNotFoundError:
+                    legacy_key = await self._legacy_partition_key(request_id, partition_key) if derived else None
+                    if legacy_key is None:
+                        raise
+                    with span('cosmos_patch'):
+                        return await self.container.patch_item(
+                            **_patch_kwargs(request_id, legacy_key, operations, etag)
+                        )
+            finally:
+                await asyncio.to_thread(_invalidate_item, request_id)
+        except CosmosResourceNotFoundError:
+            return None
+        except CosmosAccessConditionFailedError:
+            logger.warning(f"Travel request {request_id} was modified concurrently")
+            raise
+        except Exception as e:
+            logger.error(f"Failed to update travel request {request_id}: {str(e)}")
+            raise
+
+    async def list_travel_requests_page(self, requester=None, status=None, page_size=None, continuation=None,
+                                        summary=False):
+        try:
+            query, parameters = _list_query(requester, status, _list_fields(summary))
+            with span('cosmos_query', query='page'):
+                pager = self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    max_item_count=page_size or settings.COSMOS_DB['PAGE_SIZE']
+                ).by_page(continuation)
+                try:
+                    items = [item async for item in await pager.__anext__()]
+                except StopAsyncIteration:
+                    items = []
+            return _page_result(items, pager.continuation_token, summary)
+        except CosmosHttpResponseError as e:
+            _raise_for_continuation(e, continuation)
+            logger.error(f"Failed to list travel requests page: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Failed to list travel requests page: {str(e)}")
+            raise
+
+
+_cosmos_db = None
+_cosmos_db_lock = threading.Lock()
+
+def get_cosmos_db():
+    """
+    Return the process-wide CosmosDB instance, creating it on first use.
+    The client, database and container handles are reused by every request.
+    """
+    global _cosmos_db
+    if _cosmos_db is None:
+        with _cosmos_db_lock:
+            if _cosmos_db is None:
+                _cosmos_db = CosmosDB()
+    return _cosmos_db
+
+def get_async_cosmos_db():
+    """
+    Return the AsyncCosmosDB instance for the running event loop
+    """
+    return loop_client('cosmos', AsyncCosmosDB)
@@ -0,0 +1,278 @@
+# jobs.py
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from concurrent.futures import ThreadPoolExecutor
+from pdf2image import pdfinfo_from_path
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from .metrics import span
+from .utils import (
+    iter_pdf_pages_as_base64, call_openai_api, parse_expenses, build_report_data,
+    start_staging_files, PDFConversionError, EXPENSE_SCHEMA
+)
+
+logger = logging.getLogger(__name__)
+
+# Identifies the process running a job, so jobs of a process that died can be failed
+_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner):
+    """
+    Return whether the process that owns a job still runs, or None when it
+    cannot be checked (another host, a job from before owners were recorded,
+    or Windows, where signal 0 is CTRL_C_EVENT rather than a probe); those
+    jobs are failed once they exceed REPORT_JOBS['STALE_AFTER']
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if os.name == 'nt' or host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class ReportJobStore:
+    """
+    SQLite-backed store for generate-report jobs.
+    Every worker process on the host reads the same file, so status polls
+    can be answered by any worker, not only the one running the job.
+    Use journal_mode='DELETE' if path is on a network share: WAL needs
+    shared memory that such filesystems do not provide.
+    """
+
+    FIELDS = ['id', 'status', 'pages_total', 'pages_done', 'pages_failed',
+              'result', 'error', 'created_at', 'updated_at']
+
+    def __init__(self, path, journal_mode='WAL'):
+        self.path = path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS report_jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, pages_total INTEGER, "
+                "pages_done INTEGER NOT NULL DEFAULT 0, pages_failed INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(report_jobs)")]
+            if 'owner' not in columns:
+                conn.execute("ALTER TABLE report_jobs ADD COLUMN owner TEXT")
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self._local.conn = conn
+        return conn
+
+    def create(self):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO report_jobs (id, status, created_at, updated_at, owner) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, now, now, _OWNER)
+            )
+            # Drop finished jobs past their retention period
+            conn.execute(
+                "DELETE FROM report_jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?",
+                (now - settings.REPORT_JOBS['TTL'],)
+            )
+        return job_id
+
+    def update(self, job_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{field} = ?" for field in fields)
+        with self._connection() as conn:
+            conn.execute(
+                f"UPDATE report_jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id)
+            )
+
+    def page_finished(self, job_id, failed=False):
+        column = 'pages_failed' if failed else 'pages_done'
+        with self._connection() as conn:
+            conn.execute(
+                f"UPDATE report_jobs SET {column} = {column} + 1, updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def fail_stale(self):
+        """
+        Fail queued or running jobs whose process is gone (a worker that died or
+        was recycled). Running jobs, and jobs owned by a process that cannot be
+        checked, are also failed after REPORT_JOBS['STALE_AFTER'] seconds without
+        progress; pages bump updated_at as they finish, while a queued job may
+        legitimately wait for a free worker.
+
+        Returns:
+            int: Number of jobs failed
+        """
+        cutoff = time.time() - settings.REPORT_JOBS['STALE_AFTER']
+        rows = self._connection().execute(
+            "SELECT id, status, owner, updated_at FROM report_jobs WHERE status IN ('queued', 'running')"
+        ).fetchall()
+        stale = []
+        for job_id, status, owner, updated_at in rows:
+            alive = _owner_alive(owner)
+            if alive is False or (updated_at < cutoff and (status == 'running' or alive is None)):
+                stale.append(job_id)
+        if stale:
+            with self._connection() as conn:
+                conn.executemany(
+                    "UPDATE report_jobs SET status = 'failed', error = 'Report job was interrupted', "
+                    "updated_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                    [(time.time(), job_id) for job_id in stale]
+                )
+            logger.warning(f"Failed {len(stale)} interrupted report jobs")
+        return len(stale)
+
+    def active_ids(self):
+        return {row[0] for row in self._connection().execute(
+            "SELECT id FROM report_jobs WHERE status IN ('queued', 'running')"
+        )}
+
+    def get(self, job_id):
+        row = self._connection().execute(
+            f"SELECT {', '.join(self.FIELDS)} FROM report_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.FIELDS, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+_job_store = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_job_store():
+    """
+    Return the process-wide report job store
+    """
+    global _job_store
+    if _job_store is None:
+        with _lock:
+            if _job_store is None:
+                os.makedirs(settings.REPORT_JOBS['DIR'], exist_ok=True)
+                _job_store = ReportJobStore(
+                    os.path.join(settings.REPORT_JOBS['DIR'], 'jobs.sqlite3'), settings.REPORT_JOBS['JOURNAL_MODE']
+                )
+                prune_report_jobs(_job_store)
+    return _job_store
+
+
+def prune_report_jobs(store):
+    """
+    Fail interrupted jobs and remove spooled inputs no queued or running job
+    owns (left behind by a process that died before its job finished)
+    """
+    store.fail_stale()
+    active = store.active_ids()
+    for name in os.listdir(settings.REPORT_JOBS['DIR']):
+        path = os.path.join(settings.REPORT_JOBS['DIR'], name)
+        if os.path.isdir(path) and name not in active:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.REPORT_JOBS['WORKERS'],
+                    thread_name_prefix='report-job'
+                )
+    return _executor
+
+
+def submit_report_job(files):
+    """
+    Store the uploaded PDFs and queue them for background processing
+
+    Args:
+        files: List of uploaded PDF files
+
+    Returns:
+        str: Job id to poll through the report-jobs endpoint
+    """
+    store = get_job_store()
+    prune_report_jobs(store)
+    job_id = store.create()
+
+    # Spool inputs to disk so the request can release its buffers
+    job_dir = os.path.join(settings.REPORT_JOBS['DIR'], job_id)
+    os.makedirs(job_dir)
+    inputs = []
+    for index, file in enumerate(files):
+        path = os.path.join(job_dir, str(index))
+        file.seek(0)
+        with open(path, 'wb') as destination:
+            for chunk in file.chunks():
+                destination.write(chunk)
+        inputs.append({'path': path, 'name': file.name, 'content_type': file.content_type})
+
+    _get_executor().submit(_run_report_job, job_id, job_dir, inputs)
+    return job_id
+
+
+@span('report_job')
+def _run_report_job(job_id, job_dir, inputs):
+    store = get_job_store()
+    try:
+        files = []
+        for item in inputs:
+            with open(item['path'], 'rb') as source:
+                files.append(SimpleUploadedFile(item['name'], source.read(), item['content_type']))
+
+        try:
+            # Count pages from the spooled inputs rather than another temp copy
+            pages_total = sum(pdfinfo_from_path(item['path'])['Pages'] for item in inputs)
+        except Exception as e:
+            raise PDFConversionError(f"Failed to read PDF page count: {str(e)}")
+        store.update(job_id, status='running', pages_total=pages_total)
+
+        def on_page(index, response):
+            store.page_finished(job_id, failed=response is None)
+
+        # Staging uploads while the pages are extracted
+        staging = start_staging_files(files)
+        responses = call_openai_api(
+            iter_pdf_pages_as_base64(files), json.dumps(EXPENSE_SCHEMA), on_page=on_page
+        )
+
+        all_expenses = []
+        for response in responses:
+            all_expenses.extend(parse_expenses(response))
+
+        store.update(job_id, status='succeeded', result=build_report_data(files, all_expenses, staging.result()))
+        logger.info(f"Report job {job_id} finished: {len(responses)} pages")
+
+    except PDFConversionError as e:
+        logger.error(f"Report job {job_id} failed converting PDFs: {str(e)}")
+        store.update(job_id, status='failed', error=f'Error processing PDF files: {str(e)}')
+    except Exception as e:
+        logger.error(f"Report job {job_id} failed: {str(e)}")
+        store.update(job_id, status='failed', error=f'Error extracting information: {str(e)}')
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
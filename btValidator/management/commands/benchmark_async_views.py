@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+import asyncio
+import httpx
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the API as deployed: send --requests GETs of --path to each target with "
+        "--concurrency of them in flight, and report throughput and latency percentiles. "
+        "Start the deployments to compare against the same Cosmos DB first, e.g. WSGI with "
+        "`gunicorn backend.wsgi -w 1 --threads 8 -b 127.0.0.1:8001` and ASGI with "
+        "`ASYNC_VIEWS=True uvicorn backend.asgi:application --workers 1 --port 8002`, then run "
+        "`benchmark_async_views wsgi=http://127.0.0.1:8001 asgi=http://127.0.0.1:8002`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='+', help='label=base URL of each deployment')
+        parser.add_argument('--path', default='/api/travel-requests/?page_size=20',
+                            help='Request path; use a retrieve or list path that waits on Cosmos DB')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per target')
+        parser.add_argument('--concurrency', type=int, default=200, help='Requests in flight per target')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds before a request counts as failed')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['targets']:
+            label, _, url = target.rpartition('=')
+            if not url.startswith(('http://', 'https://')):
+                raise CommandError(f"Expected label=URL, got {target}")
+            targets.append((label or url, url.rstrip('/')))
+
+        for label, url in targets:
+            elapsed, latencies, errors = asyncio.run(self.load(url + options['path'], options))
+            latencies.sort()
+            completed = len(latencies)
+
+            def percentile(fraction):
+                return latencies[min(completed - 1, int(completed * fraction))] * 1000 if completed else 0.0
+
+            self.stdout.write(
+                f"{label}: requests={options['requests']} concurrency={options['concurrency']} "
+                f"errors={errors} seconds={elapsed:.2f} requests_per_second={completed / elapsed:.1f} "
+                f"p50_ms={percentile(0.5):.0f} p95_ms={percentile(0.95):.0f} p99_ms={percentile(0.99):.0f}"
+            )
+
+    async def load(self, url, options):
+        """
+        Returns:
+            tuple: (seconds, latencies of the successful requests, number of failed requests)
+        """
+        concurrency = max(1, options['concurrency'])
+        remaining = iter(range(options['requests']))
+        latencies = []
+        errors = 0
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async with httpx.AsyncClient(limits=limits, timeout=options['timeout']) as client:
+            # Warm up the connections and the server's clients outside the timing
+            await asyncio.gather(*(client.get(url) for _ in range(min(concurrency, 10))), return_exceptions=True)
+
+            async def worker():
+                nonlocal errors
+                for _ in remaining:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.get(url)
+                        failed = response.status_code >= 400
+                    except httpx.HTTPError:
+                        failed = True
+                    if failed:
+                        errors += 1
+                    else:
+                        latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return time.perf_counter() - start, latencies, errors
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from btValidator import data
+import logging
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the Cosmos DB overhead a request pays before it can read: building a "
+        "CosmosDB per request, as the viewset did before the shared client, against "
+        "reusing get_cosmos_db(). Each request reads the container properties."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Requests per mode')
+
+    def handle(self, *args, **options):
+        # CosmosDB logs its settings every time it is built
+        logging.disable(logging.INFO)
+        requests = max(1, options['requests'])
+
+        try:
+            construct = read = 0.0
+            for _ in range(requests):
+                start = time.perf_counter()
+                cosmos_db = data.CosmosDB()
+                built = time.perf_counter()
+                cosmos_db.container.read()
+                construct += built - start
+                read += time.perf_counter() - built
+            self.report('per_request', requests, construct, read)
+
+            data._cosmos_db = None
+            start = time.perf_counter()
+            data.get_cosmos_db()
+            startup = time.perf_counter() - start
+            construct = read = 0.0
+            for _ in range(requests):
+                start = time.perf_counter()
+                cosmos_db = data.get_cosmos_db()
+                built = time.perf_counter()
+                cosmos_db.container.read()
+                construct += built - start
+                read += time.perf_counter() - built
+            self.report('singleton', requests, construct, read, f" startup_ms={startup * 1000:.1f}")
+        except Exception as e:
+            raise CommandError(f"Cosmos DB request failed: {str(e)}")
+
+    def report(self, mode, requests, construct, read, extra=''):
+        self.stdout.write(
+            f"{mode}: requests={requests} construct_ms={construct * 1000 / requests:.2f} "
+            f"read_ms={read * 1000 / requests:.2f} "
+            f"ms_per_request={(construct + read) * 1000 / requests:.2f}{extra}"
+        )
@@ -0,0 +1,117 @@
+from django.core.management.base import BaseCommand
+from btValidator.utils import extract_json_from_text
+import json
+import logging
+import re
+import time
+
+# Model outputs in the shapes seen from the extraction prompt, with the value
+# extract_json_from_text must return for each
+EXPENSES = [
+    {"date": "2024-03-04", "category": "Transportation", "description": "Taxi to airport", "amount": 42.5},
+    {"date": "2024-03-05", "category": "Meals", "description": "Dinner [client meeting]", "amount": 87.0},
+]
+CORPUS = [
+    ('plain array', json.dumps(EXPENSES), EXPENSES),
+    ('markdown fence', f"```json\n{json.dumps(EXPENSES, indent=2)}\n```", EXPENSES),
+    ('prose around', f"Here are the expenses I found:\n{json.dumps(EXPENSES)}\nLet me know if you need more.", EXPENSES),
+    ('brackets in strings', '[{"date": "2024-03-04", "category": "Meals", "description": "Lunch {team} ]", "amount": 12}]',
+     [{"date": "2024-03-04", "category": "Meals", "description": "Lunch {team} ]", "amount": 12}]),
+    ('nested object', '{"result": [{"page": 1, "result": [{"amount": 1}]}]}',
+     {"result": [{"page": 1, "result": [{"amount": 1}]}]}),
+    ('batched pages', 'Results:\n{"1": [{"amount": 3}], "2": []}', {"1": [{"amount": 3}], "2": []}),
+    ('bracketed note first', f"[Note: totals in EUR]\n{json.dumps(EXPENSES)}", EXPENSES),
+    ('stray quote and bracket', 'The receipt says "total [EUR" only: {"amount": 5}', {"amount": 5}),
+    ('empty array', 'No expenses on this page: []', []),
+    ('no JSON', 'I could not read this receipt.', None),
+    ('truncated', '[{"date": "2024-03-04", "category": "Meals", "amount": 1', None),
+    ('deeply nested', '[' * 5000 + ']' * 5000, None),
+    ('unclosed brackets', 'x ' + '[' * 5000, None),
+]
+
+
+def legacy_extract_json_from_text(text):
+    """
+    extract_json_from_text before the single-pass scanner, for comparison
+    """
+    if not text or not isinstance(text, str):
+        return None
+    try:
+        try:
+            return json.loads(text.strip())
+        except json.JSONDecodeError:
+            pass
+        cleaned = re.sub(r'```(?:json)?\n?(.*?)\n?```', r'\1', text, flags=re.DOTALL).strip()
+        try:
+            return json.loads(cleaned)
+        except json.JSONDecodeError:
+            pass
+        for pattern in (r'\[.*?\]', r'\{.*?\}'):
+            match = re.search(pattern, text, re.DOTALL)
+            if match:
+                try:
+                    return json.loads(match.group())
+                except json.JSONDecodeError:
+                    pass
+        stack = []
+        start = -1
+        potential_jsons = []
+        for i, char in enumerate(text):
+            if char in '{[':
+                if not stack:
+                    start = i
+                stack.append(char)
+            elif char in '}]':
+                if not stack:
+                    continue
+                if (char == '}' and stack[-1] == '{') or (char == ']' and stack[-1] == '['):
+                    stack.pop()
+                    if not stack:
+                        potential_jsons.append(text[start:i+1])
+        for json_str in potential_jsons:
+            try:
+                return json.loads(json_str)
+            except json.JSONDecodeError:
+                continue
+        return None
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare extract_json_from_text with the previous multi-strategy extractor: "
+        "correctness on a corpus of model outputs, then throughput on large outputs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200, help='Passes over the corpus for the timing')
+        parser.add_argument('--size', type=int, default=20000, help='Expenses in the large-output cases')
+
+    def handle(self, *args, **options):
+        # Both extractors log every miss
+        logging.disable(logging.WARNING)
+        extractors = [('current', extract_json_from_text), ('legacy', legacy_extract_json_from_text)]
+
+        for name, extract in extractors:
+            failures = [case for case, text, expected in CORPUS if extract(text) != expected]
+            self.stdout.write(
+                f"{name}: {len(CORPUS) - len(failures)}/{len(CORPUS)} correct"
+                + (f" (wrong: {', '.join(failures)})" if failures else '')
+            )
+
+        large = json.dumps(EXPENSES * (options['size'] // len(EXPENSES)))
+        timings = [
+            ('corpus', [text for _, text, _ in CORPUS], options['repeat']),
+            ('large prose-wrapped', [f"Expenses:\n{large}\nDone."], 5),
+            ('large truncated', [large[:-2]], 5),
+        ]
+        for label, texts, repeat in timings:
+            for name, extract in extractors:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    for text in texts:
+                        extract(text)
+                elapsed = time.perf_counter() - start
+                mb = sum(len(text) for text in texts) * repeat / 1e6
+                self.stdout.write(f"{label} {name}: seconds={elapsed:.3f} mb_per_second={mb / elapsed:.1f}")
@@ -0,0 +1,179 @@
+from django.core.management.base import BaseCommand
+from btValidator.models import TravelRequest
+from datetime import datetime, timedelta
+import time
+import tracemalloc
+import uuid
+
+
+def travel_request_payload(count, documents=3, expenses=8, history=4):
+    """
+    Build travel requests shaped like the documents Cosmos DB returns for a list page
+
+    Returns:
+        list: count travel request dicts with their nested lists filled in
+    """
+    start = datetime(2024, 3, 4)
+    payload = []
+    for index in range(count):
+        day = (start + timedelta(days=index % 365)).isoformat()
+        payload.append({
+            'id': str(uuid.UUID(int=index)),
+            'type': 'travel_request',
+            'requester': f'user{index % 50}@example.com',
+            'status': ('PENDING', 'APPROVED', 'REJECTED')[index % 3],
+            'created_at': day,
+            'updated_at': day,
+            'start_date': day[:10],
+            'end_date': day[:10],
+            'total_amount': 42.5 * expenses,
+            'department': ('Sales', 'Engineering', 'Finance')[index % 3],
+            'position': 'Manager',
+            'documents': [
+                {'id': f'{index}-d{n}', 'file_name': f'receipt{n}.pdf', 'file_size': 120000 + n,
+                 'file_url': f'https://example.blob.core.windows.net/reports/{index}_receipt{n}.pdf',
+                 'uploaded_at': day}
+                for n in range(documents)
+            ],
+            'expenses': [
+                {'id': f'{index}-e{n}', 'category': 'Meals', 'description': f'Dinner {n}',
+                 'amount': 42.5, 'date': day}
+                for n in range(expenses)
+            ],
+            'history': [
+                {'id': f'{index}-h{n}', 'type': 'comment', 'title': 'Updated', 'user': 'approver@example.com',
+                 'comments': None, 'date': day}
+                for n in range(history)
+            ],
+            '_rid': 'abc', '_etag': '"0000"', '_ts': 1709510400,
+        })
+    return payload
+
+
+class LegacyExpense:
+    """
+    The models before __slots__ and lazy hydration, for comparison: every
+    nested item is built eagerly and defaults are computed even when supplied
+    """
+
+    def __init__(self, id=None, category=None, description=None, amount=0, date=None, **kwargs):
+        self.id = id or str(uuid.uuid4())
+        self.category = category
+        self.description = description
+        self.amount = amount
+        self.date = date or datetime.utcnow().isoformat()
+
+    def to_dict(self):
+        return {'id': self.id, 'category': self.category, 'description': self.description,
+                'amount': self.amount, 'date': self.date}
+
+
+class LegacyDocument:
+
+    def __init__(self, id=None, file_name=None, file_size=0, file_url=None, **kwargs):
+        self.id = id or str(uuid.uuid4())
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_url = file_url
+        self.uploaded_at = kwargs.get('uploaded_at', datetime.utcnow().isoformat())
+
+    def to_dict(self):
+        return {'id': self.id, 'file_name': self.file_name, 'file_size': self.file_size,
+                'file_url': self.file_url, 'uploaded_at': self.uploaded_at}
+
+
+class LegacyRequestHistory:
+
+    def __init__(self, id=None, type=None, title=None, user=None, comments=None, **kwargs):
+        self.id = id or str(uuid.uuid4())
+        self.type = type
+        self.title = title
+        self.user = user
+        self.comments = comments
+        self.date = kwargs.get('date', datetime.utcnow().isoformat())
+
+    def to_dict(self):
+        return {'id': self.id, 'type': self.type, 'title': self.title, 'user': self.user,
+                'comments': self.comments, 'date': self.date}
+
+
+class LegacyTravelRequest:
+
+    def __init__(self, id=None, requester=None, status="PENDING", **kwargs):
+        self.id = id or str(uuid.uuid4())
+        self.type = "travel_request"
+        self.requester = requester
+        self.status = status
+        self.created_at = kwargs.get('created_at', datetime.utcnow().isoformat())
+        self.updated_at = kwargs.get('updated_at', datetime.utcnow().isoformat())
+        self.start_date = kwargs.get('start_date')
+        self.end_date = kwargs.get('end_date')
+        self.total_amount = kwargs.get('total_amount', 0)
+        self.department = kwargs.get('department')
+        self.position = kwargs.get('position')
+        self.documents = [LegacyDocument(**doc) for doc in kwargs.get('documents', [])]
+        self.expenses = [LegacyExpense(**exp) for exp in kwargs.get('expenses', [])]
+        self.history = [LegacyRequestHistory(**hist) for hist in kwargs.get('history', [])]
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'type': self.type, 'requester': self.requester, 'status': self.status,
+            'created_at': self.created_at, 'updated_at': self.updated_at, 'start_date': self.start_date,
+            'end_date': self.end_date, 'total_amount': self.total_amount, 'department': self.department,
+            'position': self.position,
+            'documents': [doc.to_dict() for doc in self.documents],
+            'expenses': [exp.to_dict() for exp in self.expenses],
+            'history': [hist.to_dict() for hist in self.history]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the __slots__ models with lazy nested hydration against the previous eager "
+        "models on a list payload: time per pass, then memory retained by the hydrated "
+        "models and allocated blocks, measured with tracemalloc."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Travel requests in the payload')
+        parser.add_argument('--repeat', type=int, default=20, help='Passes over the payload for the timing')
+
+    def handle(self, *args, **options):
+        payload = travel_request_payload(options['requests'])
+        models = [('current', TravelRequest), ('legacy', LegacyTravelRequest)]
+        scenarios = [
+            # A list page that only reads top-level fields
+            ('from_dict', lambda model: [model.from_dict(item) for item in payload]),
+            # A write path that loads and stores documents back unchanged
+            ('round trip', lambda model: [model.from_dict(item).to_dict() for item in payload]),
+            # Code that reads every nested item
+            ('nested access', lambda model: [
+                (request, request.documents, request.expenses, request.history)
+                for request in (model.from_dict(item) for item in payload)
+            ]),
+        ]
+
+        for label, run in scenarios:
+            for name, model in models:
+                run(model)
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    run(model)
+                elapsed = (time.perf_counter() - start) / options['repeat']
+
+                tracemalloc.start()
+                before = tracemalloc.take_snapshot()
+                result = run(model)
+                retained, peak = tracemalloc.get_traced_memory()
+                blocks = sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+                tracemalloc.stop()
+                del result
+
+                self.stdout.write(
+                    f"{label} {name}: requests={len(payload)} ms_per_pass={elapsed * 1000:.1f} "
+                    f"retained_kb={retained / 1024:.0f} peak_kb={peak / 1024:.0f} blocks={blocks}"
+                )
@@ -0,0 +1,54 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pdf2image import pdfinfo_from_path
+from btValidator.rendering import render_pages
+import multiprocessing
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure page rendering and encoding throughput for the given PDFs with "
+        "process pools of different sizes (0 renders on the calling thread)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('pdf_paths', nargs='+', help='PDF files to render')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='Pool sizes to measure')
+        parser.add_argument('--repeat', type=int, default=3, help='Renders of the whole set per pool size')
+
+    def handle(self, *args, **options):
+        window = max(1, settings.PDF_PROCESSING['RENDER_WINDOW'])
+        thread_count = settings.PDF_PROCESSING['RENDER_THREADS']
+        jobs = []
+        try:
+            for path in options['pdf_paths']:
+                page_count = pdfinfo_from_path(path)['Pages']
+                jobs.extend(
+                    (path, first_page, min(first_page + window - 1, page_count))
+                    for first_page in range(1, page_count + 1, window)
+                )
+        except Exception as e:
+            raise CommandError(f"Could not read {path}: {str(e)}")
+        pages = sum(last_page - first_page + 1 for _, first_page, last_page in jobs) * options['repeat']
+
+        for workers in options['workers']:
+            if workers:
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                # Start every worker before timing
+                list(pool.map(time.sleep, [0] * workers))
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                if workers:
+                    futures = [pool.submit(render_pages, *job, thread_count) for job in jobs]
+                    for future in futures:
+                        future.result()
+                else:
+                    for job in jobs:
+                        render_pages(*job, thread_count)
+            elapsed = time.perf_counter() - start
+            if workers:
+                pool.shutdown()
+            self.stdout.write(f"workers={workers} pages={pages} seconds={elapsed:.2f} pages_per_second={pages / elapsed:.1f}")
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from btValidator.data import SUMMARY_FIELDS
+from btValidator.management.commands.benchmark_models import travel_request_payload
+from btValidator.models import TravelRequest
+from btValidator.renderers import ORJSONRenderer
+from btValidator.serializers import (
+    TravelRequestSerializer,
+    TravelRequestSummarySerializer,
+    represent_travel_request,
+    represent_travel_request_summary
+)
+from types import SimpleNamespace
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the list response path on a large page: DRF serializers rendered with "
+        "the stock JSONRenderer against the precompiled representers rendered with "
+        "ORJSONRenderer, for the full and the summary view. Checks the output is identical, "
+        "as parsed JSON and byte for byte."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000, help='Travel requests in the list')
+        parser.add_argument('--expenses', type=int, default=10, help='Expenses per travel request')
+        parser.add_argument('--repeat', type=int, default=5, help='Passes over the list for the timing')
+
+    def handle(self, *args, **options):
+        payload = travel_request_payload(options['requests'], expenses=options['expenses'])
+        summaries = [{field: item.get(field) for field in SUMMARY_FIELDS} for item in payload]
+        # ORJSONRenderer only takes over the list and retrieve actions
+        context = {'view': SimpleNamespace(action='list')}
+        views = [
+            # Items as list_travel_requests_page returns them for each view
+            ('full', lambda: [TravelRequest.from_dict(item) for item in payload],
+             lambda items: TravelRequestSerializer(items, many=True).data, represent_travel_request),
+            ('summary', lambda: summaries,
+             lambda items: TravelRequestSummarySerializer(items, many=True).data, represent_travel_request_summary),
+        ]
+
+        for label, load, serialize, represent in views:
+            paths = [
+                ('drf', serialize, JSONRenderer()),
+                ('compiled', lambda items: [represent(item) for item in items], ORJSONRenderer()),
+            ]
+            outputs = {}
+            for name, build, renderer in paths:
+                serialize_seconds = render_seconds = 0.0
+                for _ in range(options['repeat']):
+                    items = load()
+                    start = time.perf_counter()
+                    data = build(items)
+                    built = time.perf_counter()
+                    content = renderer.render({'results': data, 'next_cursor': None}, renderer_context=context)
+                    serialize_seconds += built - start
+                    render_seconds += time.perf_counter() - built
+                outputs[name] = content
+                serialize_seconds /= options['repeat']
+                render_seconds /= options['repeat']
+                self.stdout.write(
+                    f"{label} {name}: requests={len(payload)} serialize_seconds={serialize_seconds:.3f} "
+                    f"render_seconds={render_seconds:.3f} total_seconds={serialize_seconds + render_seconds:.3f} "
+                    f"mb={len(content) / 1e6:.1f}"
+                )
+            self.stdout.write(
+                f"{label}: identical={json.loads(outputs['drf']) == json.loads(outputs['compiled'])} "
+                f"same_bytes={outputs['drf'] == outputs['compiled']}"
+            )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from btValidator.aggregates import consume_change_feed, LeaseUnavailableError
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain the dashboard aggregates served by /api/travel-requests/stats/ from the "
+        "Cosmos DB change feed, resuming from the last checkpoint. Run one consumer per "
+        "DASHBOARD_STATS['PATH'] (e.g. as a WebJob); a second one exits while the lease is held. "
+        "The change feed does not report deletes: documents soft-deleted with \"deleted\": true "
+        "(and a ttl) are removed as they change, hard deletes only by the reconcile pass run every "
+        "DASHBOARD_STATS['RECONCILE_INTERVAL'] seconds while polling, or with --reconcile."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit after catching up instead of polling')
+        parser.add_argument('--reset', action='store_true',
+                            help='Drop the aggregates and checkpoint and rebuild from the beginning of the feed')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Remove hard-deleted documents from the aggregates once caught up')
+
+    def handle(self, *args, **options):
+        try:
+            applied = consume_change_feed(
+                once=options['once'], reset=options['reset'], reconcile=options['reconcile']
+            )
+        except LeaseUnavailableError as e:
+            raise CommandError(str(e))
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(f"Applied {applied} changed travel requests"))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from azure.cosmos import PartitionKey
+from btValidator.data import get_cosmos_db
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy travel requests from a legacy container into the configured container, "
+        "partitioned on COSMOS_DB['PARTITION_KEY'], so they can be fetched by point reads. "
+        "Partition key paths are immutable, so existing documents must be rewritten."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source_container', help='Name of the container holding the existing documents')
+        parser.add_argument('--dry-run', action='store_true', help='Count documents without writing them')
+
+    def handle(self, *args, **options):
+        cosmos_db = get_cosmos_db()
+        source_name = options['source_container']
+        if source_name == settings.COSMOS_DB['CONTAINER']:
+            raise CommandError('Source container must differ from COSMOS_DB["CONTAINER"]')
+
+        partition_key_path = f"/{settings.COSMOS_DB['PARTITION_KEY']}"
+        if not options['dry_run']:
+            # A dry run must not create the target container
+            target = cosmos_db.database.create_container_if_not_exists(
+                id=settings.COSMOS_DB['CONTAINER'],
+                partition_key=PartitionKey(path=partition_key_path)
+            )
+        source = cosmos_db.database.get_container_client(source_name)
+
+        copied = 0
+        for item in source.query_items(
+            query="SELECT * FROM c WHERE c.type = 'travel_request'",
+            enable_cross_partition_query=True
+        ):
+            if not options['dry_run']:
+                # Drop system properties; Cosmos assigns new ones on write
+                body = {key: value for key, value in item.items() if not key.startswith('_')}
+                target.upsert_item(body=body)
+            copied += 1
+
+        verb = 'Would copy' if options['dry_run'] else 'Copied'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {copied} travel requests from {source_name} to "
+            f"{settings.COSMOS_DB['CONTAINER']} (partition key {partition_key_path})"
+        ))
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from btValidator.utils import purge_staged_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete files staged by generate-report that were not submitted within "
+        "AZURE_STORAGE['STAGING_TTL'] seconds. Run it periodically (e.g. from cron or a WebJob)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.AZURE_STORAGE['STAGING_TTL'],
+            help='Age in seconds after which an unclaimed staged file is deleted'
+        )
+
+    def handle(self, *args, **options):
+        deleted = purge_staged_files(options['max_age'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} staged files"))
@@ -0,0 +1,157 @@
+# metrics.py
+
+from collections import defaultdict
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Prefix of every metric name in the Prometheus exposition
+PREFIX = 'btvalidator_'
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+# Open spans, innermost last; a context variable so threads and asyncio tasks each see their own
+_stages = contextvars.ContextVar('stages', default=())
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def increment(name, value=1, **labels):
+    """
+    Add value to the counter identified by name and labels
+    """
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration as <name>_seconds_sum and <name>_seconds_count
+    """
+    with _lock:
+        _counters[_key(f'{name}_seconds_sum', labels)] += seconds
+        _counters[_key(f'{name}_seconds_count', labels)] += 1
+
+
+def counter_value(name, **labels):
+    """
+    Return the current value of a counter (0 when never incremented)
+    """
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def average(name, **labels):
+    """
+    Return the mean of the durations recorded with observe(), or None
+    """
+    with _lock:
+        count = _counters.get(_key(f'{name}_seconds_count', labels))
+        return _counters[_key(f'{name}_seconds_sum', labels)] / count if count else None
+
+
+def current_stage():
+    """
+    Return the name of the innermost span open in this context, or None
+    """
+    stages = _stages.get()
+    return stages[-1] if stages else None
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time a pipeline stage: the duration is recorded with observe() under
+    <name>_seconds and written as a key=value log line (INFO for the
+    outermost span in the context, DEBUG for nested ones). Callbacks that run
+    inside the span, such as the Cosmos response hook, can label their
+    metrics with current_stage().
+    """
+    token = _stages.set(_stages.get() + (name,))
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _stages.reset(token)
+        observe(name, seconds, **labels)
+        level = logging.DEBUG if _stages.get() else logging.INFO
+        if logger.isEnabledFor(level):
+            fields = ' '.join(f'{key}={value}' for key, value in labels.items())
+            logger.log(level, f"stage={name} seconds={seconds:.4f} outcome={outcome} {fields}".rstrip())
+
+
+def timed(name, **labels):
+    """
+    Decorator form of span() that also times coroutine functions
+    (span() used as a decorator would stop at the first await)
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with span(name, **labels):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(name, **labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    Return a copy of all metrics as {(name, ((label, value), ...)): number}
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render_prometheus():
+    """
+    Render all metrics in the Prometheus text exposition format.
+    Durations are exposed as summaries (<name>_seconds_sum/_count) and
+    everything else as counters. Values are per process, so every sample
+    carries a pid label: scrapes answered by different workers are separate
+    series instead of looking like counter resets. Sum over pid to aggregate.
+    """
+    process = (('pid', os.getpid()),)
+    families = defaultdict(list)
+    for (name, labels), value in snapshot().items():
+        if name.endswith('_seconds_sum') or name.endswith('_seconds_count'):
+            family, kind = name.rsplit('_', 1)[0], 'summary'
+        else:
+            family, kind = name, 'counter'
+        families[(PREFIX + family, kind)].append((PREFIX + name, labels, value))
+
+    lines = []
+    for (family, kind), samples in sorted(families.items()):
+        lines.append(f'# TYPE {family} {kind}')
+        for name, labels, value in sorted(samples):
+            lines.append(f'{name}{_format_labels(labels + process)} {float(value)!r}')
+    return '\n'.join(lines) + '\n'
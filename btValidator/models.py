@@ -1,13 +1,20 @@
 from datetime import datetime
 import uuid
 
+def _now():
+    return datetime.utcnow().isoformat()
+
 class Expense:
+    __slots__ = ('id', 'category', 'description', 'amount', 'date')
+    # Fields __init__ replaces with a default when the stored value is falsy
+    FALSY_DEFAULTS = ('id', 'date')
+
     def __init__(self, id=None, category=None, description=None, amount=0, date=None, **kwargs):
         self.id = id or str(uuid.uuid4())
         self.category = category
         self.description = description
         self.amount = amount
-        self.date = date or datetime.utcnow().isoformat()
+        self.date = date or _now()
 
     def to_dict(self):
         return {
@@ -23,12 +30,16 @@ class Expense:
         return cls(**data)
 
 class Document:
+    __slots__ = ('id', 'file_name', 'file_size', 'file_url', 'uploaded_at')
+    FALSY_DEFAULTS = ('id',)
+
     def __init__(self, id=None, file_name=None, file_size=0, file_url=None, **kwargs):
         self.id = id or str(uuid.uuid4())
         self.file_name = file_name
         self.file_size = file_size
         self.file_url = file_url
-        self.uploaded_at = kwargs.get('uploaded_at', datetime.utcnow().isoformat())
+        # Only compute the default when the value was not supplied
+        self.uploaded_at = kwargs['uploaded_at'] if 'uploaded_at' in kwargs else _now()
 
     def to_dict(self):
         return {
@@ -44,13 +55,17 @@ class Document:
         return cls(**data)
 
 class RequestHistory:
+    __slots__ = ('id', 'type', 'title', 'user', 'comments', 'date')
+    FALSY_DEFAULTS = ('id',)
+
     def __init__(self, id=None, type=None, title=None, user=None, comments=None, **kwargs):
         self.id = id or str(uuid.uuid4())
         self.type = type
         self.title = title
         self.user = user
         self.comments = comments
-        self.date = kwargs.get('date', datetime.utcnow().isoformat())
+        # Only compute the default when the value was not supplied
+        self.date = kwargs['date'] if 'date' in kwargs else _now()
 
     def to_dict(self):
         return {
@@ -66,24 +81,71 @@ class RequestHistory:
     def from_dict(cls, data):
         return cls(**data)
 
+class _NestedList:
+    """
+    Descriptor for a nested list that stays as the raw Cosmos dicts until it
+    is first read, then is hydrated into model objects once
+    """
+
+    def __init__(self, model, slot):
+        self.model = model
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        items, hydrated = getattr(instance, self.slot)
+        if not hydrated:
+            if any(isinstance(item, dict) for item in items):
+                items = [self.model.from_dict(item) if isinstance(item, dict) else item for item in items]
+            setattr(instance, self.slot, (items, True))
+        return items
+
+    def __set__(self, instance, items):
+        setattr(instance, self.slot, (items, False))
+
+    def raw(self, instance):
+        """
+        Return the stored list without hydrating it (items may be dicts or models)
+        """
+        return getattr(instance, self.slot)[0]
+
+    def to_dicts(self, instance):
+        # Untouched raw dicts are passed through as stored
+        items, _ = getattr(instance, self.slot)
+        return [item.to_dict() if hasattr(item, 'to_dict') else item for item in items]
+
 class TravelRequest:
+    __slots__ = (
+        'id', 'type', 'requester', 'status', 'created_at', 'updated_at', 'start_date',
+        'end_date', 'total_amount', 'department', 'position',
+        '_documents', '_expenses', '_history'
+    )
+
+    documents = _NestedList(Document, '_documents')
+    expenses = _NestedList(Expense, '_expenses')
+    history = _NestedList(RequestHistory, '_history')
+
     def __init__(self, id=None, requester=None, status="PENDING", **kwargs):
         self.id = id or str(uuid.uuid4())
         self.type = "travel_request"
         self.requester = requester
         self.status = status
-        self.created_at = kwargs.get('created_at', datetime.utcnow().isoformat())
-        self.updated_at = kwargs.get('updated_at', datetime.utcnow().isoformat())
+        # Only compute the defaults when the values were not supplied
+        self.created_at = kwargs['created_at'] if 'created_at' in kwargs else _now()
+        self.updated_at = kwargs['updated_at'] if 'updated_at' in kwargs else _now()
         self.start_date = kwargs.get('start_date')
         self.end_date = kwargs.get('end_date')
         self.total_amount = kwargs.get('total_amount', 0)
         self.department = kwargs.get('department')
         self.position = kwargs.get('position')
-        self.documents = [Document.from_dict(doc) if isinstance(doc, dict) else doc for doc in kwargs.get('documents', [])]
-        self.expenses = [Expense.from_dict(exp) if isinstance(exp, dict) else exp for exp in kwargs.get('expenses', [])]
-        self.history = [RequestHistory.from_dict(hist) if isinstance(hist, dict) else hist for hist in kwargs.get('history', [])]
+        # Nested lists are hydrated lazily on first access
+        self.documents = kwargs.get('documents', [])
+        self.expenses = kwargs.get('expenses', [])
+        self.history = kwargs.get('history', [])
 
     def to_dict(self):
+        cls = type(self)
         return {
             'id': self.id,
             'type': self.type,
@@ -96,11 +158,11 @@ class TravelRequest:
             'total_amount': self.total_amount,
             'department': self.department,
             'position': self.position,
-            'documents': [doc.to_dict() for doc in self.documents],
-            'expenses': [exp.to_dict() for exp in self.expenses],
-            'history': [hist.to_dict() for hist in self.history]
+            'documents': cls.documents.to_dicts(self),
+            'expenses': cls.expenses.to_dicts(self),
+            'history': cls.history.to_dicts(self)
         }
 
     @classmethod
     def from_dict(cls, data):
-        return cls(**data)
\ No newline at end of file
+        return cls(**data)
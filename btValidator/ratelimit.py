@@ -0,0 +1,266 @@
+# ratelimit.py
+
+from django.conf import settings
+from email.utils import parsedate_to_datetime
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SharedQuota:
+    """
+    Token buckets for the deployment's requests-per-minute and tokens-per-minute
+    quotas, stored in SQLite so every worker process on the host draws from the
+    same budget. A retry-after received by any worker pauses all of them.
+    Use journal_mode='DELETE' if path is on a network share: WAL needs
+    shared memory that such filesystems do not provide.
+    """
+
+    def __init__(self, path, rpm_limit, tpm_limit, journal_mode='WAL'):
+        self.path = path
+        self.journal_mode = journal_mode
+        self.limits = {'requests': rpm_limit, 'tokens': tpm_limit}
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS quota ("
+                "name TEXT PRIMARY KEY, available REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS quota_block (id INTEGER PRIMARY KEY CHECK (id = 1), until REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            self._local.conn = conn
+        return conn
+
+    def _try_acquire(self, amounts):
+        """
+        Take the amounts from their buckets if all of them allow it.
+
+        Returns:
+            float: 0 on success, otherwise seconds to wait before trying again
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT until FROM quota_block WHERE id = 1").fetchone()
+            if row and row[0] > now:
+                return row[0] - now
+
+            levels = {}
+            wait = 0
+            for name, amount in amounts.items():
+                limit = self.limits[name]
+                if not limit:
+                    continue
+                # A single request larger than the whole bucket can never fit; cap it
+                amount = min(amount, limit)
+                row = conn.execute(
+                    "SELECT available, updated_at FROM quota WHERE name = ?", (name,)
+                ).fetchone()
+                available, updated_at = row if row else (limit, now)
+                available = min(limit, available + (now - updated_at) * limit / 60)
+                levels[name] = (available, amount)
+                if available < amount:
+                    wait = max(wait, (amount - available) * 60 / limit)
+
+            for name, (available, amount) in levels.items():
+                remaining = available if wait else available - amount
+                conn.execute(
+                    "INSERT OR REPLACE INTO quota (name, available, updated_at) VALUES (?, ?, ?)",
+                    (name, remaining, now)
+                )
+            return wait
+        finally:
+            conn.execute("COMMIT")
+
+    def acquire(self, requests=1, tokens=0):
+        """
+        Block until the request and token amounts are available
+        """
+        while True:
+            wait = self._try_acquire({'requests': requests, 'tokens': tokens})
+            if not wait:
+                return
+            time.sleep(min(wait, 5))
+
+    async def aacquire(self, requests=1, tokens=0):
+        """
+        Async variant of acquire that waits without blocking the event loop;
+        the SQLite transaction (BEGIN IMMEDIATE may wait on other workers)
+        runs in a thread
+        """
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, {'requests': requests, 'tokens': tokens})
+            if not wait:
+                return
+            await asyncio.sleep(min(wait, 5))
+
+    def adjust(self, tokens):
+        """
+        Correct the token bucket once the actual usage is known
+        (positive tokens charge more, negative refund)
+        """
+        if not self.limits['tokens'] or not tokens:
+            return
+        conn = self._connection()
+        conn.execute(
+            "UPDATE quota SET available = MIN(?, available - ?) WHERE name = 'tokens'",
+            (self.limits['tokens'], tokens)
+        )
+
+    def block(self, seconds):
+        """
+        Pause every worker for the given number of seconds
+        """
+        until = time.time() + seconds
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO quota_block (id, until) VALUES (1, ?) "
+            "ON CONFLICT(id) DO UPDATE SET until = MAX(until, excluded.until)",
+            (until,)
+        )
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: grows by one slot per limit's worth of successful
+    calls and halves whenever the service throttles
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        """
+        Async variant of acquire; polls instead of waiting on the condition
+        so the event loop is never blocked
+        """
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(0.05)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            self.limit = max(1.0, self.limit / 2)
+        logger.warning(f"Azure OpenAI throttled; concurrency limit reduced to {int(self.limit)}")
+
+
+def parse_retry_after(headers):
+    """
+    Return the retry delay in seconds from retry-after-ms / retry-after headers, or None
+    """
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+_quota = None
+_concurrency = None
+_lock = threading.Lock()
+
+
+def get_quota():
+    """
+    Return the process handle on the shared quota store, or None when
+    neither RPM_LIMIT nor TPM_LIMIT is configured
+    """
+    global _quota
+    config = settings.AZURE_OPENAI
+    if not config['RPM_LIMIT'] and not config['TPM_LIMIT']:
+        return None
+    if _quota is None:
+        with _lock:
+            if _quota is None:
+                path = config['RATE_LIMIT_PATH'] or os.path.join(
+                    tempfile.gettempdir(), 'btvalidator_openai_quota.sqlite3'
+                )
+                _quota = SharedQuota(path, config['RPM_LIMIT'], config['TPM_LIMIT'], config['RATE_LIMIT_JOURNAL_MODE'])
+    return _quota
+
+
+def get_concurrency():
+    """
+    Return the process-wide adaptive concurrency limiter, capped by
+    AZURE_OPENAI['PROCESS_MAX_CONCURRENCY'] (MAX_CONCURRENCY bounds each upload)
+    """
+    global _concurrency
+    if _concurrency is None:
+        with _lock:
+            if _concurrency is None:
+                _concurrency = AdaptiveConcurrency(max(1, settings.AZURE_OPENAI['PROCESS_MAX_CONCURRENCY']))
+    return _concurrency
+
+
+def on_openai_response(response):
+    """
+    httpx response hook: feeds throttling signals from every attempt, including
+    the SDK's own retries, into the shared quota and the concurrency limiter
+    """
+    if response.status_code == 429:
+        get_concurrency().on_throttle()
+        retry_after = parse_retry_after(response.headers)
+        quota = get_quota()
+        if quota and retry_after:
+            quota.block(retry_after)
+    elif response.status_code < 400:
+        get_concurrency().on_success()
+
+
+async def aon_openai_response(response):
+    """
+    Async httpx response hook for the AsyncAzureOpenAI client; a 429 writes
+    the block to the SQLite quota store, so it is handled in a thread
+    """
+    if response.status_code == 429:
+        await asyncio.to_thread(on_openai_response, response)
+    else:
+        on_openai_response(response)
@@ -0,0 +1,75 @@
+# renderers.py
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+import json
+import orjson
+
+
+def format_sse(event, data):
+    """
+    Format a single server-sent event with a JSON payload
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF negotiate text/event-stream. Streaming views write events
+    themselves; this only renders regular responses (e.g. validation
+    errors) as a single 'error' event.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return format_sse('error', data)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer using orjson for the read actions, whose data comes from
+    stored JSON documents. Types orjson does not handle natively (Decimal,
+    UUID, lazy strings, ...) go through DRF's JSONEncoder, so the output
+    matches the stock renderer in compact mode, except that floats use the
+    shortest exponent form (1e16 rather than 1e+16) and NaN/Infinity render
+    as null where STRICT_JSON raises; stored documents cannot hold either.
+    Other actions, and data orjson rejects (integers beyond 64 bits), are
+    rendered by the stock renderer.
+    """
+    actions = ('list', 'retrieve')
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        view = renderer_context.get('view')
+        # Indented output (browsable API, ?indent=) is rare; keep the stock renderer
+        if getattr(view, 'action', None) not in self.actions or self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same as JSONRenderer: these are valid JSON but not valid JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class ORJSONParser(JSONParser):
+    """
+    JSONParser using orjson
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {str(exc)}')
@@ -0,0 +1,74 @@
+# rendering.py
+
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from pdf2image import convert_from_path
+import base64
+import multiprocessing
+import tempfile
+import threading
+import time
+
+# render_pages does not read Django settings, so spawned pool workers can
+# import this module without configuring Django.
+
+
+def render_pages(pdf_path, first_page, last_page, thread_count=1, quality=85):
+    """
+    Render a page range to base64 encoded JPEGs.
+
+    pdftoppm writes the JPEGs into a temporary folder and the files are
+    encoded as they are, so pages never go through PIL and only bytes are
+    returned to the caller (or pickled back from a pool worker).
+
+    Args:
+        pdf_path: Path of the PDF on local disk
+        first_page: First page to render (1-based)
+        last_page: Last page to render, inclusive
+        thread_count: pdftoppm processes pdf2image runs for the range
+        quality: JPEG quality
+
+    Returns:
+        tuple: (list of base64 bytes per page in order, seconds spent rendering)
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_folder:
+        paths = convert_from_path(
+            pdf_path,
+            first_page=first_page,
+            last_page=last_page,
+            output_folder=output_folder,
+            fmt='jpeg',
+            jpegopt={'quality': quality, 'optimize': 'n', 'progressive': 'n'},
+            thread_count=thread_count,
+            paths_only=True
+        )
+        pages = []
+        for path in paths:
+            with open(path, 'rb') as image:
+                pages.append(base64.b64encode(image.read()))
+    return pages, time.perf_counter() - start
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """
+    Return the process-wide rendering pool, or None when
+    PDF_PROCESSING['WORKERS'] is 0 and pages are rendered on the calling thread
+    """
+    global _render_pool
+    workers = settings.PDF_PROCESSING['WORKERS']
+    if not workers:
+        return None
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                # spawn: forking a process that already runs request threads is unsafe
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _render_pool
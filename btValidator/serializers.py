@@ -1,4 +1,7 @@
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+import decimal
+from .models import TravelRequest, Document, Expense, RequestHistory
 
 class ExpenseSerializer(serializers.Serializer):
     id = serializers.CharField(read_only=True)
@@ -22,6 +25,17 @@ class RequestHistorySerializer(serializers.Serializer):
     comments = serializers.CharField(allow_null=True)
     date = serializers.DateTimeField(read_only=True)
 
+class TravelRequestSummarySerializer(serializers.Serializer):
+    id = serializers.CharField(read_only=True)
+    requester = serializers.CharField()
+    status = serializers.CharField()
+    department = serializers.CharField()
+    created_at = serializers.DateTimeField(read_only=True)
+    updated_at = serializers.DateTimeField(read_only=True)
+    start_date = serializers.DateField()
+    end_date = serializers.DateField()
+    total_amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+
 class TravelRequestSerializer(serializers.Serializer):
     id = serializers.CharField(read_only=True)
     requester = serializers.CharField()
@@ -48,4 +62,91 @@ class TravelRequestSerializer(serializers.Serializer):
         for key, value in validated_data.items():
             setattr(instance, key, value)
         instance.expenses = [Expense(**expense) for expense in expenses_data]
-        return instance
\ No newline at end of file
+        return instance
+
+
+def _compile_field(field):
+    """
+    Return a converter equivalent to field.to_representation, with fast paths
+    for the JSON-native values Cosmos stores
+    """
+    if isinstance(field, (serializers.DateTimeField, serializers.DateField)):
+        def convert(value):
+            if not value:
+                return None
+            return value if type(value) is str else field.to_representation(value)
+        return convert
+    if isinstance(field, serializers.CharField):
+        return lambda value: value if type(value) is str else str(value)
+    if isinstance(field, serializers.IntegerField):
+        return lambda value: value if type(value) is int else field.to_representation(value)
+    if (isinstance(field, serializers.DecimalField) and field.decimal_places is not None
+            and getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+            and not field.localize and not field.normalize_output):
+        # Same quantization as DecimalField.quantize, with the context built once
+        exponent = decimal.Decimal('.1') ** field.decimal_places
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+        def convert(value):
+            if not isinstance(value, decimal.Decimal):
+                value = decimal.Decimal(str(value).strip())
+            return '{:f}'.format(value.quantize(exponent, rounding=field.rounding, context=context))
+        return convert
+    return field.to_representation
+
+def _compile_serializer(serializer, models):
+    """
+    Build a function producing serializer.to_representation(instance) for a
+    read-only Serializer instance. Nested `many=True` serializers read the
+    raw stored lists and only hydrate items that lack a field or hold a falsy
+    value in one the model defaults (e.g. "date": null on an expense), so the
+    output matches serializing the hydrated models.
+    """
+    scalars = []
+    nested = []
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            nested.append((name, field.source, _compile_serializer(field.child, models), models.get(name)))
+        else:
+            scalars.append((name, field.source, _compile_field(field)))
+    field_names = frozenset(source for _, source, _ in scalars) | frozenset(source for _, source, _, _ in nested)
+
+    def represent(instance):
+        if type(instance) is dict:
+            values = instance
+        else:
+            values = {source: getattr(instance, source) for _, source, _ in scalars}
+        result = {}
+        for name, source, convert in scalars:
+            value = values[source]
+            result[name] = None if value is None else convert(value)
+        for name, source, convert, model in nested:
+            descriptor = getattr(type(instance), source, None)
+            if hasattr(descriptor, 'raw'):
+                items = descriptor.raw(instance)
+            else:
+                items = values[source] if type(instance) is dict else getattr(instance, source)
+            if items is None:
+                result[name] = None
+                continue
+            result[name] = [
+                convert(model.from_dict(item) if model and type(item) is dict and (
+                    not item.keys() >= convert.field_names
+                    or not all(item[field] for field in model.FALSY_DEFAULTS)
+                ) else item)
+                for item in items
+            ]
+        return result
+
+    represent.field_names = field_names
+    return represent
+
+_nested_models = {'documents': Document, 'expenses': Expense, 'history': RequestHistory}
+
+# Precompiled equivalents of TravelRequestSerializer(...).data and
+# TravelRequestSummarySerializer(...).data for the list/retrieve read path
+represent_travel_request = _compile_serializer(TravelRequestSerializer(), _nested_models)
+represent_travel_request_summary = _compile_serializer(TravelRequestSummarySerializer(), {})
@@ -1,3 +1,1169 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from unittest import mock
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError
+from . import aggregates, async_views, cache, data, jobs, models, ratelimit, utils, views
+from .async_views import AsyncTravelRequestViewSet
+from .metrics import increment, render_prometheus
+from rest_framework.renderers import JSONRenderer
+from .renderers import ORJSONRenderer, format_sse
+from .serializers import TravelRequestSerializer, represent_travel_request
+from .utils import extract_json_from_text, parse_expenses, EXPENSE_SCHEMA
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+import asyncio
+import base64
+import datetime
+import decimal
+import hashlib
+import io
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+import uuid
 
-# Create your tests here.
+
+class ExtractJsonFromTextTests(SimpleTestCase):
+
+    def test_returns_outermost_value(self):
+        self.assertEqual(extract_json_from_text('```json\n{"a": [1, {"b": 2}]}\n```'), {'a': [1, {'b': 2}]})
+        self.assertEqual(extract_json_from_text('Found: [{"a": 1}] done'), [{'a': 1}])
+
+    def test_brackets_inside_strings(self):
+        text = 'Result: [{"description": "Lunch {team} ]", "amount": 1}]'
+        self.assertEqual(extract_json_from_text(text), [{'description': 'Lunch {team} ]', 'amount': 1}])
+
+    def test_skips_spans_that_do_not_parse(self):
+        self.assertEqual(extract_json_from_text('[Note: EUR] [{"a": 1}]'), [{'a': 1}])
+        self.assertEqual(extract_json_from_text('{"a": [1, 2}] then {"b": 1}'), {'b': 1})
+        self.assertEqual(extract_json_from_text('He wrote "total [EUR" only: {"a": 1}'), {'a': 1})
+
+    def test_no_json(self):
+        self.assertIsNone(extract_json_from_text('I could not read this receipt.'))
+        self.assertIsNone(extract_json_from_text('[{"a": 1'))
+        self.assertIsNone(extract_json_from_text(None))
+
+    def test_deep_nesting_does_not_raise(self):
+        self.assertIsNone(extract_json_from_text('[' * 100000))
+        self.assertIsNone(extract_json_from_text('x ' + '[' * 5000))
+        self.assertIsNone(extract_json_from_text('[' * 5000 + ']' * 5000))
+        self.assertEqual(parse_expenses('[' * 100000), [])
+
+
+@override_settings(EXTRACTION_CACHE={'BACKEND': 'btValidator.cache.MemoryCache', 'OPTIONS': {'ttl': 60}})
+class ExtractionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache._extraction_cache = None
+        self.addCleanup(setattr, cache, '_extraction_cache', None)
+        self.schema = json.dumps(EXPENSE_SCHEMA)
+
+    def extract(self, answers):
+        answers = list(answers)
+        calls = []
+
+        def extract_page(client, system_message, base64_image, schema):
+            calls.append(base64_image)
+            return answers.pop(0)
+
+        with mock.patch.object(utils, '_extract_page', extract_page):
+            results = [utils._extract_page_cached(None, None, 'cGFnZQ==', self.schema) for _ in range(len(answers))]
+        return results, len(calls)
+
+    def test_unparseable_answer_is_not_cached(self):
+        results, calls = self.extract(['Sorry, I cannot read this.', '[{"amount": 1}]'])
+        self.assertEqual(results, ['Sorry, I cannot read this.', '[{"amount": 1}]'])
+        self.assertEqual(calls, 2)
+
+    def test_parsed_answer_is_cached(self):
+        results, calls = self.extract(['[{"amount": 1}]'] * 3)
+        self.assertEqual(results, ['[{"amount": 1}]'] * 3)
+        self.assertEqual(calls, 1)
+        self.assertEqual(cache.get_extraction_cache().stats(), {'hits': 2, 'misses': 1})
+        self.assertIn(f'btvalidator_cache_requests_total{{cache="extraction",result="hit",pid="{os.getpid()}"}}',
+                      render_prometheus())
+
+
+class StrictSchemaTests(SimpleTestCase):
+
+    def test_expense_schema(self):
+        original = json.dumps(EXPENSE_SCHEMA)
+        strict = utils.to_strict_schema(EXPENSE_SCHEMA)
+        self.assertEqual(json.dumps(EXPENSE_SCHEMA), original)
+        item = strict['items']
+        self.assertEqual(item['required'], list(EXPENSE_SCHEMA['items']['properties']))
+        self.assertIs(item['additionalProperties'], False)
+        self.assertEqual(item['properties']['date'], {
+            'type': ['string', 'null'], 'description': 'Date of the expense (YYYY-MM-DD)'
+        })
+        self.assertEqual(item['properties']['amount']['type'], ['number', 'null'])
+
+    def test_nested_objects_and_type_lists(self):
+        strict = utils.to_strict_schema({'type': 'object', 'properties': {
+            'vendor': {'type': 'object', 'properties': {'name': {'type': 'string', 'format': 'hostname'}}},
+            'tags': {'type': ['array', 'null'], 'items': {'type': 'string'}},
+        }})
+        self.assertEqual(strict['required'], ['vendor', 'tags'])
+        self.assertEqual(strict['properties']['vendor'], {
+            'type': ['object', 'null'], 'properties': {'name': {'type': ['string', 'null']}},
+            'required': ['name'], 'additionalProperties': False
+        })
+        self.assertEqual(strict['properties']['tags'], {'type': ['array', 'null'], 'items': {'type': 'string'}})
+
+    @override_settings(AZURE_OPENAI={**settings.AZURE_OPENAI, 'STRUCTURED_OUTPUTS': True})
+    def test_refusal_is_an_error(self):
+        message = types.SimpleNamespace(content=None, refusal="I'm sorry, I can't help with that.")
+        with self.assertRaisesMessage(ValueError, 'Model refused to extract the page'):
+            utils._structured_result(message)
+        utils._structured_format.cache_clear()
+        self.addCleanup(utils._structured_format.cache_clear)
+        response = types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+        with self.assertLogs('btValidator.utils', 'WARNING'):
+            self.assertIsNone(utils._pages_result(response, 2, json.dumps(EXPENSE_SCHEMA)))
+
+
+def page_image(index):
+    """
+    A small JPEG whose width encodes the page index
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (10 + index, 10)).save(buffer, 'JPEG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    """
+    Speaks the chat completions API: answers each page with one expense whose
+    amount is the page index. Earlier pages answer later, so completions
+    arrive out of page order. A call including one of failing_pages is
+    rejected, and a call whose page indexes are in throttled_calls is
+    throttled with Retry-After: 7. A multi-page call is answered with an
+    object keyed by page number, or with prose when split_batches is off;
+    omitted_pages are left out of that object. With a response_format the
+    answer follows the structured outputs wrapping instead, and a call
+    including one of refused_pages is refused.
+    Every call appends the page indexes it carried to calls.
+    """
+    failing_pages = set()
+    throttled_calls = set()
+    omitted_pages = set()
+    refused_pages = set()
+    page_count = 1
+    split_batches = True
+    calls = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        indexes = []
+        for part in body['messages'][-1]['content']:
+            if part['type'] == 'image_url':
+                image = base64.b64decode(part['image_url']['url'].split(',', 1)[1])
+                indexes.append(Image.open(io.BytesIO(image)).size[0] - 10)
+        self.calls.append(indexes)
+        time.sleep(0.1 * (self.page_count - min(indexes)))
+        if self.failing_pages.intersection(indexes):
+            self.respond(400, {'error': {'message': 'Invalid image', 'code': 'BadRequest'}})
+            return
+        if tuple(indexes) in self.throttled_calls:
+            self.respond(429, {'error': {'message': 'Rate limit exceeded', 'code': '429'}}, {'Retry-After': '7'})
+            return
+        pages = [
+            (number, [{'date': '2024-03-04', 'category': 'Meals', 'description': f'Page {index}', 'amount': index}])
+            for number, index in enumerate(indexes, 1) if len(indexes) == 1 or index not in self.omitted_pages
+        ]
+        message = {'role': 'assistant', 'content': None}
+        if 'response_format' in body:
+            if self.refused_pages.intersection(indexes):
+                message['refusal'] = "I'm sorry, I can't help with that."
+            elif len(indexes) == 1:
+                message['content'] = json.dumps({'result': pages[0][1]})
+            else:
+                results = [{'page': number, 'result': page} for number, page in pages]
+                message['content'] = json.dumps({'result': results})
+        elif len(indexes) == 1:
+            message['content'] = json.dumps(pages[0][1])
+        elif self.split_batches:
+            message['content'] = json.dumps({str(number): page for number, page in pages})
+        else:
+            message['content'] = 'These pages contain several receipts.'
+        self.respond(200, {
+            'id': f'pages-{indexes}', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': message}],
+            'usage': {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120},
+        })
+
+    def respond(self, status, payload, headers=None):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        try:
+            self.end_headers()
+            self.wfile.write(content)
+        except ConnectionError:
+            pass  # The client cancelled the call
+
+
+def serve(test, handler):
+    """
+    Serve handler on a free local port until the test finishes
+
+    Returns:
+        int: The port
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server.server_port
+
+
+def completion_settings(port):
+    # AZURE_OPENAI pointing at a FakeCompletionHandler
+    return {
+        **settings.AZURE_OPENAI, 'KEY': 'test', 'ENDPOINT': f'http://127.0.0.1:{port}',
+        'API_VERSION': '2024-06-01', 'DEPLOYMENT': 'gpt4o', 'MAX_RETRIES': 0, 'MAX_CONCURRENCY': 4,
+        'BATCH_PAGES': 1, 'STRUCTURED_OUTPUTS': False, 'RPM_LIMIT': 0, 'TPM_LIMIT': 0,
+    }
+
+
+@override_settings(EXTRACTION_CACHE={'BACKEND': ''})
+class CallOpenAIApiTests(SimpleTestCase):
+
+    def setUp(self):
+        override = override_settings(AZURE_OPENAI=completion_settings(serve(self, FakeCompletionHandler)))
+        override.enable()
+        self.addCleanup(override.disable)
+        utils._openai_client = None
+        self.addCleanup(setattr, utils, '_openai_client', None)
+        utils._structured_format.cache_clear()
+        # Throttled responses shrink the process-wide concurrency limit
+        ratelimit._concurrency = None
+        self.addCleanup(setattr, ratelimit, '_concurrency', None)
+        self.schema = json.dumps(EXPENSE_SCHEMA)
+
+    def extract(self, page_count, failing_pages=(), batch_pages=1, asynchronous=False, structured=False, **handler):
+        completed = []
+        handler = {'page_count': page_count, 'failing_pages': set(failing_pages), 'calls': [], **handler}
+        call_openai_api = async_to_sync(utils.acall_openai_api) if asynchronous else utils.call_openai_api
+        config = {**settings.AZURE_OPENAI, 'BATCH_PAGES': batch_pages, 'STRUCTURED_OUTPUTS': structured}
+        with mock.patch.multiple(FakeCompletionHandler, **handler), override_settings(AZURE_OPENAI=config):
+            utils._structured_format.cache_clear()
+            self.calls = FakeCompletionHandler.calls
+            responses = call_openai_api(
+                (page_image(index) for index in range(page_count)), self.schema,
+                lambda index, response: completed.append(index)
+            )
+        utils._structured_format.cache_clear()
+        return responses, completed
+
+    def test_responses_are_in_page_order(self):
+        responses, completed = self.extract(4)
+        self.assertEqual([parse_expenses(response)[0]['amount'] for response in responses], [0, 1, 2, 3])
+        self.assertEqual(sorted(completed), [0, 1, 2, 3])
+        self.assertNotEqual(completed, [0, 1, 2, 3])
+
+    def test_failed_page_is_isolated(self):
+        with self.assertLogs('btValidator.utils', 'ERROR') as logs:
+            responses, completed = self.extract(4, failing_pages={1})
+        self.assertEqual(len(logs.records), 1)
+        self.assertIsNone(responses[1])
+        self.assertEqual([parse_expenses(responses[index])[0]['amount'] for index in (0, 2, 3)], [0, 2, 3])
+        self.assertEqual(sorted(completed), [0, 1, 2, 3])
+
+    def test_every_page_failing_raises(self):
+        with self.assertLogs('btValidator.utils', 'ERROR'), \
+                self.assertRaisesMessage(Exception, 'All pages failed to process'):
+            self.extract(2, failing_pages={0, 1})
+
+    def test_batched_pages_are_split_per_page(self):
+        responses, _ = self.extract(4, batch_pages=2)
+        self.assertEqual([parse_expenses(response)[0]['amount'] for response in responses], [0, 1, 2, 3])
+        self.assertEqual(sorted(self.calls), [[0, 1], [2, 3]])
+
+    def test_unsplittable_batch_falls_back_to_single_pages(self):
+        with self.assertLogs('btValidator.utils', 'WARNING'):
+            responses, _ = self.extract(2, batch_pages=2, split_batches=False)
+        self.assertEqual([parse_expenses(response)[0]['amount'] for response in responses], [0, 1])
+        self.assertEqual(sorted(self.calls), [[0], [0, 1], [1]])
+
+    def test_batch_answer_missing_a_page_falls_back_to_single_pages(self):
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous), self.assertLogs('btValidator.utils', 'WARNING'):
+                responses, _ = self.extract(4, batch_pages=2, asynchronous=asynchronous, omitted_pages={1})
+                self.assertEqual([parse_expenses(response)[0]['amount'] for response in responses], [0, 1, 2, 3])
+                self.assertEqual(sorted(self.calls), [[0], [0, 1], [1], [2, 3]])
+
+    def test_structured_outputs_are_unwrapped_per_page(self):
+        for batch_pages in (1, 2):
+            with self.subTest(batch_pages=batch_pages):
+                responses, _ = self.extract(4, batch_pages=batch_pages, structured=True)
+                self.assertEqual([json.loads(response)[0]['amount'] for response in responses], [0, 1, 2, 3])
+                self.assertEqual(len(self.calls), 4 // batch_pages)
+
+    def test_refused_page_fails_alone(self):
+        with self.assertLogs('btValidator.utils', 'WARNING') as logs:
+            responses, _ = self.extract(4, batch_pages=2, structured=True, refused_pages={1})
+        self.assertEqual([response is None for response in responses], [False, True, False, False])
+        # The refused batch falls back to single pages; only the refused page fails
+        self.assertEqual(sorted(self.calls), [[0], [0, 1], [1], [2, 3]])
+        self.assertTrue(any('Model refused to extract the page' in line for line in logs.output))
+
+    @override_settings(EXTRACTION_CACHE={'BACKEND': 'btValidator.cache.MemoryCache', 'OPTIONS': {'ttl': 60}})
+    def test_cached_pages_are_left_out_of_the_batch(self):
+        cache._extraction_cache = None
+        self.addCleanup(setattr, cache, '_extraction_cache', None)
+        self.extract(2, batch_pages=2)
+        responses, _ = self.extract(4, batch_pages=4)
+        self.assertEqual([parse_expenses(response)[0]['amount'] for response in responses], [0, 1, 2, 3])
+        self.assertEqual(self.calls, [[2, 3]])
+
+    def test_throttled_single_page_calls_in_batch_mode_raise_with_retry_after(self):
+        with self.assertLogs('btValidator', 'WARNING'), \
+                self.assertRaises(utils.ExtractionThrottledError) as raised:
+            self.extract(2, batch_pages=2, split_batches=False, throttled_calls={(0,), (1,)})
+        self.assertEqual(raised.exception.retry_after, 7)
+
+    def test_throttled_batch_call_raises_with_retry_after(self):
+        with self.assertLogs('btValidator', 'WARNING'), \
+                self.assertRaises(utils.ExtractionThrottledError) as raised:
+            self.extract(4, batch_pages=2, throttled_calls={(0, 1), (2, 3)})
+        self.assertEqual(raised.exception.retry_after, 7)
+        self.assertEqual(sorted(self.calls), [[0, 1], [2, 3]])
+
+    def test_failed_batch_call_is_not_retried_per_page(self):
+        with self.assertLogs('btValidator.utils', 'ERROR'):
+            responses, _ = self.extract(4, failing_pages={1}, batch_pages=2)
+        self.assertEqual(responses[:2], [None, None])
+        self.assertEqual(sorted(self.calls), [[0, 1], [2, 3]])
+
+
+class SharedQuotaTests(SimpleTestCase):
+
+    def setUp(self):
+        ratelimit._quota = None
+        self.addCleanup(setattr, ratelimit, '_quota', None)
+
+    @override_settings(AZURE_OPENAI={**settings.AZURE_OPENAI, 'RPM_LIMIT': 60, 'RATE_LIMIT_PATH': None,
+                                     'RATE_LIMIT_JOURNAL_MODE': 'DELETE'})
+    def test_quota_defaults_to_local_temp_directory(self):
+        quota = ratelimit.get_quota()
+        self.addCleanup(os.remove, quota.path)
+        self.assertEqual(os.path.dirname(quota.path), tempfile.gettempdir())
+        self.assertEqual(quota._connection().execute("PRAGMA journal_mode").fetchone()[0], 'delete')
+
+
+class FakeBlobHandler(BaseHTTPRequestHandler):
+    """
+    The part of the Blob service REST API that Azurite serves for uploads,
+    create-only uploads, metadata updates, property reads, server-side copies
+    and deletes, under the devstoreaccount1 path-style URLs. Blobs whose name
+    ends with 'rejected.pdf' are refused, as if the upload had failed.
+    """
+    blobs = {}
+
+    def log_message(self, *args):
+        pass
+
+    def blob_key(self, url=None):
+        return tuple(urllib.parse.unquote(urllib.parse.urlsplit(url or self.path).path).split('/', 3)[2:])
+
+    def do_PUT(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        key = self.blob_key()
+        if 'comp=metadata' in urllib.parse.urlsplit(self.path).query:
+            self.respond(200 if key in self.blobs else 404, 'BlobNotFound')
+        elif self.headers.get('x-ms-copy-source'):
+            source = self.blob_key(self.headers['x-ms-copy-source'])
+            if source not in self.blobs:
+                self.respond(404, 'CannotVerifyCopySource')
+                return
+            self.blobs[key] = self.blobs[source]
+            self.respond(202, headers={'x-ms-copy-id': str(uuid.uuid4()), 'x-ms-copy-status': 'success'})
+        elif key[1].endswith('rejected.pdf'):
+            self.respond(400, 'InvalidInput')
+        elif self.headers.get('If-None-Match') == '*' and key in self.blobs:
+            self.respond(409, 'BlobAlreadyExists')
+        else:
+            self.blobs[key] = content
+            self.respond(201)
+
+    def do_HEAD(self):
+        content = self.blobs.get(self.blob_key())
+        if content is None:
+            self.respond(404, 'BlobNotFound')
+            return
+        self.respond(200, headers={'x-ms-blob-type': 'BlockBlob'}, length=len(content))
+
+    def do_DELETE(self):
+        self.respond(202 if self.blobs.pop(self.blob_key(), None) is not None else 404, 'BlobNotFound')
+
+    def respond(self, status, error_code=None, headers=None, length=0):
+        self.send_response(status)
+        self.send_header('ETag', '"0x1"')
+        self.send_header('Last-Modified', 'Mon, 04 Mar 2024 00:00:00 GMT')
+        self.send_header('x-ms-request-id', str(uuid.uuid4()))
+        self.send_header('x-ms-version', self.headers.get('x-ms-version', ''))
+        if status >= 400:
+            self.send_header('x-ms-error-code', error_code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+def storage_settings(port):
+    # AZURE_STORAGE pointing at a FakeBlobHandler, with Azurite's well-known development account
+    connection_string = (
+        'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+        'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tOwDJ1XnWStFhT6Z4r7sd1Kl1Ig==;'
+        f'BlobEndpoint=http://127.0.0.1:{port}/devstoreaccount1;'
+    )
+    return {**settings.AZURE_STORAGE, 'CONNECTION_STRING': connection_string, 'UPLOAD_CONCURRENCY': 3}
+
+
+def use_fake_blob_storage(test):
+    # Point the blob client at a FakeBlobHandler with no blobs for the duration of test
+    override = override_settings(AZURE_STORAGE=storage_settings(serve(test, FakeBlobHandler)))
+    override.enable()
+    test.addCleanup(override.disable)
+    utils._blob_client = None
+    test.addCleanup(setattr, utils, '_blob_client', None)
+    mock.patch.object(FakeBlobHandler, 'blobs', {}).start()
+    test.addCleanup(mock.patch.stopall)
+
+
+class UploadMultipleFilesTests(SimpleTestCase):
+
+    def setUp(self):
+        use_fake_blob_storage(self)
+
+    def test_uploads_every_file_in_input_order(self):
+        files = [SimpleUploadedFile(f'{name}.pdf', name.encode()) for name in ('a', 'b', 'c')]
+        uploaded = utils.upload_multiple_files(files)
+        self.assertEqual([info['name'] for info in uploaded], ['a.pdf', 'b.pdf', 'c.pdf'])
+        stored = {name: content for (_, name), content in FakeBlobHandler.blobs.items()}
+        self.assertEqual([stored[info['url'].split('/')[-1]] for info in uploaded], [b'a', b'b', b'c'])
+
+    def test_failed_upload_removes_the_others(self):
+        files = [SimpleUploadedFile('a.pdf', b'a'), SimpleUploadedFile('rejected.pdf', b'r'),
+                 SimpleUploadedFile('c.pdf', b'c')]
+        with self.assertLogs('btValidator.utils', 'ERROR'), \
+                self.assertRaisesMessage(Exception, 'Failed to upload rejected.pdf'):
+            utils.upload_multiple_files(files)
+        self.assertEqual(FakeBlobHandler.blobs, {})
+
+
+class StagedFilesTests(SimpleTestCase):
+
+    def setUp(self):
+        use_fake_blob_storage(self)
+        self.files = [SimpleUploadedFile(f'{name}.pdf', name.encode() * 3, content_type='application/pdf')
+                      for name in ('a', 'b')]
+        self.handles = [hashlib.sha256(name.encode() * 3).hexdigest() for name in ('a', 'b')]
+
+    def stored(self, container):
+        return {name: content for (blob_container, name), content in FakeBlobHandler.blobs.items()
+                if blob_container == container}
+
+    def test_files_are_staged_once_under_their_content_hash(self):
+        staged = utils.stage_files(self.files)
+        self.assertEqual(staged, [{'handle': handle, 'name': f'{name}.pdf', 'size': 3}
+                                  for handle, name in zip(self.handles, 'ab')])
+        # Staging the same content again touches the existing blob
+        self.assertEqual(utils.stage_files(self.files), staged)
+        self.assertEqual(self.stored('staging'), dict(zip(self.handles, [b'aaa', b'bbb'])))
+
+    def test_promotion_copies_staged_files(self):
+        staged = utils.stage_files(self.files)
+        for promote in (utils.promote_staged_files, async_to_sync(self.apromote)):
+            with self.subTest(promote=promote):
+                promoted = promote(staged)
+                self.assertEqual([(info['name'], info['size']) for info in promoted], [('a.pdf', 3), ('b.pdf', 3)])
+                stored = self.stored('reports')
+                self.assertEqual([stored[info['url'].split('/')[-1]] for info in promoted], [b'aaa', b'bbb'])
+
+    async def apromote(self, staged):
+        try:
+            return await utils.apromote_staged_files(staged)
+        finally:
+            await utils.get_async_blob_client().close()
+
+    def test_expired_handle_fails_the_whole_promotion(self):
+        expired = {'handle': hashlib.sha256(b'gone').hexdigest(), 'name': 'gone.pdf'}
+        staged = utils.stage_files(self.files[:1]) + [expired]
+        with self.assertLogs('btValidator.utils', 'ERROR'), \
+                self.assertRaisesMessage(Exception, 'Staged file gone.pdf has expired, please upload it again'):
+            utils.promote_staged_files(staged)
+        self.assertEqual(self.stored('reports'), {})
+
+    def test_handles_are_validated(self):
+        with self.assertRaisesMessage(ValueError, 'Invalid staged file handle'):
+            utils.promote_staged_files([{'handle': '../reports/a.pdf', 'name': 'a.pdf'}])
+
+    @override_settings(REQUEST_CACHE={'BACKEND': ''})
+    def test_submit_report_references_staged_files(self):
+        container = FakeContainer()
+        cosmos_db = object.__new__(data.CosmosDB)
+        cosmos_db.container = container
+        mock.patch.object(views, 'get_cosmos_db', return_value=cosmos_db).start()
+        staged = utils.stage_files(self.files)
+
+        def submit(staged_files):
+            report = {'requester': 'a@example.com', 'total_amount': 6, 'expenses': [], 'staged_files': staged_files}
+            return self.client.post('/api/travel-requests/submit-report/', {'data': json.dumps(report)})
+
+        response = submit(staged)
+        self.assertEqual(response.status_code, 201)
+        documents = container.read_item(response.json()['request_id'], response.json()['request_id'])['documents']
+        self.assertEqual([(document['file_name'], document['file_size']) for document in documents],
+                         [('a.pdf', 3), ('b.pdf', 3)])
+
+        with self.assertLogs('btValidator', 'ERROR'):
+            response = submit([{'handle': hashlib.sha256(b'gone').hexdigest(), 'name': 'gone.pdf'}])
+        self.assertIn('has expired, please upload it again', response.json()['error'])
+        self.assertEqual(len(container.documents), 1)
+
+class FakeContainer:
+    """
+    Sync Cosmos container stand-in holding documents under their partition key
+    """
+
+    def __init__(self, partition_key_path='/id'):
+        self.partition_key_path = partition_key_path
+        self.documents = {}
+
+    def add(self, document):
+        key = data._partition_key_value(document, self.partition_key_path)
+        self.documents[(document['id'], key)] = dict(document, _etag='"1"')
+
+    def read(self):
+        return {'partitionKey': {'paths': [self.partition_key_path]}}
+
+    def read_item(self, item, partition_key):
+        try:
+            return dict(self.documents[(item, partition_key)])
+        except KeyError:
+            raise CosmosResourceNotFoundError(message='Not found')
+
+    def create_item(self, body):
+        self.add(body)
+        return dict(self.documents[(body['id'], data._partition_key_value(body, self.partition_key_path))])
+
+    def query_items(self, query, parameters, max_item_count=None, **kwargs):
+        # Parameters filter on the field they are named after; c.field projections are applied
+        filters = {parameter['name'][1:]: parameter['value'] for parameter in parameters}
+        documents = [document for document in self.documents.values()
+                     if all(document.get(field) == value for field, value in filters.items())]
+        projection = query.split(' FROM ')[0].removeprefix('SELECT ')
+        if projection != '*':
+            fields = [field.removeprefix('c.') for field in projection.split(', ')]
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        return FakeQueryResult([dict(document) for document in documents], max_item_count)
+
+    def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        document = self.documents.get((item, partition_key))
+        if document is None:
+            raise CosmosResourceNotFoundError(message='Not found')
+        for operation in patch_operations:
+            field = operation['path'].strip('/').split('/')[0]
+            if operation['op'] == 'add':
+                document.setdefault(field, []).append(operation['value'])
+            else:
+                document[field] = operation['value']
+        document['_etag'] = f'"{int(document["_etag"].strip(chr(34))) + 1}"'
+        return dict(document)
+
+
+class FakeQueryResult(list):
+    """
+    Query result that can also be read a page at a time, as ItemPaged does.
+    Continuation tokens are the offset of the next page; others are rejected
+    with a 400, as Cosmos rejects a malformed token.
+    """
+
+    def __init__(self, documents, page_size=None):
+        super().__init__(documents)
+        self.page_size = page_size or len(documents) or 1
+
+    def by_page(self, continuation=None):
+        return FakePages(self, continuation)
+
+
+class FakePages:
+
+    def __init__(self, result, continuation):
+        self.result = result
+        self.continuation_token = continuation
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.continuation_token is not None and not self.continuation_token.isdigit():
+            raise CosmosHttpResponseError(status_code=400, message='Invalid continuation token')
+        offset = int(self.continuation_token or 0)
+        if offset and offset >= len(self.result):
+            raise StopIteration
+        end = offset + self.result.page_size
+        self.continuation_token = str(end) if end < len(self.result) else None
+        return iter(self.result[offset:end])
+
+
+async def aiterate(items):
+    for item in items:
+        yield item
+
+
+class AsyncFakeContainer:
+    """
+    azure.cosmos.aio container stand-in over a FakeContainer
+    """
+
+    def __init__(self, container):
+        self.container = container
+
+    async def read(self):
+        return self.container.read()
+
+    async def read_item(self, item, partition_key):
+        return self.container.read_item(item, partition_key)
+
+    async def create_item(self, body):
+        return self.container.create_item(body)
+
+    async def patch_item(self, **kwargs):
+        return self.container.patch_item(**kwargs)
+
+    def query_items(self, query, parameters, **kwargs):
+        return AsyncFakeQueryResult(self.container.query_items(query, parameters, **kwargs))
+
+
+class AsyncFakeQueryResult:
+
+    def __init__(self, result):
+        self.result = result
+
+    def __aiter__(self):
+        return aiterate(self.result)
+
+    def by_page(self, continuation=None):
+        return AsyncFakePages(self.result.by_page(continuation))
+
+
+class AsyncFakePages:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    @property
+    def continuation_token(self):
+        return self.pages.continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return aiterate(next(self.pages))
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def travel_request_document(index, **fields):
+    day = f'2024-03-{index + 1:02d}'
+    return {'id': f'r{index}', 'type': 'travel_request', 'requester': 'a@example.com', 'status': 'PENDING',
+            'created_at': day, 'updated_at': day, 'start_date': day, 'end_date': day, 'total_amount': 10 * index,
+            'department': 'Sales', 'position': 'Manager', 'documents': [], 'expenses': [], 'history': [], **fields}
+
+
+@override_settings(REQUEST_CACHE={'BACKEND': ''}, COSMOS_DB={**settings.COSMOS_DB, 'PARTITION_KEY': 'id'})
+class UploadDocumentTests(SimpleTestCase):
+
+    def setUp(self):
+        use_fake_blob_storage(self)
+        self.container = FakeContainer()
+        self.container.add(travel_request_document(1))
+        cosmos_db = object.__new__(data.CosmosDB)
+        cosmos_db.container = self.container
+        mock.patch.object(views, 'get_cosmos_db', return_value=cosmos_db).start()
+
+    def upload(self, pk):
+        receipt = SimpleUploadedFile('receipt.pdf', b'%PDF-1.4', content_type='application/pdf')
+        with mock.patch.object(self.container, 'read_item', side_effect=AssertionError('read before patch')):
+            return self.client.post(f'/api/travel-requests/{pk}/upload_document/', {'file': receipt})
+
+    def test_document_is_appended_without_a_read(self):
+        response = self.upload('r1')
+        self.assertEqual(response.status_code, 200)
+        documents = self.container.read_item('r1', 'r1')['documents']
+        self.assertEqual([(document['file_name'], document['file_url']) for document in documents],
+                         [('receipt.pdf', response.json()['file_url'])])
+
+    def test_missing_request_is_not_found_and_keeps_no_blob(self):
+        self.assertEqual(self.upload('r9').status_code, 404)
+        self.assertEqual(FakeBlobHandler.blobs, {})
+
+@override_settings(REQUEST_CACHE={'BACKEND': ''})
+class LegacyPartitionTests(SimpleTestCase):
+
+    def setUp(self):
+        # Container partitioned on /requester, from before the id partitioning
+        self.container = FakeContainer('/requester')
+        self.container.add({'id': 'r1', 'type': 'travel_request', 'requester': 'a@example.com',
+                            'status': 'PENDING', 'history': []})
+        self.cosmos_db = object.__new__(data.CosmosDB)
+        self.cosmos_db.container = self.container
+
+    @override_settings(COSMOS_DB={**settings.COSMOS_DB, 'PARTITION_KEY': 'id', 'LEGACY_QUERY_FALLBACK': True})
+    def test_patch_retries_under_stored_partition_key(self):
+        self.assertIsNotNone(self.cosmos_db.get_travel_request_item('r1'))
+        updated = self.cosmos_db.update_travel_request('r1', updates={'status': 'APPROVED'})
+        self.assertEqual(updated['status'], 'APPROVED')
+        self.assertIsNone(self.cosmos_db.update_travel_request('missing', updates={'status': 'APPROVED'}))
+
+    @override_settings(COSMOS_DB={**settings.COSMOS_DB, 'PARTITION_KEY': 'id', 'LEGACY_QUERY_FALLBACK': False})
+    def test_patch_without_fallback_is_not_found(self):
+        self.assertIsNone(self.cosmos_db.update_travel_request('r1', updates={'status': 'APPROVED'}))
+        self.assertIsNone(self.cosmos_db.update_travel_request('missing', updates={'status': 'APPROVED'}))
+
+
+
+@override_settings(REQUEST_CACHE={'BACKEND': 'btValidator.cache.MemoryCache', 'OPTIONS': {'ttl': 60}})
+class RequestCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache._request_cache = None
+        self.addCleanup(setattr, cache, '_request_cache', None)
+        self.container = FakeContainer('/id')
+        self.container.add({'id': 'r1', 'type': 'travel_request', 'status': 'PENDING', 'history': []})
+        self.cosmos_db = object.__new__(data.CosmosDB)
+        self.cosmos_db.container = self.container
+
+    def test_read_racing_a_write_does_not_cache_the_old_version(self):
+        read_item = self.container.read_item
+
+        def read_then_write(item, partition_key):
+            # The read completes before a write that lands while it is being cached
+            document = read_item(item, partition_key)
+            self.cosmos_db.update_travel_request('r1', updates={'status': 'APPROVED'})
+            return document
+
+        with mock.patch.object(self.container, 'read_item', read_then_write):
+            self.assertEqual(self.cosmos_db.get_travel_request_item('r1')['status'], 'PENDING')
+        self.assertEqual(self.cosmos_db.get_travel_request_item('r1')['status'], 'APPROVED')
+
+    def test_reads_are_cached_until_a_write(self):
+        for _ in range(3):
+            self.cosmos_db.get_travel_request_item('r1')
+        self.assertEqual(cache.get_request_cache().stats(), {'hits': 2, 'misses': 1})
+        self.cosmos_db.update_travel_request('r1', updates={'status': 'APPROVED'})
+        self.assertEqual(self.cosmos_db.get_travel_request_item('r1')['status'], 'APPROVED')
+
+    def test_sqlite_cache_defaults_to_local_temp_directory(self):
+        request_cache = cache.SQLiteCache(table='request_cache_test', journal_mode='DELETE')
+        self.addCleanup(os.remove, request_cache.path)
+        self.assertEqual(os.path.dirname(request_cache.path), tempfile.gettempdir())
+        mode = request_cache._connection().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'delete')
+
+
+class ReportJobPruneTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        override = override_settings(REPORT_JOBS={**settings.REPORT_JOBS, 'DIR': self.dir, 'STALE_AFTER': 60})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.store = jobs.ReportJobStore(os.path.join(self.dir, 'jobs.sqlite3'))
+
+    def add_job(self, status, owner, age=0):
+        job_id = self.store.create()
+        with self.store._connection() as conn:
+            conn.execute(
+                "UPDATE report_jobs SET status = ?, owner = ?, updated_at = ? WHERE id = ?",
+                (status, owner, time.time() - age, job_id)
+            )
+        os.makedirs(os.path.join(self.dir, job_id))
+        return job_id
+
+    def test_interrupted_jobs_fail_and_orphaned_inputs_are_removed(self):
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        host = socket.gethostname()
+        dead = self.add_job('running', f'{host}:{exited.pid}')
+        stalled = self.add_job('running', f'{host}:{os.getpid()}', age=120)
+        waiting = self.add_job('queued', f'{host}:{os.getpid()}', age=120)
+        foreign = self.add_job('queued', 'other-host:1', age=120)
+        os.makedirs(os.path.join(self.dir, 'unknown'))
+
+        jobs.prune_report_jobs(self.store)
+
+        statuses = {job_id: self.store.get(job_id)['status'] for job_id in (dead, stalled, waiting, foreign)}
+        self.assertEqual(statuses, {dead: 'failed', stalled: 'failed', waiting: 'queued', foreign: 'failed'})
+        self.assertEqual(sorted(name for name in os.listdir(self.dir) if os.path.isdir(os.path.join(self.dir, name))),
+                         [waiting])
+
+    def test_owner_is_not_signalled_on_windows(self):
+        with mock.patch.object(jobs.os, 'name', 'nt'), mock.patch.object(jobs.os, 'kill') as kill:
+            self.assertIsNone(jobs._owner_alive(f'{socket.gethostname()}:{os.getpid()}'))
+        kill.assert_not_called()
+
+    def test_job_store_uses_the_configured_journal_mode(self):
+        store = jobs.ReportJobStore(os.path.join(self.dir, 'share.sqlite3'), journal_mode='DELETE')
+        self.assertEqual(store._connection().execute("PRAGMA journal_mode").fetchone()[0], 'delete')
+        self.assertEqual(self.store._connection().execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+
+class TextLayerSavingTests(SimpleTestCase):
+
+    def test_estimate_from_measured_image_pages(self):
+        counters = {('pdf_pages_total', 'image'): 10, ('pdf_render_seconds_sum', None): 5.0}
+        averages = {'image': 3.0, 'text': 1.0}
+        with mock.patch.object(utils, 'counter_value', lambda name, path=None: counters.get((name, path), 0)), \
+                mock.patch.object(utils, 'average', lambda name, path: averages.get(path)):
+            # 0.5s render + 3s image extraction - 1s text extraction
+            self.assertAlmostEqual(utils._text_layer_seconds_saved(), 2.5)
+
+    @override_settings(PDF_PROCESSING={**settings.PDF_PROCESSING, 'IMAGE_PAGE_SECONDS': 4.0})
+    def test_default_until_image_pages_are_measured(self):
+        with mock.patch.object(utils, 'counter_value', return_value=0), \
+                mock.patch.object(utils, 'average', return_value=None):
+            self.assertEqual(utils._text_layer_seconds_saved(), 4.0)
+
+
+    @override_settings(PDF_PROCESSING={**settings.PDF_PROCESSING, 'TEXT_LAYER': True, 'TEXT_MIN_CHARS': 10})
+    def test_poppler_reads_the_spooled_pdf(self):
+        paths = []
+
+        def pdfinfo(path):
+            paths.append(path)
+            return {'Pages': 1}
+
+        def pdftotext(args, **kwargs):
+            path = args[-2]
+            paths.append(path)
+            # The spooled copy is complete and closed, so it can be opened on Windows too
+            with open(path, 'rb') as pdf_file:
+                self.assertEqual(pdf_file.read(), b'%PDF-1.4 receipt')
+            return subprocess.CompletedProcess(args, 0, stdout=b'Taxi to the airport 42.50 EUR\f')
+
+        with mock.patch.object(utils, 'pdfinfo_from_path', pdfinfo), \
+                mock.patch.object(utils.subprocess, 'run', pdftotext):
+            pages = list(utils.iter_pdf_pages_as_base64([SimpleUploadedFile('a.pdf', b'%PDF-1.4 receipt')]))
+        self.assertEqual(pages, ['Taxi to the airport 42.50 EUR'])
+        self.assertIsInstance(pages[0], utils.TextPage)
+        self.assertEqual(len(set(paths)), 1)
+
+
+class CompiledSerializerTests(SimpleTestCase):
+
+    def test_matches_drf_for_null_defaulted_fields(self):
+        item = {
+            'id': 'r1', 'requester': 'a@example.com', 'status': 'PENDING', 'created_at': '2024-03-01T00:00:00',
+            'updated_at': '2024-03-01T00:00:00', 'start_date': '2024-03-04', 'end_date': '2024-03-06',
+            'total_amount': 42.5, 'department': 'Sales', 'position': 'Manager',
+            'documents': [{'id': None, 'file_name': 'a.pdf', 'file_size': 1,
+                           'file_url': 'https://example.com/a.pdf', 'uploaded_at': None}],
+            'expenses': [
+                {'id': None, 'category': 'Meals', 'description': 'Dinner', 'amount': 42.5, 'date': None},
+                {'id': 'e2', 'category': 'Meals', 'description': 'Lunch', 'amount': 1, 'date': ''},
+                {'id': 'e3', 'category': 'Taxi', 'description': 'Airport', 'amount': 2, 'date': '2024-03-04T10:00:00'},
+            ],
+            'history': [{'id': '', 'type': 'created', 'title': 'Created', 'user': 'a', 'comments': None,
+                         'date': '2024-03-01T00:00:00'}],
+        }
+        with mock.patch.object(models, '_now', return_value='2024-03-09T00:00:00'), \
+                mock.patch.object(models.uuid, 'uuid4', return_value='generated'):
+            expected = TravelRequestSerializer(models.TravelRequest.from_dict(item)).data
+            compiled = represent_travel_request(models.TravelRequest.from_dict(item))
+        self.assertEqual(json.loads(json.dumps(compiled)), json.loads(json.dumps(expected)))
+        self.assertEqual(compiled['expenses'][0]['id'], 'generated')
+        self.assertEqual(compiled['expenses'][1]['date'], '2024-03-09T00:00:00')
+
+
+class ORJSONRendererTests(SimpleTestCase):
+
+    def render(self, renderer, data, action='list'):
+        return renderer.render(data, 'application/json', {'view': types.SimpleNamespace(action=action)})
+
+    def test_read_actions_match_the_stock_renderer(self):
+        data = {'results': [{'id': uuid.UUID(int=1), 'amount': decimal.Decimal('12.50'), 'total': 42.5,
+                             'created_at': datetime.datetime(2024, 3, 4, 10, 0), 'note': 'café\u2028ok'}],
+                'next_cursor': None}
+        rendered = self.render(ORJSONRenderer(), data)
+        self.assertEqual(rendered, self.render(JSONRenderer(), data))
+
+    def test_integers_orjson_rejects_fall_back_to_the_stock_renderer(self):
+        data = {'count': 2 ** 64}
+        self.assertEqual(self.render(ORJSONRenderer(), data), b'{"count":18446744073709551616}')
+
+    def test_other_actions_keep_strict_json(self):
+        with self.assertRaises(ValueError):
+            self.render(ORJSONRenderer(), {'amount': float('nan')}, action='generate_report')
+
+class AggregateDeleteTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = aggregates.AggregateStore(os.path.join(directory.name, 'stats.sqlite3'))
+        self.store.acquire_lease('owner', 60)
+        self.store.checkpoint('owner', [
+            {'id': 'r1', 'type': 'travel_request', 'status': 'PENDING', 'department': 'Sales',
+             'start_date': '2024-03-04', 'total_amount': 10, '_lsn': 1},
+            {'id': 'r2', 'type': 'travel_request', 'status': 'PENDING', 'department': 'Sales',
+             'start_date': '2024-03-05', 'total_amount': 5, '_lsn': 2},
+        ], 'c1', 60)
+
+    def test_soft_delete_removes_contribution(self):
+        self.store.checkpoint('owner', [{'id': 'r2', 'type': 'travel_request', 'status': 'PENDING',
+                                         'deleted': True, 'ttl': 60, '_lsn': 3}], 'c2', 60)
+        self.assertEqual(self.store.stats()['by_status'], {'PENDING': {'count': 1, 'total_amount': 10}})
+
+    def test_reconcile_removes_hard_deletes(self):
+        self.assertEqual(self.store.reconcile('owner', {'r1'}, 60), 1)
+        self.assertEqual(self.store.stats()['by_department'], {'Sales': {'count': 1, 'total_amount': 10}})
+        self.assertEqual(self.store.reconcile('owner', set(), 60), 1)
+        self.assertEqual(self.store.stats()['by_month'], {})
+        with self.assertRaises(aggregates.LeaseUnavailableError):
+            self.store.reconcile('someone else', set(), 60)
+
+    def test_store_uses_the_configured_journal_mode(self):
+        self.assertEqual(self.store._connection().execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        with tempfile.TemporaryDirectory() as directory:
+            store = aggregates.AggregateStore(os.path.join(directory, 'share.sqlite3'), journal_mode='DELETE')
+            self.assertEqual(store._connection().execute("PRAGMA journal_mode").fetchone()[0], 'delete')
+            store._connection().close()
+
+
+class MetricsEndpointTests(SimpleTestCase):
+
+    def test_local_scrape_gets_per_process_samples(self):
+        increment('extraction_cache_rejected_total')
+        response = self.client.get('/api/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(f'btvalidator_extraction_cache_rejected_total{{pid="{os.getpid()}"}}', response.content.decode())
+
+    @override_settings(METRICS={'ALLOWED_IPS': ['10.0.0.4']})
+    def test_only_allowed_addresses_may_scrape(self):
+        self.assertEqual(self.client.get('/api/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get('/api/metrics', REMOTE_ADDR='10.0.0.4').status_code, 200)
+
+
+@override_settings(REQUEST_CACHE={'BACKEND': ''}, EXTRACTION_CACHE={'BACKEND': ''},
+                   COSMOS_DB={**settings.COSMOS_DB, 'PARTITION_KEY': 'id'})
+class AsyncViewSetTests(SimpleTestCase):
+
+    def setUp(self):
+        override = override_settings(
+            AZURE_OPENAI=completion_settings(serve(self, FakeCompletionHandler)),
+            AZURE_STORAGE=storage_settings(serve(self, FakeBlobHandler))
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        ratelimit._concurrency = None
+        self.addCleanup(setattr, ratelimit, '_concurrency', None)
+
+        self.container = FakeContainer()
+        for index in range(3):
+            self.container.add(travel_request_document(index))
+        cosmos_db = object.__new__(data.AsyncCosmosDB)
+        cosmos_db.container = AsyncFakeContainer(self.container)
+        mock.patch.object(async_views, 'get_async_cosmos_db', return_value=cosmos_db).start()
+        # Building the sync client would block the event loop
+        mock.patch.object(views, 'get_cosmos_db', side_effect=AssertionError('sync Cosmos client used')).start()
+        mock.patch.multiple(FakeCompletionHandler, page_count=2, calls=[]).start()
+        mock.patch.object(FakeBlobHandler, 'blobs', {}).start()
+        self.addCleanup(mock.patch.stopall)
+        self.factory = APIRequestFactory()
+
+    async def call(self, actions, request, **kwargs):
+        force_authenticate(request, user=types.SimpleNamespace(email='approver@example.com', is_authenticated=True))
+        response = await AsyncTravelRequestViewSet.as_view(actions)(request, **kwargs)
+        response.render()
+        return response
+
+    async def test_list_pages_with_cursor(self):
+        response = await self.call({'get': 'list'}, self.factory.get('/api/travel-requests/', {'page_size': 2}))
+        self.assertEqual([item['id'] for item in response.data['results']], ['r0', 'r1'])
+        response = await self.call({'get': 'list'}, self.factory.get(
+            '/api/travel-requests/', {'page_size': 2, 'cursor': response.data['next_cursor']}
+        ))
+        self.assertEqual([item['id'] for item in response.data['results']], ['r2'])
+        self.assertIsNone(response.data['next_cursor'])
+
+    async def test_retrieve(self):
+        response = await self.call({'get': 'retrieve'}, self.factory.get('/api/travel-requests/r1/'), pk='r1')
+        self.assertEqual((response.status_code, response.data['total_amount']), (200, '10.00'))
+        self.assertEqual(response['ETag'], '"1"')
+        response = await self.call({'get': 'retrieve'}, self.factory.get('/api/travel-requests/r9/'), pk='r9')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_approve(self):
+        request = self.factory.post('/api/travel-requests/r1/approve/', {'comments': 'ok'}, format='json')
+        response = await self.call({'post': 'approve'}, request, pk='r1')
+        self.assertEqual(response.data['status'], 'APPROVED')
+        self.assertEqual([(entry['type'], entry['user']) for entry in response.data['history']],
+                         [('approved', 'approver@example.com')])
+        response = await self.call({'post': 'approve'}, self.factory.post('/api/travel-requests/r9/approve/'), pk='r9')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_generate_report(self):
+        pdf = SimpleUploadedFile('receipts.pdf', b'%PDF-1.4 receipts', content_type='application/pdf')
+        request = self.factory.post('/api/travel-requests/generate-report/', {'files': [pdf]}, format='multipart')
+        # Poppler is not needed: the upload stands for two rendered pages
+        with mock.patch.object(async_views, 'iter_pdf_pages_as_base64',
+                               lambda files: (page_image(index) for index in range(2))):
+            response = await self.call({'post': 'generate_report'}, request)
+        await utils.get_async_blob_client().close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([expense['amount'] for expense in response.data['expenses']], [0, 1])
+        handle = hashlib.sha256(b'%PDF-1.4 receipts').hexdigest()
+        self.assertEqual(response.data['files'][0]['handle'], handle)
+        self.assertIn(handle, [name for _, name in FakeBlobHandler.blobs])
+
+    async def test_cancelled_extraction_cancels_its_batches(self):
+        extraction = asyncio.create_task(utils.acall_openai_api(
+            (page_image(index) for index in range(2)), json.dumps(EXPENSE_SCHEMA)
+        ))
+        while len(FakeCompletionHandler.calls) < 2:
+            await asyncio.sleep(0.01)
+        batches = asyncio.all_tasks() - {asyncio.current_task(), extraction}
+        extraction.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await extraction
+        await asyncio.wait(batches)
+        self.assertTrue(batches)
+        self.assertTrue(all(batch.cancelled() for batch in batches))
+
+
+@override_settings(REQUEST_CACHE={'BACKEND': ''}, COSMOS_DB={**settings.COSMOS_DB, 'MAX_PAGE_SIZE': 3})
+class ListPaginationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.container = FakeContainer()
+        for index in range(5):
+            self.container.add(travel_request_document(index))
+        cosmos_db = object.__new__(data.CosmosDB)
+        cosmos_db.container = self.container
+        mock.patch.object(views, 'get_cosmos_db', return_value=cosmos_db).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def list(self, **params):
+        return self.client.get('/api/travel-requests/', params)
+
+    def test_page_size_is_validated_and_clamped(self):
+        self.assertEqual(self.list(page_size='ten').status_code, 400)
+        self.assertEqual(len(self.list(page_size=0).json()['results']), 1)
+        self.assertEqual(len(self.list(page_size=100).json()['results']), 3)
+
+    def test_next_cursor_round_trip(self):
+        ids, cursor = [], None
+        while True:
+            page = self.list(page_size=2, **({'cursor': cursor} if cursor else {})).json()
+            ids.extend(item['id'] for item in page['results'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, ['r0', 'r1', 'r2', 'r3', 'r4'])
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.list(page_size=2)
+        self.assertEqual(self.client.get('/api/travel-requests/', {'page_size': 2},
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.container.patch_item('r1', 'r1', [{'op': 'set', 'path': '/status', 'value': 'APPROVED'}])
+        self.assertEqual(self.client.get('/api/travel-requests/', {'page_size': 2},
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_bad_cursor_is_a_client_error(self):
+        self.assertEqual(self.list(cursor='not base64!').status_code, 400)
+        # Decodes, but Cosmos DB rejects the continuation token
+        self.assertEqual(self.list(cursor=utils.encode_cursor('{"token": "forged"}')).status_code, 400)
+
+    def test_summary_view_projects_the_summary_fields(self):
+        with mock.patch.object(self.container, 'query_items', wraps=self.container.query_items) as query_items:
+            summary = self.list(page_size=2, view='summary')
+        projection = ', '.join(f'c.{field}' for field in data.SUMMARY_FIELDS + ['_etag'])
+        self.assertTrue(query_items.call_args.kwargs['query'].startswith(f'SELECT {projection} FROM'))
+        self.assertEqual([sorted(item) for item in summary.json()['results']], [sorted(data.SUMMARY_FIELDS)] * 2)
+        self.assertNotEqual(summary['ETag'], self.list(page_size=2)['ETag'])
+
+
+def parse_sse(content):
+    """
+    Split a text/event-stream body into (event, data) pairs, checking each
+    event is an event line and a single data line closed by a blank line
+    """
+    frames = content.decode('utf-8').split('\n\n')
+    if frames.pop() != '':
+        raise AssertionError(f'Unterminated event in {content!r}')
+    events = []
+    for frame in frames:
+        event, data = frame.split('\n')
+        events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+@override_settings(EXTRACTION_CACHE={'BACKEND': ''})
+class ServerSentEventsTests(SimpleTestCase):
+
+    def test_event_framing(self):
+        payload = {'description': 'Taxi\n\nairport', 'amount': 12.5, 'note': 'café'}
+        frame = format_sse('page', payload)
+        self.assertTrue(frame.startswith(b'event: page\ndata: '))
+        self.assertEqual(parse_sse(frame), [('page', payload)])
+
+    def test_validation_error_is_an_error_event(self):
+        response = self.client.post('/api/travel-requests/generate-report/stream/', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response['Content-Type'].startswith('text/event-stream'))
+        self.assertEqual(parse_sse(response.content), [('error', {'error': 'No files provided'})])
+
+    def test_pages_stream_before_the_report(self):
+        override = override_settings(
+            AZURE_OPENAI=completion_settings(serve(self, FakeCompletionHandler)),
+            AZURE_STORAGE=storage_settings(serve(self, FakeBlobHandler))
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        for client in ('_openai_client', '_blob_client'):
+            mock.patch.object(utils, client, None).start()
+        mock.patch.object(ratelimit, '_concurrency', None).start()
+        mock.patch.multiple(FakeCompletionHandler, page_count=3, calls=[]).start()
+        mock.patch.object(FakeBlobHandler, 'blobs', {}).start()
+        mock.patch.object(utils, 'iter_pdf_pages_as_base64',
+                          lambda files: (page_image(index) for index in range(3))).start()
+        self.addCleanup(mock.patch.stopall)
+
+        pdf = SimpleUploadedFile('receipts.pdf', b'%PDF-1.4 receipts', content_type='application/pdf')
+        response = self.client.post('/api/travel-requests/generate-report/stream/', {'files': [pdf]})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = parse_sse(b''.join(response.streaming_content))
+
+        self.assertEqual([event for event, _ in events], ['page', 'page', 'page', 'done'])
+        pages = [data for _, data in events[:3]]
+        self.assertEqual(sorted(page['page'] for page in pages), [1, 2, 3])
+        # Running totals follow completion order; a page's only expense amount is its index
+        self.assertEqual([page['pages_completed'] for page in pages], [1, 2, 3])
+        self.assertEqual([page['total_amount'] for page in pages],
+                         list(itertools.accumulate(page['page'] - 1 for page in pages)))
+        self.assertEqual([expense['amount'] for expense in events[3][1]['expenses']], [0, 1, 2])
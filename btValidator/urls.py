@@ -1,12 +1,17 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import TravelRequestViewSet
+from .views import TravelRequestViewSet, metrics
 
 # Create a router and register the viewset
+if settings.ASYNC_VIEWS:
+    from .async_views import AsyncTravelRequestViewSet as TravelRequestViewSet
 router = DefaultRouter()
 router.register(r'travel-requests', TravelRequestViewSet, basename='travel-request')
 
 # Define URL patterns
+# Served under api/ because web.config only routes ^api/.* to Django
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     path('', include(router.urls)),
 ]
@@ -1,40 +1,114 @@
 # utils.py
 
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from django.conf import settings
 import uuid
 import logging
 from datetime import datetime, timedelta
 import base64
-from pdf2image import convert_from_bytes
+import binascii
+from pdf2image import pdfinfo_from_path
 import openai
-import io, json, re
+import httpx
+import asyncio
+import queue
+import threading
+import functools
+import hashlib
+import collections
+import io, json, math, os, re
+import shutil
+import subprocess
+import tempfile
+import time
+import weakref
+from .metrics import average, counter_value, increment, observe, span
+from .ratelimit import get_quota, get_concurrency, on_openai_response, aon_openai_response, parse_retry_after
+from PIL import Image
+from .cache import get_extraction_cache, make_extraction_key
+from .rendering import get_render_pool, render_pages
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever the extraction system prompt changes so cached results are not reused
+PROMPT_VERSION = '1'
 
+class PDFConversionError(Exception):
+    """Raised when an uploaded PDF cannot be rendered to images"""
+
+class ExtractionThrottledError(Exception):
+    """Raised when every page was rejected by the Azure OpenAI rate limits"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+
+def encode_cursor(continuation):
+    """
+    Wrap a Cosmos continuation token in an opaque, URL-safe cursor
+    """
+    return base64.urlsafe_b64encode(continuation.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Recover the Cosmos continuation token from a cursor returned by encode_cursor
+
+    Raises:
+        ValueError: The cursor is not valid
+    """
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+_blob_client = None
+_blob_client_lock = threading.Lock()
 
 def get_blob_client():
-    return BlobServiceClient.from_connection_string(settings.AZURE_STORAGE['CONNECTION_STRING'])
+    """
+    Return the process-wide BlobServiceClient, creating it on first use.
+    The client keeps a pooled HTTP session and is safe to share between threads.
+    """
+    global _blob_client
+    if _blob_client is None:
+        with _blob_client_lock:
+            if _blob_client is None:
+                _blob_client = BlobServiceClient.from_connection_string(
+                    settings.AZURE_STORAGE['CONNECTION_STRING'],
+                    max_single_put_size=settings.AZURE_STORAGE['MAX_SINGLE_PUT_SIZE'],
+                    max_block_size=settings.AZURE_STORAGE['MAX_BLOCK_SIZE']
+                )
+    return _blob_client
+
+def _report_blob_name(name):
+    # Unique blob name; the timestamp prefix keeps uploads ordered
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    unique_id = str(uuid.uuid4())[:8]
+    return f"{timestamp}_{unique_id}_{name}"
 
 def upload_to_blob_storage(file, container_name="reports"):
     """
     Upload a file to Azure Blob Storage and return its URL
     """
     try:
-        # Generate unique blob name
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_id = str(uuid.uuid4())[:8]
-        blob_name = f"{timestamp}_{unique_id}_{file.name}"
-        
-        # Get blob client
         blob_service_client = get_blob_client()
         container_client = blob_service_client.get_container_client(container_name)
-        blob_client = container_client.get_blob_client(blob_name)
+        blob_client = container_client.get_blob_client(_report_blob_name(file.name))
 
-        # Upload file
+        # Upload file; files above MAX_SINGLE_PUT_SIZE are sent as parallel blocks
         file.seek(0)  # Ensure we're at the start of the file
-        blob_client.upload_blob(file, overwrite=True)
+        with span('blob_upload'):
+            blob_client.upload_blob(
+                file,
+                overwrite=True,
+                max_concurrency=settings.AZURE_STORAGE['MAX_CONCURRENCY']
+            )
+        increment('blob_upload_bytes_total', file.size)
         
         return blob_client.url
 
@@ -44,33 +118,55 @@ def upload_to_blob_storage(file, container_name="reports"):
 
 def upload_multiple_files(files, container_name="reports"):
     """
-    Upload multiple files to Azure Blob Storage
-    Returns a list of dictionaries containing file information
+    Upload multiple files to Azure Blob Storage concurrently.
+    Either every file is uploaded or the ones that succeeded are deleted again.
+    Returns a list of dictionaries containing file information, in input order
     """
-    uploaded_files = []
-    
-    for file in files:
+    def upload(file):
         try:
-            file_url = upload_to_blob_storage(file, container_name)
-            uploaded_files.append({
-                'name': file.name,
-                'size': file.size,
-                'url': file_url
-            })
+            url = upload_to_blob_storage(file, container_name)
         except Exception as e:
-            # If any file fails, attempt to clean up already uploaded files
-            logger.error(f"Error during multiple file upload: {str(e)}")
-            cleanup_uploaded_files(uploaded_files)
             raise Exception(f"Failed to upload {file.name}: {str(e)}")
-    
-    return uploaded_files
+        return {'name': file.name, 'size': file.size, 'url': url}
 
-def cleanup_uploaded_files(uploaded_files):
+    return _gather_all_or_nothing(
+        [functools.partial(upload, file) for file in files], container_name, 'multiple file upload'
+    )
+
+def _completed_or_error(outcomes, action):
+    """
+    Split the outcomes of an all-or-nothing upload/copy into the file info
+    dicts that completed and the first exception, or None
+    """
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if errors:
+        logger.error(f"Error during {action}: {str(errors[0])}")
+    return [outcome for outcome in outcomes if not isinstance(outcome, Exception)], (errors[0] if errors else None)
+
+def _gather_all_or_nothing(calls, container_name, action):
+    """
+    Run the upload/copy calls concurrently (at most UPLOAD_CONCURRENCY at
+    once); if any fails, delete the blobs the others created and raise
+
+    Returns:
+        list: The calls' file info dicts, in order
+    """
+    max_workers = max(1, min(settings.AZURE_STORAGE['UPLOAD_CONCURRENCY'], len(calls)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(call) for call in calls]
+    outcomes = [future.exception() or future.result() for future in futures]
+    completed, error = _completed_or_error(outcomes, action)
+    if error:
+        cleanup_uploaded_files(completed, container_name)
+        raise Exception(str(error))
+    return outcomes
+
+def cleanup_uploaded_files(uploaded_files, container_name="reports"):
     """
     Clean up uploaded files in case of an error
     """
     blob_service_client = get_blob_client()
-    container_client = blob_service_client.get_container_client("reports")
+    container_client = blob_service_client.get_container_client(container_name)
     
     for file_info in uploaded_files:
         try:
@@ -81,6 +177,329 @@ def cleanup_uploaded_files(uploaded_files):
         except Exception as e:
             logger.error(f"Error cleaning up blob: {str(e)}")
 
+_staging_handle = re.compile(r'^[0-9a-f]{64}$')
+
+def _read_payloads(files):
+    # Read in the calling thread; upload threads and the page renderer must
+    # not share the file positions
+    payloads = []
+    for file in files:
+        file.seek(0)
+        content = file.read()
+        file.seek(0)
+        payloads.append((file, content))
+    return payloads
+
+def stage_files(files, container_name=None):
+    """
+    Stage uploaded files in blob storage so submit-report can reuse them
+    without the client sending the bytes again. Blobs are named by the
+    sha256 of their content, so the same file is only stored once; staging
+    it again refreshes its last-modified time for purge_staged_files.
+
+    Args:
+        files: List of uploaded files
+        container_name: Staging container (defaults to AZURE_STORAGE['STAGING_CONTAINER'])
+
+    Returns:
+        list: {'handle', 'name', 'size'} per file, in input order
+    """
+    return _stage_payloads(_read_payloads(files), container_name)
+
+def _staging_upload(file, content):
+    """
+    Return the staging handle of a file (the sha256 of its content) and the
+    upload_blob arguments that store it under that name
+    """
+    return hashlib.sha256(content).hexdigest(), dict(
+        data=content,
+        overwrite=False,
+        content_settings=ContentSettings(content_type=file.content_type),
+        max_concurrency=settings.AZURE_STORAGE['MAX_CONCURRENCY']
+    )
+
+def _stage_payloads(payloads, container_name=None):
+    container_client = get_blob_client().get_container_client(
+        container_name or settings.AZURE_STORAGE['STAGING_CONTAINER']
+    )
+
+    def stage(file, content):
+        handle, upload = _staging_upload(file, content)
+        blob_client = container_client.get_blob_client(handle)
+        try:
+            blob_client.upload_blob(**upload)
+            increment('blob_upload_bytes_total', len(content))
+        except ResourceExistsError:
+            # Already staged; touch it so it is not purged while in use
+            blob_client.set_blob_metadata({'staged': '1'})
+        return {'handle': handle, 'name': file.name, 'size': len(content)}
+
+    max_workers = max(1, min(settings.AZURE_STORAGE['UPLOAD_CONCURRENCY'], len(payloads)))
+    with span('blob_stage'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda payload: stage(*payload), payloads))
+
+def try_stage_files(files):
+    """
+    Stage files for submit-report, returning None instead of raising when
+    staging fails; the client then falls back to uploading the files again
+    """
+    return _try_stage_payloads(_read_payloads(files))
+
+def _try_stage_payloads(payloads):
+    try:
+        return _stage_payloads(payloads)
+    except Exception as e:
+        logger.warning(f"Could not stage report files: {str(e)}")
+        return None
+
+def start_staging_files(files):
+    """
+    Start try_stage_files on a background thread so staging overlaps the
+    extraction. The files are read before this returns, so the caller can
+    render them straight away.
+
+    Returns:
+        concurrent.futures.Future: Resolves to the try_stage_files result
+    """
+    payloads = _read_payloads(files)
+    future = Future()
+    threading.Thread(target=lambda: future.set_result(_try_stage_payloads(payloads)), daemon=True).start()
+    return future
+
+def promote_staged_files(staged_files, container_name="reports"):
+    """
+    Copy staged files into the reports container with a server-side blob copy.
+    Either every file is promoted or the copies already made are deleted again.
+
+    Args:
+        staged_files: List of {'handle', 'name'} returned by generate-report
+        container_name: Destination container
+
+    Returns:
+        list: {'name', 'size', 'url'} per file, in input order, like upload_multiple_files
+    """
+    blob_service_client = get_blob_client()
+    staging_client = blob_service_client.get_container_client(settings.AZURE_STORAGE['STAGING_CONTAINER'])
+    container_client = blob_service_client.get_container_client(container_name)
+    _check_staged_handles(staged_files)
+
+    def promote(staged):
+        try:
+            source = staging_client.get_blob_client(staged['handle'])
+            try:
+                size = source.get_blob_properties().size
+            except ResourceNotFoundError:
+                raise Exception(f"Staged file {staged['name']} has expired, please upload it again")
+
+            blob_client = container_client.get_blob_client(_report_blob_name(staged['name']))
+            with span('blob_copy'):
+                copy_status = blob_client.start_copy_from_url(source.url)['copy_status']
+                # Copies within one account normally complete immediately
+                while copy_status == 'pending':
+                    time.sleep(0.2)
+                    copy_status = blob_client.get_blob_properties().copy.status
+            if copy_status != 'success':
+                raise Exception(f"Copy of {staged['name']} ended with status {copy_status}")
+            return {'name': staged['name'], 'size': size, 'url': blob_client.url}
+        except Exception as e:
+            raise Exception(f"Failed to promote {staged['name']}: {str(e)}")
+
+    return _gather_all_or_nothing(
+        [functools.partial(promote, staged) for staged in staged_files], container_name, 'staged file promotion'
+    )
+
+def _check_staged_handles(staged_files):
+    """
+    Raises:
+        ValueError: A handle is not one generate-report returned
+    """
+    for staged in staged_files:
+        if not _staging_handle.match(str(staged.get('handle', ''))):
+            raise ValueError(f"Invalid staged file handle: {staged.get('handle')}")
+
+def purge_staged_files(max_age=None):
+    """
+    Delete staged files that were not used within max_age seconds
+
+    Args:
+        max_age: Age in seconds (defaults to AZURE_STORAGE['STAGING_TTL'])
+
+    Returns:
+        int: Number of blobs deleted
+    """
+    max_age = settings.AZURE_STORAGE['STAGING_TTL'] if max_age is None else max_age
+    cutoff = datetime.now().astimezone() - timedelta(seconds=max_age)
+    container_client = get_blob_client().get_container_client(settings.AZURE_STORAGE['STAGING_CONTAINER'])
+    deleted = 0
+    for blob in container_client.list_blobs():
+        if blob.last_modified < cutoff:
+            try:
+                container_client.delete_blob(blob.name)
+                deleted += 1
+            except ResourceNotFoundError:
+                pass
+    return deleted
+
+class TextPage(str):
+    """
+    A page whose embedded text layer is sent to the model instead of an image
+    """
+
+def extract_text_layer(pdf_path):
+    """
+    Extract the embedded text of every page with poppler's pdftotext
+
+    Args:
+        pdf_path: Path of the PDF (the spooled copy, which is closed)
+
+    Returns:
+        list: Text per page, or an empty list if the text layer could not be read
+    """
+    try:
+        result = subprocess.run(
+            ['pdftotext', '-layout', '-enc', 'UTF-8', pdf_path, '-'],
+            capture_output=True,
+            timeout=settings.PDF_PROCESSING['TEXT_TIMEOUT'],
+            check=True
+        )
+        # pdftotext ends every page with a form feed
+        return result.stdout.decode('utf-8', errors='replace').split('\f')[:-1]
+    except Exception as e:
+        logger.warning(f"Could not read PDF text layer: {str(e)}")
+        return []
+
+def _plan_pdf_pages(pdf_path, pdf_name, window):
+    """
+    Split a spooled PDF into text-layer pages and runs of at most `window` image pages
+
+    Returns:
+        list: ('text', TextPage) or ('render', first_page, last_page) in page order
+    """
+    min_chars = settings.PDF_PROCESSING['TEXT_MIN_CHARS']
+    page_count = pdfinfo_from_path(pdf_path)['Pages']
+
+    texts = []
+    if settings.PDF_PROCESSING['TEXT_LAYER']:
+        with span('pdf_text_layer'):
+            texts = extract_text_layer(pdf_path)
+    is_text = [
+        index < len(texts) and len(texts[index].strip()) >= min_chars
+        for index in range(page_count)
+    ]
+    if any(is_text):
+        logger.info(f"{sum(is_text)} of {page_count} pages in {pdf_name} use the text layer")
+
+    plan = []
+    first_page = 1
+    while first_page <= page_count:
+        if is_text[first_page - 1]:
+            plan.append(('text', TextPage(texts[first_page - 1])))
+            first_page += 1
+            continue
+
+        # The next run of image pages, up to the window size
+        last_page = first_page
+        while (last_page < page_count and last_page - first_page + 1 < window
+               and not is_text[last_page]):
+            last_page += 1
+        plan.append(('render', first_page, last_page))
+        first_page = last_page + 1
+    return plan
+
+def _text_layer_seconds_saved():
+    """
+    Estimate the seconds a text-layer page saves: what an image page costs this
+    process to render and extract, less what a text page costs to extract.
+    PDF_PROCESSING['IMAGE_PAGE_SECONDS'] stands in until image pages were measured.
+    """
+    image_pages = counter_value('pdf_pages_total', path='image')
+    image_extraction = average('page_extraction', path='image')
+    if image_pages and image_extraction is not None:
+        image_seconds = counter_value('pdf_render_seconds_sum') / image_pages + image_extraction
+    else:
+        image_seconds = settings.PDF_PROCESSING['IMAGE_PAGE_SECONDS']
+    return max(0.0, image_seconds - (average('page_extraction', path='text') or 0.0))
+
+def iter_pdf_pages_as_base64(pdf_files, window=None):
+    """
+    Render PDF pages lazily, a small window of pages at a time
+    
+    Each PDF is spooled to a temporary file and pdftoppm renders page windows
+    straight to JPEG, which are base64 encoded without going through PIL. With
+    PDF_PROCESSING['WORKERS'] set, windows from every file are rendered in a
+    process pool, at most WORKERS windows ahead of the consumer, so CPU work
+    runs on several cores instead of holding this worker's GIL. When
+    PDF_PROCESSING['TEXT_LAYER'] is enabled, pages whose embedded text has at
+    least TEXT_MIN_CHARS characters are not rendered and are yielded as
+    TextPage instead.
+    
+    Args:
+        pdf_files: List of uploaded PDF files
+        window: Number of pages rendered per pdftoppm call
+            (defaults to PDF_PROCESSING['RENDER_WINDOW'])
+        
+    Yields:
+        str: Base64 encoded JPEG (or TextPage) for each page, in document order
+    """
+    window = max(1, window or settings.PDF_PROCESSING['RENDER_WINDOW'])
+    thread_count = settings.PDF_PROCESSING['RENDER_THREADS']
+    pool = get_render_pool()
+    ahead = settings.PDF_PROCESSING['WORKERS'] if pool else 0
+    pending = collections.deque()
+
+    def rendered(result):
+        pages, seconds = result
+        observe('pdf_render', seconds)
+        increment('pdf_pages_total', len(pages), path='image')
+        return [page.decode('ascii') for page in pages]
+
+    def drain(keep):
+        # Yield finished work in document order until at most `keep` windows are pending
+        while len(pending) > keep:
+            kind, work = pending.popleft()
+            if kind == 'text':
+                increment('pdf_pages_total', path='text')
+                increment('text_layer_seconds_saved_total', _text_layer_seconds_saved())
+                yield work
+            else:
+                with span('pdf_render_wait'):
+                    pages = rendered(work.result())
+                yield from pages
+
+    try:
+        with tempfile.TemporaryDirectory() as spool_dir:
+            for file_index, pdf_file in enumerate(pdf_files):
+                # pdfinfo, pdftotext and pdftoppm all read this one spooled copy
+                pdf_path = os.path.join(spool_dir, f'{file_index}.pdf')
+                with open(pdf_path, 'wb') as spooled:
+                    shutil.copyfileobj(pdf_file, spooled)
+
+                for step in _plan_pdf_pages(pdf_path, pdf_file.name, window):
+                    if step[0] == 'text':
+                        pending.append(step)
+                    elif pool:
+                        pending.append(('render', pool.submit(render_pages, pdf_path, step[1], step[2], thread_count)))
+                    else:
+                        # rendered() records pdf_render; no span, which would record it twice
+                        pages = rendered(render_pages(pdf_path, step[1], step[2], thread_count))
+                        yield from drain(0)
+                        yield from pages
+                        continue
+                    yield from drain(ahead)
+
+                # Reset file pointer for potential future use
+                pdf_file.seek(0)
+            yield from drain(0)
+
+    except Exception as e:
+        logger.error(f"Error converting PDFs to images: {str(e)}")
+        raise PDFConversionError(f"Failed to convert PDFs to images: {str(e)}")
+    finally:
+        # The consumer stopped early or rendering failed; drop queued windows
+        for kind, work in pending:
+            if kind == 'render':
+                work.cancel()
+
 def convert_pdfs_to_base64_images(pdf_files):
     """
     Convert multiple PDF files to base64 encoded images
@@ -91,108 +510,561 @@ def convert_pdfs_to_base64_images(pdf_files):
     Returns:
         list: List of base64 encoded images from all PDFs
     """
+    return list(iter_pdf_pages_as_base64(pdf_files))
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """
+    Return the process-wide AzureOpenAI client, creating it on first use.
+    The client owns a keep-alive httpx pool and is safe to share between threads.
+    """
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                config = settings.AZURE_OPENAI
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=config['POOL_SIZE'],
+                        max_keepalive_connections=config['POOL_SIZE'],
+                        keepalive_expiry=config['KEEPALIVE_EXPIRY']
+                    ),
+                    timeout=httpx.Timeout(config['TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+                    event_hooks={'response': [on_openai_response]}
+                )
+                # The SDK retries 408/429/5xx and connection errors with exponential backoff
+                _openai_client = openai.AzureOpenAI(
+                    api_key=config['KEY'],
+                    azure_deployment=config['DEPLOYMENT'],
+                    api_version=config['API_VERSION'],
+                    azure_endpoint=config['ENDPOINT'],
+                    max_retries=config['MAX_RETRIES'],
+                    http_client=http_client
+                )
+    return _openai_client
+
+def _create_completion(client, estimated_tokens, kwargs):
+    """
+    Create a chat completion within the shared RPM/TPM quota and the adaptive
+    concurrency limit, then settle the token bucket with the actual usage
+    """
+    quota = get_quota()
+    if quota:
+        with span('openai_quota_wait'):
+            quota.acquire(requests=1, tokens=estimated_tokens)
+    concurrency = get_concurrency()
+    with span('openai_concurrency_wait'):
+        concurrency.acquire()
     try:
-        all_base64_images = []
-        
-        for pdf_file in pdf_files:
-            # Read PDF content
-            pdf_content = pdf_file.read()
-            
-            # Convert PDF pages to images
-            images = convert_from_bytes(pdf_content)
-            
-            # Convert each image to base64
-            for image in images:
-                # Convert PIL image to bytes
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='JPEG', quality=85)  # Reduced quality for better performance
-                img_byte_arr = img_byte_arr.getvalue()
-                
-                # Convert to base64
-                base64_image = base64.b64encode(img_byte_arr).decode('utf-8')
-                all_base64_images.append(base64_image)
-                
-            # Reset file pointer for potential future use
-            pdf_file.seek(0)
-            
-        return all_base64_images
-        
+        with span('openai_completion'):
+            response = client.chat.completions.create(**kwargs)
+    finally:
+        concurrency.release()
+    _record_usage(response, quota, estimated_tokens)
+    return response
+
+def _record_usage(response, quota, estimated_tokens):
+    """
+    Count the tokens a completion used and settle the token bucket
+    """
+    if response.usage:
+        increment('openai_tokens_total', response.usage.prompt_tokens, kind='prompt')
+        increment('openai_tokens_total', response.usage.completion_tokens, kind='completion')
+        if quota:
+            quota.adjust(response.usage.total_tokens - estimated_tokens)
+
+def _estimate_request_tokens(system_message, pages, max_tokens):
+    prompt_tokens = sum(len(part['text']) // 4 for part in system_message['content'])
+    return prompt_tokens + sum(estimate_image_tokens(page) for page in pages) + max_tokens
+
+def _page_content(page):
+    """
+    Build the user message part for a page: its text layer or its image
+    """
+    if isinstance(page, TextPage):
+        return {"type": "text", "text": f"Page text:\n{page}"}
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{page}"
+        }
+    }
+
+def to_strict_schema(schema):
+    """
+    Adapt a JSON schema to the subset accepted by structured outputs strict mode:
+    every object lists all its properties as required, forbids additional
+    properties, and unsupported keywords such as 'format' are dropped. Every
+    property is made nullable since the prompt asks for null when a value is missing.
+    """
+    if not isinstance(schema, dict):
+        return schema
+    strict = {key: to_strict_schema(value) for key, value in schema.items()
+              if key not in ('format', 'properties')}
+    if 'properties' in schema:
+        properties = {}
+        for name, prop in schema['properties'].items():
+            prop = to_strict_schema(prop)
+            if isinstance(prop.get('type'), str):
+                prop['type'] = [prop['type'], 'null']
+            properties[name] = prop
+        strict['properties'] = properties
+        strict['required'] = list(properties)
+        strict['additionalProperties'] = False
+    return strict
+
+@functools.lru_cache(maxsize=8)
+def _structured_format(schema, batch=False):
+    """
+    Build the response_format for structured outputs, or None when disabled.
+    Strict mode needs an object at the top level, so the schema is wrapped in
+    {"result": ...}; batches return {"result": [{"page": n, "result": ...}]}.
+    """
+    if not settings.AZURE_OPENAI['STRUCTURED_OUTPUTS']:
+        return None
+    result = to_strict_schema(json.loads(schema))
+    if batch:
+        result = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"page": {"type": "integer"}, "result": result},
+                "required": ["page", "result"],
+                "additionalProperties": False
+            }
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "batch_extraction" if batch else "page_extraction",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"result": result},
+                "required": ["result"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+def _structured_result(message):
+    """
+    Return the 'result' of a structured output message. There is no heuristic
+    recovery: a refusal or a truncated answer fails the page.
+    """
+    if getattr(message, 'refusal', None):
+        raise ValueError(f"Model refused to extract the page: {message.refusal}")
+    return json.loads(message.content)['result']
+
+def _page_request(system_message, base64_image, schema):
+    """
+    Build the completion arguments for a single page
+
+    Returns:
+        tuple: (estimated tokens, keyword arguments for chat.completions.create)
+    """
+    response_format = _structured_format(schema)
+    options = {'response_format': response_format} if response_format else {}
+    return _estimate_request_tokens(system_message, [base64_image], 2500), dict(
+        model="gpt4o",
+        messages=[
+            system_message,
+            {
+                "role": "user",
+                "content": [_page_content(base64_image)]
+            }
+        ],
+        max_tokens=2500,
+        temperature=0.1,
+        **options
+    )
+
+def _page_result(response, schema):
+    """
+    Return the raw message content of a single page completion
+    (with structured outputs, the page's JSON result)
+    """
+    if _structured_format(schema):
+        return json.dumps(_structured_result(response.choices[0].message))
+    return response.choices[0].message.content
+
+def _extract_page(client, system_message, base64_image, schema):
+    """
+    Send a single page image to the model and return the raw message content
+    (with structured outputs, the page's JSON result)
+    """
+    path = 'text' if isinstance(base64_image, TextPage) else 'image'
+    start = time.perf_counter()
+    response = _create_completion(client, *_page_request(system_message, base64_image, schema))
+    observe('page_extraction', time.perf_counter() - start, path=path)
+    return _page_result(response, schema)
+
+_schema_types = {'array': list, 'object': dict}
+
+@functools.lru_cache(maxsize=8)
+def _schema_type(schema):
+    return _schema_types.get(json.loads(schema).get('type'))
+
+def _cache_extraction(cache, key, content, schema):
+    """
+    Store a page extraction unless it does not parse to the schema's top-level
+    type, so a re-upload after a bad answer asks the model again
+    """
+    expected = _schema_type(schema)
+    if expected is not None and not isinstance(extract_json_from_text(content), expected):
+        increment('extraction_cache_rejected_total')
+        return
+    cache.set(key, content)
+
+def _extract_page_cached(client, system_message, base64_image, schema):
+    """
+    Return the extraction for a page from the cache, calling the model on a miss
+    """
+    cache = get_extraction_cache()
+    if cache is None:
+        return _extract_page(client, system_message, base64_image, schema)
+
+    key = make_extraction_key(base64_image, schema, PROMPT_VERSION)
+    content = cache.get(key)
+    if content is None:
+        content = _extract_page(client, system_message, base64_image, schema)
+        _cache_extraction(cache, key, content, schema)
+    return content
+
+def estimate_image_tokens(base64_image):
+    """
+    Estimate the prompt tokens a high-detail image costs: the image is scaled to
+    fit 2048x2048, then its shortest side to 768px, and billed 170 tokens per
+    512px tile plus 85 base tokens. A TextPage is estimated at four characters
+    per token.
+    """
+    if isinstance(base64_image, TextPage):
+        return len(base64_image) // 4
+    width, height = Image.open(io.BytesIO(base64.b64decode(base64_image))).size
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+def _iter_batches(base64_images):
+    """
+    Group (index, page) pairs into batches of at most AZURE_OPENAI['BATCH_PAGES']
+    pages whose estimated image tokens stay within BATCH_TOKEN_BUDGET
+    """
+    max_pages = max(1, settings.AZURE_OPENAI['BATCH_PAGES'])
+    budget = settings.AZURE_OPENAI['BATCH_TOKEN_BUDGET']
+    batch, tokens = [], 0
+    for index, base64_image in enumerate(base64_images):
+        cost = estimate_image_tokens(base64_image) if max_pages > 1 else 0
+        if batch and (len(batch) >= max_pages or tokens + cost > budget):
+            yield batch
+            batch, tokens = [], 0
+        batch.append((index, base64_image))
+        tokens += cost
+    if batch:
+        yield batch
+
+def _pages_request(system_message, base64_images, schema):
+    """
+    Build the completion arguments for several pages in one call
+
+    Returns:
+        tuple: (estimated tokens, keyword arguments for chat.completions.create)
+    """
+    response_format = _structured_format(schema, batch=True)
+    if response_format:
+        instructions = "Return the data extracted from each page together with its page number."
+        options = {'response_format': response_format}
+    else:
+        instructions = (
+            "Return a single JSON object whose keys are the page numbers as strings and whose "
+            "values are the data extracted from that page, following the schema."
+        )
+        options = {}
+    content = [{
+        "type": "text",
+        "text": (
+            f"The following {len(base64_images)} parts are separate pages, numbered 1 to "
+            f"{len(base64_images)} in order. {instructions}"
+        )
+    }]
+    content.extend(_page_content(base64_image) for base64_image in base64_images)
+    max_tokens = min(2500 * len(base64_images), 16000)
+    return _estimate_request_tokens(system_message, base64_images, max_tokens), dict(
+        model="gpt4o",
+        messages=[system_message, {"role": "user", "content": content}],
+        max_tokens=max_tokens,
+        temperature=0.1,
+        **options
+    )
+
+def _pages_result(response, page_count, schema):
+    """
+    Split a multi-page completion into one JSON string per page
+
+    Returns:
+        list: One JSON string per page, or None if the response could not be
+            mapped back to every page (including a refusal)
+    """
+    if _structured_format(schema, batch=True):
+        try:
+            by_page = {str(page['page']): page['result'] for page in _structured_result(response.choices[0].message)}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Could not parse batched extraction: {str(e)}")
+            return None
+    else:
+        by_page = extract_json_from_text(response.choices[0].message.content)
+    if not isinstance(by_page, dict):
+        return None
+    pages = [by_page.get(str(number)) for number in range(1, page_count + 1)]
+    if any(page is None for page in pages):
+        return None
+    return [json.dumps(page) for page in pages]
+
+def _extract_pages(client, system_message, base64_images, schema):
+    """
+    Send several page images in one completion and split the answer per page
+
+    Returns:
+        list: One JSON string per page, or None if the response could not be
+            mapped back to every page
+    """
+    start = time.perf_counter()
+    response = _create_completion(client, *_pages_request(system_message, base64_images, schema))
+    observe('page_extraction', time.perf_counter() - start, path='batch')
+    return _pages_result(response, len(base64_images), schema)
+
+def _cached_batch(cache, batch, schema):
+    """
+    Look up the pages of a batch in the extraction cache
+
+    Returns:
+        tuple: (cache keys, responses aligned with the batch; None for a miss)
+    """
+    keys = [make_extraction_key(base64_image, schema, PROMPT_VERSION) for _, base64_image in batch]
+    if cache is None:
+        return keys, [None] * len(keys)
+    return keys, [cache.get(key) for key in keys]
+
+def _merge_batch(cache, keys, responses, missing, by_page, schema):
+    """
+    Fill the pages that missed the cache from a batched answer and cache them.
+    by_page is None when the answer could not be split per page; the pages
+    are then left for single-page calls.
+    """
+    if by_page is None:
+        logger.warning(f"Falling back to single-page extraction for {len(missing)} pages")
+        return
+    for position, response in zip(missing, by_page):
+        responses[position] = response
+        if cache is not None:
+            _cache_extraction(cache, keys[position], response, schema)
+
+def _extract_batch(client, system_message, batch, schema):
+    """
+    Extract a batch of (index, page) pairs, using the cache per page and one
+    model call for the pages that missed. Falls back to single-page calls when
+    the batched response cannot be parsed.
+
+    Returns:
+        list: Responses aligned with the batch; a page that failed is None
+    """
+    if len(batch) == 1:
+        return [_extract_page_cached(client, system_message, batch[0][1], schema)]
+
+    cache = get_extraction_cache()
+    keys, responses = _cached_batch(cache, batch, schema)
+    missing = [position for position, response in enumerate(responses) if response is None]
+    if len(missing) > 1:
+        # API errors (throttling, timeouts, 5xx) fail the batch; only an answer
+        # that cannot be split per page falls back to single-page calls
+        by_page = _extract_pages(client, system_message, [batch[position][1] for position in missing], schema)
+        _merge_batch(cache, keys, responses, missing, by_page, schema)
+
+    for position, (index, base64_image) in enumerate(batch):
+        if responses[position] is None:
+            try:
+                responses[position] = _extract_page_cached(client, system_message, base64_image, schema)
+            except openai.RateLimitError:
+                # Fail the batch so the caller records the throttling and its Retry-After
+                raise
+            except Exception as e:
+                # Isolate the failure to this page so the others are kept
+                logger.error(f"Error extracting page {index + 1}: {str(e)}")
+    return responses
+
+def _collect_batch(batch, outcome, results, throttled, on_page):
+    """
+    Record the responses of a finished batch; outcome() returns them or raises
+    """
+    try:
+        responses = outcome()
     except Exception as e:
-        logger.error(f"Error converting PDFs to images: {str(e)}")
-        raise Exception(f"Failed to convert PDFs to images: {str(e)}")
+        # Isolate the failure to this batch so the other pages are kept
+        logger.error(f"Error extracting pages {[index + 1 for index, _ in batch]}: {str(e)}")
+        if isinstance(e, openai.RateLimitError):
+            throttled.append(e)
+        responses = [None] * len(batch)
+    for (index, _), response in zip(batch, responses):
+        results[index] = response
+        if on_page:
+            on_page(index, response)
 
-def call_openai_api(base64_images, schema):
+def _system_message(schema):
+    """
+    Create the system message with the extraction schema
     """
-    Call OpenAI API to extract information from images according to provided schema
+    return {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": (
+                    "You are an AI assistant that extracts information from travel reports "
+                    "and maps it to a specific JSON schema. Return only the JSON data without "
+                    "any additional explanations. If you can't find specific information, use null "
+                    f"for that field. Here is the schema to follow: {schema}"
+                )
+            }
+        ]
+    }
+
+def _ordered_responses(results, throttled):
+    """
+    Return the responses in page order, raising when every page failed
+
+    Args:
+        results: {page index: response or None}
+        throttled: RateLimitErrors raised while extracting
+    """
+    all_responses = [results[index] for index in range(len(results))]
+    if all_responses and all(response is None for response in all_responses):
+        if throttled:
+            retry_after = parse_retry_after(throttled[-1].response.headers)
+            raise ExtractionThrottledError("Azure OpenAI quota exceeded", retry_after)
+        raise Exception("All pages failed to process")
+
+    # Return all responses
+    return all_responses
+
+def call_openai_api(base64_images, schema, on_page=None):
+    """
+    Call OpenAI API to extract information from images according to provided schema.
+    Pages are sent concurrently, bounded by AZURE_OPENAI['MAX_CONCURRENCY'], and
+    grouped into multi-page calls when AZURE_OPENAI['BATCH_PAGES'] is above 1.
     
     Args:
-        base64_images: List of base64 encoded images
+        base64_images: Iterable of base64 encoded images; a generator such as
+            iter_pdf_pages_as_base64 is consumed as pages become available
         schema: JSON schema defining the structure of information to extract
+        on_page: Optional callback on_page(index, response) invoked from the calling
+            thread as each page completes; response is None if the page failed
         
     Returns:
-        str: JSON string containing extracted information
+        list: Model responses in page order; a page that failed is None
     """
     try:
-        client = openai.AzureOpenAI(
-            api_key=settings.AZURE_OPENAI['KEY'],
-            azure_deployment=settings.AZURE_OPENAI['DEPLOYMENT'],
-            api_version=settings.AZURE_OPENAI['API_VERSION'],
-            azure_endpoint=settings.AZURE_OPENAI['ENDPOINT']
-        )
-        # Create system message with schema
-        system_message = {
-            "role": "system",
-            "content": [
-                {
-                    "type": "text",
-                    "text": (
-                        "You are an AI assistant that extracts information from travel reports "
-                        "and maps it to a specific JSON schema. Return only the JSON data without "
-                        "any additional explanations. If you can't find specific information, use null "
-                        f"for that field. Here is the schema to follow: {schema}"
-                    )
-                }
-            ]
-        }
+        client = get_openai_client()
+        system_message = _system_message(schema)
 
-        # Process each image
-        all_responses = []
-        for base64_image in base64_images:
-            response = client.chat.completions.create(
-                model="gpt4o",
-                messages=[
-                    system_message,
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=2500,
-                temperature=0.1
-            )
+        # Process batches in parallel as pages are rendered, keeping results in page order.
+        # At most max_workers batches are in flight, which also throttles rendering.
+        results = {}
+        pending = {}
+        throttled = []
+        max_workers = max(1, settings.AZURE_OPENAI['MAX_CONCURRENCY'])
+
+        def collect(done):
+            for future in done:
+                _collect_batch(pending.pop(future), future.result, results, throttled, on_page)
 
-            print(response.choices[0].message.content)
-            
-            all_responses.append(response.choices[0].message.content)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in _iter_batches(base64_images):
+                if len(pending) >= max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(_extract_batch, client, system_message, batch, schema)] = batch
+            collect(wait(pending)[0])
 
-        # Return all responses
-        return all_responses
+        return _ordered_responses(results, throttled)
 
+    except (PDFConversionError, ExtractionThrottledError):
+        raise
     except Exception as e:
         logger.error(f"Error calling OpenAI API: {str(e)}")
         raise Exception(f"Failed to process images with OpenAI: {str(e)}")
     
+_json_decoder = json.JSONDecoder()
+# Brackets and the quotes that open string literals inside them
+_json_token = re.compile(r'[\[\]{}"]')
+_json_string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_json_closers = {'[': ']', '{': '}'}
+_invalid_json = object()
+# Rescans past a candidate that never closes or closes with the wrong
+# bracket (e.g. a stray '[' in prose); bounded so the scan stays linear
+_JSON_RESCANS = 3
+
+def _loads_or_invalid(text):
+    try:
+        return json.loads(text)
+    except (ValueError, RecursionError):
+        # RecursionError: nesting deeper than the C scanner allows
+        return _invalid_json
+
+def _scan_json(text, position, rescan):
+    """
+    Return (first top-level value from position that parses, or
+    _invalid_json; start of the candidate to rescan past, or None).
+    Without rescan, a candidate closed by the wrong bracket is dropped and
+    the scan continues after it.
+    """
+    stack = []
+    start = position
+    match = _json_token.search(text, position)
+    while match:
+        char = match.group()
+        position = match.end()
+        if char == '"':
+            # Quotes only delimit strings inside a candidate; prose quotes are ignored
+            if stack:
+                string = _json_string.match(text, match.start())
+                if string is None:
+                    # Unterminated string: no later bracket can close the candidate
+                    break
+                position = string.end()
+        elif char in _json_closers:
+            if not stack:
+                start = match.start()
+                # The decoder stops at the first error, which lies inside this
+                # candidate, so a failed attempt costs no more than the scan past it
+                try:
+                    return _json_decoder.raw_decode(text, start)[0], None
+                except (ValueError, RecursionError):
+                    pass
+            stack.append(char)
+        elif stack:
+            if _json_closers[stack.pop()] != char:
+                if rescan:
+                    return _invalid_json, start
+                stack.clear()
+        match = _json_token.search(text, position)
+    return _invalid_json, start if stack else None
+
 def extract_json_from_text(text):
     """
     Robustly extract JSON from text that might contain markdown or other content.
-    Searches for valid JSON arrays or objects in the text.
+    Returns the first complete, outermost JSON array or object in the text.
+    
+    The text is scanned from left to right. At each top-level '{' or '['
+    the C JSON scanner (raw_decode) parses the value in place; when that
+    fails, the brackets of the candidate are matched (skipping string
+    literals) and the scan resumes after it, so no span is parsed twice.
+    A bracket that never closes or is closed by the wrong one is rescanned
+    past at most a few times, so the work stays linear in the text length.
     
     Args:
         text (str): Text that might contain JSON content
@@ -211,67 +1083,507 @@ def extract_json_from_text(text):
     if not text or not isinstance(text, str):
         return None
 
+    # Fast path: the whole response is JSON
+    value = _loads_or_invalid(text)
+    if value is not _invalid_json:
+        return value
+
+    position = 0
+    for rescans_left in range(_JSON_RESCANS, -1, -1):
+        value, unclosed = _scan_json(text, position, rescans_left > 0)
+        if value is not _invalid_json:
+            return value
+        if unclosed is None:
+            break
+        position = unclosed + 1
+
+    logger.warning(f"Could not extract valid JSON from text: {text[:100]}...")
+    return None
+
+# Schema for expense extraction
+EXPENSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "date": {
+                "type": "string",
+                "format": "date",
+                "description": "Date of the expense (YYYY-MM-DD)"
+            },
+            "category": {
+                "type": "string",
+                "description": "Category of expense (e.g., Transportation, Accommodation, Meals)"
+            },
+            "description": {
+                "type": "string",
+                "description": "Detailed description of the expense"
+            },
+            "amount": {
+                "type": "number",
+                "description": "Amount of the expense"
+            }
+        },
+        "required": ["date", "category", "description", "amount"]
+    }
+}
+
+def parse_expenses(response):
+    """
+    Parse a single page response into a list of expenses
+
+    Returns:
+        list: Extracted expenses, empty if the response could not be parsed
+    """
+    with span('json_parse'):
+        expenses = extract_json_from_text(response)
+    return expenses if isinstance(expenses, list) else []
+
+def expenses_total(expenses):
+    """
+    Sum the expense amounts, ignoring missing or null amounts
+    """
+    return sum(
+        expense['amount'] for expense in expenses
+        if isinstance(expense, dict) and isinstance(expense.get('amount'), (int, float))
+    )
+
+def build_report_data(files, expenses, staged_files=None):
+    """
+    Build the generate-report payload from the uploaded files and extracted expenses.
+    When the files were staged, each entry carries the handle submit-report accepts
+    in place of the file itself.
+    """
+    # Store file information for later upload
+    file_info = [{
+        'name': file.name,
+        'size': file.size,
+        'content_type': file.content_type
+    } for file in files]
+    for info, staged in zip(file_info, staged_files or []):
+        info['handle'] = staged['handle']
+
+    # Prepare response with dummy data and extracted expenses
+    return {
+        'requester': 'John Doe',
+        'department': 'Engineering',
+        'position': 'Software Engineer',
+        'start_date': '2024-01-15',
+        'end_date': '2024-01-20',
+        'total_amount': expenses_total(expenses),
+        'expenses': expenses,
+        'files': file_info
+    }
+
+def _page_event(state, index, response):
+    # 'page' event for a completed page, updating the running totals in state
+    expenses = parse_expenses(response)
+    state['total_amount'] += expenses_total(expenses)
+    state['pages_completed'] += 1
+    return ('page', {
+        'page': index + 1,
+        'failed': response is None,
+        'expenses': expenses,
+        'total_amount': state['total_amount'],
+        'pages_completed': state['pages_completed']
+    })
+
+def _error_event(e):
+    if isinstance(e, PDFConversionError):
+        return ('error', {'error': f'Error processing PDF files: {str(e)}'})
+    return ('error', {'error': f'Error extracting information: {str(e)}'})
+
+def stream_expense_report(files):
+    """
+    Extract expenses page by page, yielding events as soon as each page completes
+
+    Extraction runs on a background thread; pages may finish out of order.
+
+    Yields:
+        tuple: (event, data) where event is 'page' with the page's expenses and
+            the running total, 'done' with the full report payload, or 'error'
+    """
+    events = queue.Queue()
+    state = {'total_amount': 0, 'pages_completed': 0}
+
+    def run():
+        try:
+            staging = start_staging_files(files)
+            responses = call_openai_api(
+                iter_pdf_pages_as_base64(files), json.dumps(EXPENSE_SCHEMA),
+                on_page=lambda index, response: events.put(_page_event(state, index, response))
+            )
+            all_expenses = []
+            for response in responses:
+                all_expenses.extend(parse_expenses(response))
+            events.put(('done', build_report_data(files, all_expenses, staging.result())))
+        except Exception as e:
+            events.put(_error_event(e))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event, data = events.get()
+        yield event, data
+        if event in ('done', 'error'):
+            return
+
+# Async variants of the storage and extraction helpers, used by the ASGI views
+
+_async_clients = weakref.WeakKeyDictionary()
+
+def loop_client(name, factory):
+    """
+    Return the async client `name` bound to the running event loop, creating
+    it with factory() on first use. Async clients own connections tied to one
+    loop, so each loop (one per uvicorn worker) gets its own.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+def get_async_blob_client():
+    """
+    Return the async BlobServiceClient for the running event loop
+    """
+    return loop_client('blob', lambda: AsyncBlobServiceClient.from_connection_string(
+        settings.AZURE_STORAGE['CONNECTION_STRING'],
+        max_single_put_size=settings.AZURE_STORAGE['MAX_SINGLE_PUT_SIZE'],
+        max_block_size=settings.AZURE_STORAGE['MAX_BLOCK_SIZE']
+    ))
+
+def get_async_openai_client():
+    """
+    Return the AsyncAzureOpenAI client for the running event loop
+    """
+    def create():
+        config = settings.AZURE_OPENAI
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config['POOL_SIZE'],
+                max_keepalive_connections=config['POOL_SIZE'],
+                keepalive_expiry=config['KEEPALIVE_EXPIRY']
+            ),
+            timeout=httpx.Timeout(config['TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+            event_hooks={'response': [aon_openai_response]}
+        )
+        return openai.AsyncAzureOpenAI(
+            api_key=config['KEY'],
+            azure_deployment=config['DEPLOYMENT'],
+            api_version=config['API_VERSION'],
+            azure_endpoint=config['ENDPOINT'],
+            max_retries=config['MAX_RETRIES'],
+            http_client=http_client
+        )
+    return loop_client('openai', create)
+
+async def aupload_to_blob_storage(file, container_name="reports"):
+    """
+    Async variant of upload_to_blob_storage
+    """
     try:
-        # First try: direct JSON parsing
+        blob_client = get_async_blob_client().get_blob_client(container_name, _report_blob_name(file.name))
+        file.seek(0)  # Ensure we're at the start of the file
+        content = await asyncio.to_thread(file.read)
+        with span('blob_upload'):
+            await blob_client.upload_blob(
+                content,
+                overwrite=True,
+                max_concurrency=settings.AZURE_STORAGE['MAX_CONCURRENCY']
+            )
+        increment('blob_upload_bytes_total', file.size)
+        return blob_client.url
+
+    except Exception as e:
+        logger.error(f"Error uploading to blob storage: {str(e)}")
+        raise Exception(f"Failed to upload file: {str(e)}")
+
+async def _agather_all_or_nothing(coroutines, container_name, action):
+    """
+    Async variant of _gather_all_or_nothing, taking coroutines
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.AZURE_STORAGE['UPLOAD_CONCURRENCY']))
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    outcomes = await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines), return_exceptions=True)
+    completed, error = _completed_or_error(outcomes, action)
+    if error:
+        await acleanup_uploaded_files(completed, container_name)
+        raise Exception(str(error))
+    return outcomes
+
+async def aupload_multiple_files(files, container_name="reports"):
+    """
+    Async variant of upload_multiple_files
+    """
+    async def upload(file):
         try:
-            return json.loads(text.strip())
-        except json.JSONDecodeError:
-            pass
+            url = await aupload_to_blob_storage(file, container_name)
+        except Exception as e:
+            raise Exception(f"Failed to upload {file.name}: {str(e)}")
+        return {'name': file.name, 'size': file.size, 'url': url}
+
+    return await _agather_all_or_nothing([upload(file) for file in files], container_name, 'multiple file upload')
 
-        # Second try: Remove markdown code blocks
-        cleaned = re.sub(r'```(?:json)?\n?(.*?)\n?```', r'\1', text, flags=re.DOTALL)
-        cleaned = cleaned.strip()
+async def acleanup_uploaded_files(uploaded_files, container_name="reports"):
+    """
+    Async variant of cleanup_uploaded_files
+    """
+    container_client = get_async_blob_client().get_container_client(container_name)
+    for file_info in uploaded_files:
         try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
-            pass
-
-        # Third try: Find JSON array or object patterns
-        # Look for array pattern first
-        array_match = re.search(r'\[.*?\]', text, re.DOTALL)
-        if array_match:
-            try:
-                return json.loads(array_match.group())
-            except json.JSONDecodeError:
-                pass
+            await container_client.delete_blob(file_info['url'].split('/')[-1])
+        except Exception as e:
+            logger.error(f"Error cleaning up blob: {str(e)}")
+
+async def astage_files(files, container_name=None):
+    """
+    Async variant of stage_files
+    """
+    return await _astage_payloads(await asyncio.to_thread(_read_payloads, files), container_name)
+
+async def _astage_payloads(payloads, container_name=None):
+    container_client = get_async_blob_client().get_container_client(
+        container_name or settings.AZURE_STORAGE['STAGING_CONTAINER']
+    )
+
+    async def stage(file, content):
+        handle, upload = _staging_upload(file, content)
+        blob_client = container_client.get_blob_client(handle)
+        try:
+            await blob_client.upload_blob(**upload)
+            increment('blob_upload_bytes_total', len(content))
+        except ResourceExistsError:
+            # Already staged; touch it so it is not purged while in use
+            await blob_client.set_blob_metadata({'staged': '1'})
+        return {'handle': handle, 'name': file.name, 'size': len(content)}
+
+    with span('blob_stage'):
+        return list(await asyncio.gather(*(stage(*payload) for payload in payloads)))
+
+async def atry_stage_files(files):
+    """
+    Async variant of try_stage_files
+    """
+    return await _atry_stage_payloads(await asyncio.to_thread(_read_payloads, files))
+
+async def _atry_stage_payloads(payloads):
+    try:
+        return await _astage_payloads(payloads)
+    except Exception as e:
+        logger.warning(f"Could not stage report files: {str(e)}")
+        return None
+
+async def astart_staging_files(files):
+    """
+    Async variant of start_staging_files. The files are read on a worker
+    thread (up to five uploads of 10MB) before this returns.
+
+    Returns:
+        asyncio.Task: Resolves to the atry_stage_files result
+    """
+    payloads = await asyncio.to_thread(_read_payloads, files)
+    return asyncio.create_task(_atry_stage_payloads(payloads))
 
-        # Look for object pattern
-        object_match = re.search(r'\{.*?\}', text, re.DOTALL)
-        if object_match:
+async def apromote_staged_files(staged_files, container_name="reports"):
+    """
+    Async variant of promote_staged_files
+    """
+    blob_service_client = get_async_blob_client()
+    staging_client = blob_service_client.get_container_client(settings.AZURE_STORAGE['STAGING_CONTAINER'])
+    container_client = blob_service_client.get_container_client(container_name)
+    _check_staged_handles(staged_files)
+
+    async def promote(staged):
+        try:
+            source = staging_client.get_blob_client(staged['handle'])
             try:
-                return json.loads(object_match.group())
-            except json.JSONDecodeError:
-                pass
+                size = (await source.get_blob_properties()).size
+            except ResourceNotFoundError:
+                raise Exception(f"Staged file {staged['name']} has expired, please upload it again")
+
+            blob_client = container_client.get_blob_client(_report_blob_name(staged['name']))
+            with span('blob_copy'):
+                copy_status = (await blob_client.start_copy_from_url(source.url))['copy_status']
+                # Copies within one account normally complete immediately
+                while copy_status == 'pending':
+                    await asyncio.sleep(0.2)
+                    copy_status = (await blob_client.get_blob_properties()).copy.status
+            if copy_status != 'success':
+                raise Exception(f"Copy of {staged['name']} ended with status {copy_status}")
+            return {'name': staged['name'], 'size': size, 'url': blob_client.url}
+        except Exception as e:
+            raise Exception(f"Failed to promote {staged['name']}: {str(e)}")
+
+    return await _agather_all_or_nothing(
+        [promote(staged) for staged in staged_files], container_name, 'staged file promotion'
+    )
+
+async def _acreate_completion(client, estimated_tokens, kwargs):
+    """
+    Async variant of _create_completion
+    """
+    quota = get_quota()
+    if quota:
+        with span('openai_quota_wait'):
+            await quota.aacquire(requests=1, tokens=estimated_tokens)
+    concurrency = get_concurrency()
+    with span('openai_concurrency_wait'):
+        await concurrency.aacquire()
+    try:
+        with span('openai_completion'):
+            response = await client.chat.completions.create(**kwargs)
+    finally:
+        concurrency.release()
+    if quota:
+        # Settling the token bucket writes to SQLite
+        await asyncio.to_thread(_record_usage, response, quota, estimated_tokens)
+    else:
+        _record_usage(response, quota, estimated_tokens)
+    return response
 
-        # Final try: Look for the most promising {...} or [...] content
-        # This handles nested structures better
-        stack = []
-        start = -1
-        potential_jsons = []
-
-        for i, char in enumerate(text):
-            if char in '{[':
-                if not stack:
-                    start = i
-                stack.append(char)
-            elif char in '}]':
-                if not stack:
-                    continue
-                if (char == '}' and stack[-1] == '{') or (char == ']' and stack[-1] == '['):
-                    stack.pop()
-                    if not stack:  # Complete JSON structure found
-                        potential_jsons.append(text[start:i+1])
-
-        # Try to parse each potential JSON string
-        for json_str in potential_jsons:
+async def _aextract_page(client, system_message, base64_image, schema):
+    """
+    Async variant of _extract_page
+    """
+    path = 'text' if isinstance(base64_image, TextPage) else 'image'
+    start = time.perf_counter()
+    response = await _acreate_completion(client, *_page_request(system_message, base64_image, schema))
+    observe('page_extraction', time.perf_counter() - start, path=path)
+    return _page_result(response, schema)
+
+async def _aextract_page_cached(client, system_message, base64_image, schema):
+    """
+    Async variant of _extract_page_cached; SQLiteCache reads and writes block,
+    so they run in a thread
+    """
+    cache = get_extraction_cache()
+    if cache is None:
+        return await _aextract_page(client, system_message, base64_image, schema)
+
+    key = make_extraction_key(base64_image, schema, PROMPT_VERSION)
+    content = await asyncio.to_thread(cache.get, key)
+    if content is None:
+        content = await _aextract_page(client, system_message, base64_image, schema)
+        await asyncio.to_thread(_cache_extraction, cache, key, content, schema)
+    return content
+
+async def _aextract_pages(client, system_message, base64_images, schema):
+    """
+    Async variant of _extract_pages
+    """
+    start = time.perf_counter()
+    response = await _acreate_completion(client, *_pages_request(system_message, base64_images, schema))
+    observe('page_extraction', time.perf_counter() - start, path='batch')
+    return _pages_result(response, len(base64_images), schema)
+
+async def _aextract_batch(client, system_message, batch, schema):
+    """
+    Async variant of _extract_batch
+    """
+    if len(batch) == 1:
+        return [await _aextract_page_cached(client, system_message, batch[0][1], schema)]
+
+    cache = get_extraction_cache()
+    keys, responses = await asyncio.to_thread(_cached_batch, cache, batch, schema)
+    missing = [position for position, response in enumerate(responses) if response is None]
+    if len(missing) > 1:
+        pages = [batch[position][1] for position in missing]
+        by_page = await _aextract_pages(client, system_message, pages, schema)
+        await asyncio.to_thread(_merge_batch, cache, keys, responses, missing, by_page, schema)
+
+    for position, (index, base64_image) in enumerate(batch):
+        if responses[position] is None:
             try:
-                return json.loads(json_str)
-            except json.JSONDecodeError:
-                continue
+                responses[position] = await _aextract_page_cached(client, system_message, base64_image, schema)
+            except openai.RateLimitError:
+                raise
+            except Exception as e:
+                logger.error(f"Error extracting page {index + 1}: {str(e)}")
+    return responses
 
-        logger.warning(f"Could not extract valid JSON from text: {text[:100]}...")
-        return None
+async def acall_openai_api(base64_images, schema, on_page=None):
+    """
+    Async variant of call_openai_api. Pages are pulled from base64_images on a
+    worker thread (rendering is CPU and subprocess work) and the model calls
+    run as tasks on the event loop, at most AZURE_OPENAI['MAX_CONCURRENCY']
+    batches at a time.
+
+    Returns:
+        list: Model responses in page order; a page that failed is None
+    """
+    pending = {}
+    try:
+        client = get_async_openai_client()
+        system_message = _system_message(schema)
+
+        results = {}
+        throttled = []
+        max_workers = max(1, settings.AZURE_OPENAI['MAX_CONCURRENCY'])
+
+        def collect(done):
+            for task in done:
+                _collect_batch(pending.pop(task), task.result, results, throttled, on_page)
+
+        batches = _iter_batches(base64_images)
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            if len(pending) >= max_workers:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+            task = asyncio.ensure_future(_aextract_batch(client, system_message, batch, schema))
+            pending[task] = batch
+        if pending:
+            collect((await asyncio.wait(pending))[0])
+
+        return _ordered_responses(results, throttled)
 
+    except (PDFConversionError, ExtractionThrottledError):
+        raise
     except Exception as e:
-        logger.error(f"Error extracting JSON: {str(e)}")
-        return None
\ No newline at end of file
+        logger.error(f"Error calling OpenAI API: {str(e)}")
+        raise Exception(f"Failed to process images with OpenAI: {str(e)}")
+    finally:
+        # Left over when the caller was cancelled or rendering failed
+        for task in pending:
+            task.cancel()
+
+async def astream_expense_report(files):
+    """
+    Async variant of stream_expense_report. Extraction runs as a task on the
+    event loop and is cancelled when the consumer stops early (the client
+    disconnected).
+    """
+    events = asyncio.Queue()
+    state = {'total_amount': 0, 'pages_completed': 0}
+
+    async def run():
+        staging = await astart_staging_files(files)
+        try:
+            responses = await acall_openai_api(
+                iter_pdf_pages_as_base64(files), json.dumps(EXPENSE_SCHEMA),
+                on_page=lambda index, response: events.put_nowait(_page_event(state, index, response))
+            )
+            all_expenses = []
+            for response in responses:
+                all_expenses.extend(parse_expenses(response))
+            events.put_nowait(('done', build_report_data(files, all_expenses, await staging)))
+        except Exception as e:
+            events.put_nowait(_error_event(e))
+            await staging
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event, data = await events.get()
+            yield event, data
+            if event in ('done', 'error'):
+                return
+    finally:
+        if not task.done():
+            task.cancel()
@@ -1,23 +1,33 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.viewsets import ViewSet
 from django.shortcuts import get_object_or_404
 from .models import TravelRequest, Document, RequestHistory, Expense  
-from .data import CosmosDB
+from .data import get_cosmos_db
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
 from .utils import upload_to_blob_storage
 from .serializers import (
     TravelRequestSerializer, 
     DocumentSerializer, 
-    RequestHistorySerializer
+    RequestHistorySerializer,
+    represent_travel_request,
+    represent_travel_request_summary
 )
-from datetime import datetime
 from .utils import upload_to_blob_storage, upload_multiple_files, \
-    convert_pdfs_to_base64_images, call_openai_api, extract_json_from_text, cleanup_uploaded_files
+    iter_pdf_pages_as_base64, call_openai_api, parse_expenses, build_report_data, cleanup_uploaded_files, \
+    PDFConversionError, ExtractionThrottledError, EXPENSE_SCHEMA, encode_cursor, decode_cursor, stream_expense_report, \
+    start_staging_files, promote_staged_files
+from .renderers import EventStreamRenderer, ORJSONRenderer, format_sse
+from .jobs import submit_report_job, get_job_store
+from .aggregates import get_aggregate_store
+from .metrics import render_prometheus, span
 import logging
 from django.conf import settings
-import time, json
+import time, json, math
 from rest_framework.parsers import MultiPartParser, FormParser
 
 logger = logging.getLogger(__name__)
@@ -29,15 +39,13 @@ class TravelRequestViewSet(ViewSet):
     permission_classes = [AllowAny]  # Temporarily allow all requests
     serializer_class = TravelRequestSerializer
     
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        logger.info("Cosmos DB Settings:")
-        logger.info(f"Endpoint: {settings.COSMOS_DB['ENDPOINT']}")
-        logger.info(f"Database: {settings.COSMOS_DB['DATABASE']}")
-        logger.info(f"Container: {settings.COSMOS_DB['CONTAINER']}")
-        logger.info(f"Has Primary Key: {bool(settings.COSMOS_DB['PRIMARY_KEY'])}")
-        self.cosmos_db = CosmosDB()
+    @property
+    def cosmos_db(self):
+        # DRF builds a viewset per request; share the process-wide Cosmos connection.
+        # Looked up on use so AsyncTravelRequestViewSet never builds it on the event loop.
+        return get_cosmos_db()
 
+    @span('view', action='list')
     def list(self, request):
 
         logger.info("=== Authenticated User Details ===")
@@ -47,16 +55,70 @@ class TravelRequestViewSet(ViewSet):
         logger.info("=== Headers ===")
         logger.info(dict(request.headers))
 
-        travel_requests = self.cosmos_db.list_travel_requests()
-        serializer = TravelRequestSerializer(travel_requests, many=True)
-        return Response(serializer.data)
+        try:
+            params = self._list_params(request)
+            travel_requests, continuation, etag = self.cosmos_db.list_travel_requests_page(**params)
+        except ValueError:
+            return Response(
+                {'error': 'Invalid page_size or cursor'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return self._list_response(request, travel_requests, continuation, etag, params['summary'])
 
-    def retrieve(self, request, pk=None):
-        travel_request = self.cosmos_db.get_travel_request(pk)
-        if not travel_request:
+    def _list_params(self, request):
+        """
+        Parse the list query parameters into list_travel_requests_page arguments
+
+        Raises:
+            ValueError: page_size or cursor is malformed
+        """
+        page_size = int(request.query_params.get('page_size', settings.COSMOS_DB['PAGE_SIZE']))
+        cursor = request.query_params.get('cursor')
+        return {
+            'requester': request.query_params.get('requester'),
+            'status': request.query_params.get('status'),
+            'page_size': max(1, min(page_size, settings.COSMOS_DB['MAX_PAGE_SIZE'])),
+            'continuation': decode_cursor(cursor) if cursor else None,
+            # ?view=summary returns a projection without documents, expenses and history
+            'summary': request.query_params.get('view') == 'summary'
+        }
+
+    def _list_response(self, request, travel_requests, continuation, etag, summary):
+        # Precompiled read-path serializers; same output as the DRF serializers
+        represent = represent_travel_request_summary if summary else represent_travel_request
+        return self._conditional_response(request, etag, lambda: {
+            'results': [represent(travel_request) for travel_request in travel_requests],
+            'next_cursor': encode_cursor(continuation) if continuation else None
+        })
+
+    def _conditional_response(self, request, etag, build_data):
+        """
+        Respond 304 Not Modified when If-None-Match matches etag, otherwise
+        with the data from build_data(), which is only called in that case.
+        The ETag header is set on both.
+        """
+        if_none_match = request.headers.get('If-None-Match')
+        if etag and if_none_match:
+            # Weak comparison (RFC 9110 13.1.2)
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            if '*' in tags or etag.removeprefix('W/') in tags:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response = Response(build_data())
+        if etag:
+            response['ETag'] = etag
+        return response
+
+    def _retrieve_response(self, request, item):
+        if not item:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        serializer = TravelRequestSerializer(travel_request)
-        return Response(serializer.data)
+        # The Cosmos _etag, also accepted as If-Match by the update actions
+        return self._conditional_response(
+            request, item.get('_etag'), lambda: represent_travel_request(TravelRequest.from_dict(item))
+        )
+
+    @span('view', action='retrieve')
+    def retrieve(self, request, pk=None):
+        return self._retrieve_response(request, self.cosmos_db.get_travel_request_item(pk))
 
     def create(self, request):
         serializer = TravelRequestSerializer(data=request.data)
@@ -81,10 +143,6 @@ class TravelRequestViewSet(ViewSet):
 
     @action(detail=True, methods=['post'])
     def approve(self, request, pk=None):
-        travel_request = self.cosmos_db.get_travel_request(pk)
-        if not travel_request:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-
         # Create history entry
         history_entry = RequestHistory(
             type='approved',
@@ -93,22 +151,22 @@ class TravelRequestViewSet(ViewSet):
             comments=request.data.get('comments', '')
         )
         
-        # Update request
-        updates = {
-            'status': 'APPROVED',
-            'history': travel_request.history + [history_entry],
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        
-        updated_request = self.cosmos_db.update_travel_request(pk, updates)
+        # Patch status and append history in one round-trip
+        try:
+            updated_request = self.cosmos_db.update_travel_request(
+                pk,
+                updates={'status': 'APPROVED'},
+                append={'history': [history_entry]},
+                etag=request.headers.get('If-Match')
+            )
+        except CosmosAccessConditionFailedError:
+            return Response(status=status.HTTP_412_PRECONDITION_FAILED)
+        if not updated_request:
+            return Response(status=status.HTTP_404_NOT_FOUND)
         return Response(TravelRequestSerializer(updated_request).data)
 
     @action(detail=True, methods=['post'])
     def reject(self, request, pk=None):
-        travel_request = self.cosmos_db.get_travel_request(pk)
-        if not travel_request:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-
         # Create history entry
         history_entry = RequestHistory(
             type='rejected',
@@ -117,22 +175,22 @@ class TravelRequestViewSet(ViewSet):
             comments=request.data.get('comments', '')
         )
         
-        # Update request
-        updates = {
-            'status': 'REJECTED',
-            'history': travel_request.history + [history_entry],
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        
-        updated_request = self.cosmos_db.update_travel_request(pk, updates)
+        # Patch status and append history in one round-trip
+        try:
+            updated_request = self.cosmos_db.update_travel_request(
+                pk,
+                updates={'status': 'REJECTED'},
+                append={'history': [history_entry]},
+                etag=request.headers.get('If-Match')
+            )
+        except CosmosAccessConditionFailedError:
+            return Response(status=status.HTTP_412_PRECONDITION_FAILED)
+        if not updated_request:
+            return Response(status=status.HTTP_404_NOT_FOUND)
         return Response(TravelRequestSerializer(updated_request).data)
 
     @action(detail=True, methods=['post'])
     def assign(self, request, pk=None):
-        travel_request = self.cosmos_db.get_travel_request(pk)
-        if not travel_request:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-
         assignee_email = request.data.get('assignee_email')
         comments = request.data.get('comments', '')
         
@@ -144,21 +202,21 @@ class TravelRequestViewSet(ViewSet):
             comments=f"Assigned to {assignee_email}. {comments}"
         )
         
-        # Update request
-        updates = {
-            'history': travel_request.history + [history_entry],
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        
-        updated_request = self.cosmos_db.update_travel_request(pk, updates)
+        # Append history in one round-trip
+        try:
+            updated_request = self.cosmos_db.update_travel_request(
+                pk,
+                append={'history': [history_entry]},
+                etag=request.headers.get('If-Match')
+            )
+        except CosmosAccessConditionFailedError:
+            return Response(status=status.HTTP_412_PRECONDITION_FAILED)
+        if not updated_request:
+            return Response(status=status.HTTP_404_NOT_FOUND)
         return Response(TravelRequestSerializer(updated_request).data)
 
     @action(detail=True, methods=['post'])
     def upload_document(self, request, pk=None):
-        travel_request = self.cosmos_db.get_travel_request(pk)
-        if not travel_request:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-
         file = request.FILES.get('file')
         if not file:
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
@@ -174,20 +232,77 @@ class TravelRequestViewSet(ViewSet):
                 file_url=file_url
             )
             
-            # Update request
-            updates = {
-                'documents': travel_request.documents + [document],
-                'updated_at': datetime.utcnow().isoformat()
-            }
-            
-            updated_request = self.cosmos_db.update_travel_request(pk, updates)
+            # Append the document in one round-trip
+            updated_request = self.cosmos_db.update_travel_request(
+                pk,
+                append={'documents': [document]}
+            )
+            if not updated_request:
+                # The travel request does not exist; do not keep its blob
+                cleanup_uploaded_files([{'url': file_url}])
+                return Response(status=status.HTTP_404_NOT_FOUND)
             return Response(DocumentSerializer(document).data)
             
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
 
+    def _validate_report_files(self, files):
+        """
+        Return an error Response if the uploaded report files are invalid, else None
+        """
+        if not files:
+            return Response(
+                {'error': 'No files provided'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(files) > 5:
+            return Response(
+                {'error': 'Maximum 5 files allowed'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Validate each file
+        for file in files:
+            if file.size > settings.AZURE_STORAGE['MAX_FILE_SIZE']:
+                return Response(
+                    {'error': f'File {file.name} exceeds 10MB limit'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            if file.content_type not in settings.AZURE_STORAGE['ALLOWED_FILE_TYPES']:
+                return Response(
+                    {'error': f'File {file.name} is not a PDF'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        return None
+
+    def _extraction_error_response(self, e):
+        """
+        Map an exception raised by call_openai_api to an error Response
+        """
+        if isinstance(e, PDFConversionError):
+            logger.error(f"Error converting PDFs: {str(e)}")
+            return Response(
+                {'error': f'Error processing PDF files: {str(e)}'}, 
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        if isinstance(e, ExtractionThrottledError):
+            logger.warning(f"Extraction throttled: {str(e)}")
+            headers = {'Retry-After': str(math.ceil(e.retry_after))} if e.retry_after else None
+            return Response(
+                {'error': 'The extraction service is busy, please try again shortly'}, 
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers=headers
+            )
+        logger.error(f"Error calling OpenAI API: {str(e)}")
+        return Response(
+            {'error': f'Error extracting information: {str(e)}'}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
     @action(detail=False, methods=['post'], url_path='generate-report')
+    @span('view', action='generate_report')
     def generate_report(self, request):
         """
         Process uploaded PDFs and extract expense information
@@ -198,110 +313,39 @@ class TravelRequestViewSet(ViewSet):
             files = request.FILES.getlist('files')
             
             # Validate files
-            if not files:
-                return Response(
-                    {'error': 'No files provided'}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            if len(files) > 5:
-                return Response(
-                    {'error': 'Maximum 5 files allowed'}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            # Validate each file
-            for file in files:
-                if file.size > settings.AZURE_STORAGE['MAX_FILE_SIZE']:
-                    return Response(
-                        {'error': f'File {file.name} exceeds 10MB limit'}, 
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-                
-                if file.content_type not in settings.AZURE_STORAGE['ALLOWED_FILE_TYPES']:
-                    return Response(
-                        {'error': f'File {file.name} is not a PDF'}, 
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-            # Convert PDFs to base64 images
-            try:
-                base64_images = convert_pdfs_to_base64_images(files)
-                logger.info(f"Successfully converted {len(base64_images)} pages to images")
-            except Exception as e:
-                logger.error(f"Error converting PDFs: {str(e)}")
-                return Response(
-                    {'error': f'Error processing PDF files: {str(e)}'}, 
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
-            # Define schema for expense extraction
-            schema = {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "date": {
-                            "type": "string",
-                            "format": "date",
-                            "description": "Date of the expense (YYYY-MM-DD)"
-                        },
-                        "category": {
-                            "type": "string",
-                            "description": "Category of expense (e.g., Transportation, Accommodation, Meals)"
-                        },
-                        "description": {
-                            "type": "string",
-                            "description": "Detailed description of the expense"
-                        },
-                        "amount": {
-                            "type": "number",
-                            "description": "Amount of the expense"
-                        }
-                    },
-                    "required": ["date", "category", "description", "amount"]
-                }
-            }
+            error_response = self._validate_report_files(files)
+            if error_response:
+                return error_response
+
+            # Hand the work to the background pool and return immediately
+            if request.query_params.get('mode') == 'async':
+                job_id = submit_report_job(files)
+                return Response({
+                    'job_id': job_id,
+                    'status': 'queued',
+                    'status_url': reverse('travel-request-report-job', kwargs={'job_id': job_id}, request=request)
+                }, status=status.HTTP_202_ACCEPTED)
+
+            # Stage the files so submit-report can reference them instead of
+            # receiving them again; the upload overlaps the extraction
+            staging = start_staging_files(files)
+
+            # Render PDF pages lazily; pages are sent to the model as they are ready
+            base64_images = iter_pdf_pages_as_base64(files)
 
             # Call OpenAI API for each image
             try:
-                responses = call_openai_api(base64_images, json.dumps(schema))
+                responses = call_openai_api(base64_images, json.dumps(EXPENSE_SCHEMA))
                 logger.info(f"Received {len(responses)} responses from OpenAI")
             except Exception as e:
-                logger.error(f"Error calling OpenAI API: {str(e)}")
-                return Response(
-                    {'error': f'Error extracting information: {str(e)}'}, 
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+                return self._extraction_error_response(e)
 
             # Process responses and combine expenses
             all_expenses = []
             for response in responses:
-                try:
-                    expenses = extract_json_from_text(response)
-                    if isinstance(expenses, list):
-                        all_expenses.extend(expenses)
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Error parsing OpenAI response: {str(e)}")
-                    continue
-
-            # Store file information for later upload
-            file_info = [{
-                'name': file.name,
-                'size': file.size,
-                'content_type': file.content_type
-            } for file in files]
-
-            # Prepare response with dummy data and extracted expenses
-            extracted_data = {
-                'requester': 'John Doe',
-                'department': 'Engineering',
-                'position': 'Software Engineer',
-                'start_date': '2024-01-15',
-                'end_date': '2024-01-20',
-                'total_amount': sum(expense['amount'] for expense in all_expenses if 'amount' in expense),
-                'expenses': all_expenses,
-                'files': file_info
-            }
+                all_expenses.extend(parse_expenses(response))
+
+            extracted_data = build_report_data(files, all_expenses, staging.result())
 
             return Response(extracted_data, status=status.HTTP_200_OK)
 
@@ -312,19 +356,57 @@ class TravelRequestViewSet(ViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
+    @action(detail=False, methods=['post'], url_path='generate-report/stream',
+            renderer_classes=[ORJSONRenderer, EventStreamRenderer])
+    def generate_report_stream(self, request):
+        """
+        Streaming variant of generate-report. Sends a server-sent 'page' event with
+        each page's expenses and the running total as soon as that page completes,
+        then a 'done' event with the full report (or an 'error' event).
+        """
+        files = request.FILES.getlist('files')
+        error_response = self._validate_report_files(files)
+        if error_response:
+            return error_response
+
+        def events():
+            for event, data in stream_expense_report(files):
+                yield format_sse(event, data)
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering
+        return response
+
+    @action(detail=False, methods=['get'], url_path=r'report-jobs/(?P<job_id>[0-9a-f-]+)')
+    def report_job(self, request, job_id=None):
+        """
+        Return the status, per-page progress and (when finished) the result
+        of a generate-report job started with ?mode=async
+        """
+        job = get_job_store().get(job_id)
+        if not job:
+            return Response(
+                {'error': 'Report job not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(job)
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """
+        Return request counts and total_amount sums by status, department and
+        month, maintained from the change feed by the consume_change_feed command
+        """
+        return Response(get_aggregate_store().stats())
+
     @action(detail=True, methods=['put'], url_path='update-report')
+    @span('view', action='update_report')
     def update_report(self, request, pk=None):
         """
         Update a travel request with edited report data
         """
         try:
-            travel_request = self.cosmos_db.get_travel_request(pk)
-            if not travel_request:
-                return Response(
-                    {'error': 'Travel request not found'}, 
-                    status=status.HTTP_404_NOT_FOUND
-                )
-
             # Create history entry for the update
             history_entry = RequestHistory(
                 type='updated',
@@ -333,21 +415,30 @@ class TravelRequestViewSet(ViewSet):
                 comments='Report details were updated'
             )
 
-            # Update the travel request with new data
-            updates = {
-                'requester': request.data.get('requester', travel_request.requester),
-                'department': request.data.get('department', travel_request.department),
-                'position': request.data.get('position', travel_request.position),
-                'start_date': request.data.get('start_date', travel_request.start_date),
-                'end_date': request.data.get('end_date', travel_request.end_date),
-                'total_amount': request.data.get('total_amount', travel_request.total_amount),
-                'expenses': request.data.get('expenses', travel_request.expenses),
-                'updated_at': datetime.utcnow().isoformat(),
-                'history': travel_request.history + [history_entry]
-            }
-            
+            # Only the fields present in the request are patched; the rest are left as stored
+            fields = ['requester', 'department', 'position', 'start_date', 'end_date', 'total_amount']
+            updates = {field: request.data[field] for field in fields if field in request.data}
+            if 'expenses' in request.data:
+                updates['expenses'] = [Expense.from_dict(expense) for expense in request.data['expenses']]
+
             # Update in Cosmos DB
-            updated_request = self.cosmos_db.update_travel_request(pk, updates)
+            try:
+                updated_request = self.cosmos_db.update_travel_request(
+                    pk,
+                    updates=updates,
+                    append={'history': [history_entry]},
+                    etag=request.headers.get('If-Match')
+                )
+            except CosmosAccessConditionFailedError:
+                return Response(
+                    {'error': 'Travel request was modified by another user'}, 
+                    status=status.HTTP_412_PRECONDITION_FAILED
+                )
+            if not updated_request:
+                return Response(
+                    {'error': 'Travel request not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             
             return Response(TravelRequestSerializer(updated_request).data)
 
@@ -358,6 +449,7 @@ class TravelRequestViewSet(ViewSet):
             )
 
     @action(detail=False, methods=['post'], url_path='submit-report', parser_classes=[MultiPartParser, FormParser])
+    @span('view', action='submit_report')
     def submit_report(self, request):
         """
         Create a new travel request from the user-validated extracted data
@@ -366,7 +458,7 @@ class TravelRequestViewSet(ViewSet):
         try:
             # Get files from request
             files = request.FILES.getlist('files')
-            print(files)
+            logger.debug(f"submit_report received {len(files)} files")
             
             # Parse the JSON data from the form
             try:
@@ -383,12 +475,31 @@ class TravelRequestViewSet(ViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            # Files staged by generate-report are copied server-side instead of re-uploaded
+            staged_files = data.get('staged_files') or []
+            if staged_files:
+                try:
+                    uploaded_files = promote_staged_files(staged_files)
+                    logger.info(f"Promoted {len(uploaded_files)} staged files")
+                except ValueError as e:
+                    return Response(
+                        {'error': str(e)}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                except Exception as e:
+                    logger.error(f"Error promoting staged files: {str(e)}")
+                    return Response(
+                        {'error': f'Error uploading files: {str(e)}'}, 
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                    )
+
             if files:
                 try:
-                    uploaded_files = upload_multiple_files(files)
-                    logger.info(f"Successfully uploaded {len(uploaded_files)} files to blob storage")
+                    uploaded_files = uploaded_files + upload_multiple_files(files)
+                    logger.info(f"Successfully uploaded {len(files)} files to blob storage")
                 except Exception as e:
                     logger.error(f"Error uploading files: {str(e)}")
+                    cleanup_uploaded_files(uploaded_files)
                     return Response(
                         {'error': f'Error uploading files: {str(e)}'}, 
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -460,4 +571,14 @@ class TravelRequestViewSet(ViewSet):
             return Response(
                 {'error': f'Error submitting report: {str(e)}'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+
+
+def metrics(request):
+    """
+    Expose this worker's pipeline metrics in the Prometheus text format.
+    Only clients listed in METRICS['ALLOWED_IPS'] may scrape it.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS['ALLOWED_IPS']:
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -64,7 +64,9 @@ export default {
         start_date: reportData.start_date,
         end_date: reportData.end_date,
         total_amount: reportData.total_amount,
-        expenses: reportData.expenses
+        expenses: reportData.expenses,
+        // Handles of the files already staged by generate-report
+        staged_files: reportData.staged_files || []
       };
       
       formData.append('data', JSON.stringify(metadata));